@@ -0,0 +1,149 @@
+import argparse, asyncio, os, statistics, subprocess, sys, tempfile
+
+from .datasets import parse_size
+from .harness import bench_session, make_report, load_json, dump_json, compare
+from .scenarios import bench_endpoints, bench_download, bench_dtypes, bench_storage
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DATA_DIR = os.path.join(BENCH_DIR, 'data')
+DEFAULT_THRESHOLDS = os.path.join(BENCH_DIR, 'thresholds.json')
+
+
+def add_common_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--redis', choices=('fake', 'local'), default='fake',
+                        help='fakeredis in-process or the redis from REDIS_URL')
+    parser.add_argument('--base-url', default=None,
+                        help='benchmark a running server instead of the in-process ASGI app')
+    parser.add_argument('--server-pid', type=int, default=None,
+                        help='pid of the server at --base-url, its peak RSS is reported too (Linux)')
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', default=None, help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', default=None, help='JSON report to compare against')
+    parser.add_argument('--thresholds', default=DEFAULT_THRESHOLDS)
+
+
+def finish(report: dict, args) -> int:
+    dump_json(report, args.output)
+    if not args.baseline:
+        return 0
+    regressions = compare(report['results'], load_json(args.baseline), load_json(args.thresholds))
+    for message in regressions:
+        print('REGRESSION', message, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+async def endpoints(args) -> int:
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    async with bench_session(args.redis, args.base_url, args.server_pid) as session:
+        results = await bench_endpoints(session, sizes, args.data_dir, args.requests, args.concurrency)
+    report = make_report(results, command='endpoints', redis=args.redis, requests=args.requests,
+                         concurrency=args.concurrency, sizes=args.sizes)
+    return finish(report, args)
+
+
+async def download(args) -> int:
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    async with bench_session(args.redis, args.base_url, args.server_pid) as session:
+        results = await bench_download(session, sizes, args.data_dir, args.requests, args.concurrency)
+    report = make_report(results, command='download', redis=args.redis, requests=args.requests,
+                         concurrency=args.concurrency, sizes=args.sizes)
+    return finish(report, args)
+
+
+async def dtypes(args) -> int:
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    results = bench_dtypes(sizes, args.data_dir, args.repeat)
+    dump_json(make_report(results, command='dtypes', repeat=args.repeat, sizes=args.sizes), args.output)
+    return 0
+
+
+async def storage(args) -> int:
+    size = parse_size(args.size)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # local directories stand in for volumes unless real mount points are given
+        roots = args.roots.split(',') if args.roots else [os.path.join(tmpdir, f'volume{i}') for i in range(4)]
+        results = bench_storage(roots, args.users, size, args.concurrency)
+    report = make_report(results, command='storage', roots=len(roots), users=args.users, size=args.size,
+                         concurrency=args.concurrency)
+    dump_json(report, args.output)
+    return 0
+
+
+async def overhead(args) -> int:
+    """Run the endpoint benchmark with metrics disabled and enabled and compare median latencies."""
+    reports = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for enabled in ('false', 'true'):
+            output = os.path.join(tmpdir, f'metrics-{enabled}.json')
+            command = [sys.executable, '-m', 'benchmarks', 'endpoints', '--redis', args.redis,
+                       '--requests', str(args.requests), '--concurrency', str(args.concurrency),
+                       '--sizes', args.sizes, '--data-dir', args.data_dir, '--output', output]
+            subprocess.run(command, check=True, env={**os.environ, 'METRICS_ENABLED': enabled})
+            reports[enabled] = load_json(output)['results']
+
+    results = {}
+    for name, off in reports['false'].items():
+        on = reports['true'][name]
+        results[name] = {
+            'p50_ms_disabled': off['p50_ms'],
+            'p50_ms_enabled': on['p50_ms'],
+            'overhead': round(on['p50_ms'] / off['p50_ms'] - 1, 4) if off['p50_ms'] else 0.0,
+        }
+    # the median across scenarios keeps one noisy scenario from deciding the result
+    total = round(statistics.median(result['overhead'] for result in results.values()), 4)
+    report = make_report(results, command='overhead', redis=args.redis, requests=args.requests,
+                         concurrency=args.concurrency, sizes=args.sizes, overhead=total)
+    dump_json(report, args.output)
+    if total > args.max_overhead:
+        print(f'REGRESSION metrics overhead {total:.2%} > {args.max_overhead:.2%}', file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_endpoints = subparsers.add_parser('endpoints', help='latency and throughput of every router')
+    add_common_arguments(parser_endpoints)
+    parser_endpoints.add_argument('--sizes', default='64KB,1MB', help='comma separated CSV sizes, e.g. 64KB,10MB,1GB')
+    parser_endpoints.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help='cache for generated CSV files')
+    parser_endpoints.set_defaults(handler=endpoints)
+
+    parser_download = subparsers.add_parser('download', help='raw file download against the pandas read path')
+    add_common_arguments(parser_download)
+    parser_download.add_argument('--sizes', default='1MB,64MB')
+    parser_download.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser_download.set_defaults(handler=download)
+
+    parser_dtypes = subparsers.add_parser('dtypes', help='parse time and memory with the inferred dtypes')
+    parser_dtypes.add_argument('--sizes', default='1MB,64MB')
+    parser_dtypes.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser_dtypes.add_argument('--repeat', type=int, default=5, help='parses per measurement, the median is reported')
+    parser_dtypes.add_argument('--output', default=None)
+    parser_dtypes.set_defaults(handler=dtypes)
+
+    parser_storage = subparsers.add_parser('storage', help='file throughput with users spread over storage roots')
+    parser_storage.add_argument('--roots', default=None,
+                                help='comma separated directories on separate volumes, 4 temporary ones by default')
+    parser_storage.add_argument('--users', type=int, default=64)
+    parser_storage.add_argument('--size', default='4MB', help='size of the file written and read per user')
+    parser_storage.add_argument('--concurrency', type=int, default=16)
+    parser_storage.add_argument('--output', default=None)
+    parser_storage.set_defaults(handler=storage)
+
+    parser_overhead = subparsers.add_parser('overhead', help='latency added by the metrics instrumentation')
+    add_common_arguments(parser_overhead)
+    parser_overhead.add_argument('--sizes', default='64KB,1MB')
+    parser_overhead.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser_overhead.add_argument('--max-overhead', type=float, default=0.05,
+                                 help='fail when the median p50 overhead across scenarios exceeds this fraction')
+    parser_overhead.set_defaults(handler=overhead)
+
+    args = parser.parse_args(argv)
+    return asyncio.run(args.handler(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
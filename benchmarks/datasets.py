@@ -0,0 +1,66 @@
+import os, random
+
+SIZE_UNITS = {'GB': 1024 ** 3, 'MB': 1024 ** 2, 'KB': 1024, 'B': 1}
+FIELDNAMES = ['Index', 'User Id', 'First Name', 'Last Name', 'Sex', 'Email', 'Phone', 'Date of birth', 'Job Title']
+
+FIRST_NAMES = ['Shelby', 'Phillip', 'Kristine', 'Yesenia', 'Lori', 'Erin', 'Katherine', 'Ricardo', 'Dale', 'Gwendolyn']
+LAST_NAMES = ['Terrell', 'Summers', 'Travis', 'Martinez', 'Todd', 'Day', 'Buck', 'Hinton', 'Richard', 'Rocha']
+JOB_TITLES = ['Games developer', 'Phytotherapist', 'Homeopath', 'Market researcher', 'Veterinary surgeon',
+              'Waste management officer', 'Intelligence analyst', 'Hydrogeologist', 'Lawyer', 'Dancer']
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().upper()
+    for unit, factor in SIZE_UNITS.items():
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * factor)
+    return int(value)
+
+
+def format_size(size: int) -> str:
+    for unit, factor in SIZE_UNITS.items():
+        if size >= factor and size % factor == 0:
+            return f'{size // factor}{unit}'
+    return f'{size}B'
+
+
+def _row_template(rnd: random.Random) -> str:
+    first, last = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+    return ','.join((
+        '{index}',
+        '%016x' % rnd.getrandbits(64),
+        first,
+        last,
+        rnd.choice(('Male', 'Female')),
+        f'{first.lower()}.{last.lower()}{rnd.randint(1, 999)}@example.com',
+        f'+1-{rnd.randint(200, 999)}-{rnd.randint(100, 999)}-{rnd.randint(1000, 9999)}',
+        f'{rnd.randint(1940, 2010)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}',
+        f'"{rnd.choice(JOB_TITLES)}"',
+    )) + '\n'
+
+
+def generate_csv(path: str, size: int, seed: int = 0) -> int:
+    """Write a people-like CSV of at least ``size`` bytes and return the number of data rows."""
+    rnd = random.Random(seed)
+    templates = [_row_template(rnd) for _ in range(1024)]
+    header = ','.join(FIELDNAMES) + '\n'
+    written, rows = len(header), 0
+    with open(path, 'w', encoding='utf-8', newline='') as outfile:
+        outfile.write(header)
+        while written < size:
+            count = min(4096, (size - written) // 100 + 1)
+            batch = ''.join(templates[(rows + i) % 1024].format(index=rows + i + 1) for i in range(count))
+            outfile.write(batch)
+            written += len(batch)
+            rows += count
+    return rows
+
+
+def ensure_dataset(directory: str, size: int, seed: int = 0) -> str:
+    """Return the path of a cached generated dataset, generating it on first use."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'bench-{format_size(size)}-{seed}.csv')
+    if not os.path.isfile(path):
+        generate_csv(path + '.tmp', size, seed)
+        os.replace(path + '.tmp', path)
+    return path
@@ -0,0 +1,231 @@
+import asyncio, json, math, os, platform, time
+from contextlib import asynccontextmanager
+from typing import get_args
+from datetime import timedelta, datetime, UTC
+
+from fastapi import HTTPException
+from httpx import AsyncClient
+
+from src.app.constants import APP_URL, METRICS_ENABLED
+from src.app.dependencies import get_db, get_password_hash, create_access_token
+from src.app.main import app
+from src.app.metrics import RedisMetricsMixin, observe_redis_usage
+from src.app.schemas.users import UserInDB, RateLimit, RouteClass
+from src.app.sql_app.crud import create_user, delete_user
+
+BENCH_USERNAME = 'benchmark_user'
+BENCH_PASSWORD = 'benchmark_password'
+
+DEFAULT_THRESHOLDS = {
+    'latency_tolerance': 0.25,
+    'throughput_tolerance': 0.20,
+    'rss_tolerance': 0.25,
+}
+
+
+def percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def reset_peak_rss(pid: int | str = 'self') -> bool:
+    """Reset the peak RSS (VmHWM) of process ``pid``, so the next reading covers one scenario. Linux only."""
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as outfile:
+            outfile.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_mb(pid: int | str = 'self') -> float | None:
+    """Peak RSS of process ``pid`` since its last reset, None where /proc doesn't report it."""
+    try:
+        with open(f'/proc/{pid}/status') as infile:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def summarize(durations: list[float], errors: int, elapsed: float) -> dict:
+    return {
+        'requests': len(durations),
+        'errors': errors,
+        'p50_ms': round(percentile(durations, 50) * 1000, 3),
+        'p95_ms': round(percentile(durations, 95) * 1000, 3),
+        'p99_ms': round(percentile(durations, 99) * 1000, 3),
+        'rps': round(len(durations) / elapsed, 2) if elapsed else 0.0,
+    }
+
+
+async def run_load(send, requests: int, concurrency: int, server_pid: int | None = None) -> dict:
+    """Call ``send(i)`` ``requests`` times from ``concurrency`` workers and summarize the latencies.
+
+    Peak RSS is measured for this scenario alone, of this process and of the server process ``server_pid``
+    (this one too for the in-process app). It is None where the peak can't be reset, a process lifetime
+    peak would hide the regressions of every scenario run after the largest one.
+    """
+    durations, errors = [], 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            response = await send(i)
+            durations.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    server = 'self' if server_pid == os.getpid() else server_pid
+    pids = [pid for pid in dict.fromkeys(['self', server]) if pid]
+    reset = {pid: reset_peak_rss(pid) for pid in pids}
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result = summarize(durations, errors, time.perf_counter() - start)
+    peaks = {pid: peak_rss_mb(pid) if reset[pid] else None for pid in pids}
+    result['peak_rss_mb'] = peaks['self']
+    result['server_peak_rss_mb'] = peaks.get(server)
+    return result
+
+
+def fake_db_override():
+    import fakeredis
+
+    server = fakeredis.FakeServer()
+    if METRICS_ENABLED:
+        redis_class = type('InstrumentedFakeRedis', (RedisMetricsMixin, fakeredis.aioredis.FakeRedis), {})
+    else:
+        redis_class = fakeredis.aioredis.FakeRedis
+
+    async def get_fake_db():
+        client = redis_class(server=server, decode_responses=True)
+        try:
+            yield client
+        finally:
+            if METRICS_ENABLED:
+                observe_redis_usage(client)
+            await client.aclose()
+
+    return get_fake_db
+
+
+class BenchSession:
+
+    def __init__(self, client: AsyncClient, db, token: str, server_pid: int | None = None):
+        self.client = client
+        self.db = db
+        self.token = token
+        self.server_pid = server_pid
+        self.username = BENCH_USERNAME
+        self.password = BENCH_PASSWORD
+
+    @property
+    def headers(self) -> dict:
+        return {'Authorization': 'Bearer ' + self.token}
+
+
+@asynccontextmanager
+async def bench_session(redis: str = 'fake', base_url: str | None = None, server_pid: int | None = None):
+    """Create the benchmark user and yield a client bound to the in-process app or to ``base_url``.
+
+    ``server_pid`` is the process serving ``base_url``, whose peak RSS is reported next to the client's.
+    """
+    get_session_db = get_db
+    if redis == 'fake':
+        if base_url:
+            raise ValueError('fakeredis can only be used with the in-process ASGI client')
+        get_session_db = fake_db_override()
+        app.dependency_overrides[get_db] = get_session_db
+
+    db = await anext(get_session_db())
+    try:
+        await delete_user(db, BENCH_USERNAME)
+    except HTTPException:
+        pass
+    # the benchmark measures the server, not the rate limiter
+    rate_limits = {route_class: RateLimit(rate=1e9, burst=10 ** 9) for route_class in get_args(RouteClass)}
+    user = UserInDB(username=BENCH_USERNAME, hashed_password=get_password_hash(BENCH_PASSWORD), admin=True,
+                    rate_limits=rate_limits)
+    await create_user(db, user.username, user.model_dump_json())
+    token = create_access_token(data={'sub': user.username}, expires_delta=timedelta(hours=1))
+
+    if base_url:
+        client = AsyncClient(base_url=base_url, timeout=None)
+    else:
+        client = AsyncClient(app=app, base_url=APP_URL, timeout=None)
+    try:
+        async with client:
+            yield BenchSession(client, db, token, server_pid if base_url else os.getpid())
+    finally:
+        await delete_user(db, BENCH_USERNAME)
+        await db.aclose()
+        app.dependency_overrides.pop(get_db, None)
+
+
+def make_report(results: dict, **meta) -> dict:
+    return {
+        'meta': {
+            'created': datetime.now(UTC).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            **meta,
+        },
+        'results': results,
+    }
+
+
+def load_json(path: str | None, default: dict | None = None) -> dict:
+    if not path:
+        return default or {}
+    with open(path, encoding='utf-8') as infile:
+        return json.load(infile)
+
+
+def dump_json(report: dict, path: str | None):
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w', encoding='utf-8') as outfile:
+            outfile.write(text + '\n')
+    else:
+        print(text)
+
+
+def compare(results: dict, baseline: dict, thresholds: dict | None = None) -> list[str]:
+    """Return a message for every metric in ``results`` that regressed past its threshold."""
+    thresholds = thresholds or {}
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        limits = {**DEFAULT_THRESHOLDS, **thresholds.get('default', {}), **thresholds.get('scenarios', {}).get(name, {})}
+
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            allowed = previous[metric] * (1 + limits['latency_tolerance'])
+            if current[metric] > allowed:
+                regressions.append(f'{name}: {metric} {current[metric]} > {allowed:.3f} (baseline {previous[metric]})')
+
+        allowed = previous['rps'] * (1 - limits['throughput_tolerance'])
+        if current['rps'] < allowed:
+            regressions.append(f'{name}: rps {current["rps"]} < {allowed:.2f} (baseline {previous["rps"]})')
+
+        for metric in ('peak_rss_mb', 'server_peak_rss_mb'):
+            # not measured on this platform or for this run
+            if current.get(metric) is None or previous.get(metric) is None:
+                continue
+            allowed = previous[metric] * (1 + limits['rss_tolerance'])
+            if current[metric] > allowed:
+                regressions.append(
+                    f'{name}: {metric} {current[metric]} > {allowed:.1f} (baseline {previous[metric]})'
+                )
+
+        if current['errors'] > previous['errors']:
+            regressions.append(f'{name}: errors {current["errors"]} > {previous["errors"]}')
+    return regressions
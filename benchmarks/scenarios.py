@@ -0,0 +1,220 @@
+import os, statistics, time
+
+from .datasets import ensure_dataset, format_size, FIELDNAMES, LAST_NAMES
+from .harness import BenchSession, run_load
+
+
+async def upload_dataset(session: BenchSession, path: str, filename: str, index_columns: str | None = None):
+    params = {'index_columns': index_columns} if index_columns else None
+    with open(path, 'rb') as infile:
+        response = await session.client.post(
+            '/uploadfiles/', headers=session.headers, params=params,
+            files=[('files', (filename, infile, 'text/csv'))],
+        )
+    response.raise_for_status()
+
+
+async def bench_endpoints(session: BenchSession, sizes: list[int], data_dir: str,
+                          requests: int, concurrency: int) -> dict:
+    """Drive every router and return the summary of each scenario keyed by its name."""
+    client, headers = session.client, session.headers
+    results = {}
+
+    async def token(i):
+        return await client.post('/token/', data={'username': session.username, 'password': session.password})
+
+    async def users_me(i):
+        return await client.get('/users/me', headers=headers)
+
+    async def users_list(i):
+        return await client.get('/users/', headers=headers)
+
+    results['token'] = await run_load(token, requests, concurrency, session.server_pid)
+    results['users_me'] = await run_load(users_me, requests, concurrency, session.server_pid)
+    results['users_list'] = await run_load(users_list, requests, concurrency, session.server_pid)
+
+    for size in sizes:
+        label = format_size(size)
+        path = ensure_dataset(data_dir, size)
+        filename = os.path.basename(path)
+        with open(path, 'rb') as infile:
+            content = infile.read() if size <= 64 * 1024 ** 2 else None
+
+        async def upload(i):
+            name = f'upload-{i}-{filename}'
+            if content is not None:
+                return await client.post('/uploadfiles/', headers=headers, files=[('files', (name, content))])
+            with open(path, 'rb') as infile:
+                return await client.post('/uploadfiles/', headers=headers, files=[('files', (name, infile))])
+
+        async def remove(i):
+            return await client.delete(f'/uploadfiles/upload-{i}-{filename}', headers=headers)
+
+        upload_requests = max(1, min(requests, (256 * 1024 ** 2) // size))
+        results[f'upload[{label}]'] = await run_load(upload, upload_requests, concurrency, session.server_pid)
+        results[f'delete[{label}]'] = await run_load(remove, upload_requests, concurrency, session.server_pid)
+
+        await upload_dataset(session, path, filename, index_columns='Last Name')
+
+        async def read(i):
+            return await client.get(f'/uploadfiles/{filename}', headers=headers)
+
+        async def read_sorted(i):
+            params = {'headers': ','.join(FIELDNAMES[:4]), 'sort_by': 'Last Name,First Name'}
+            return await client.get(f'/uploadfiles/{filename}', headers=headers, params=params)
+
+        async def read_full(i):
+            async with client.stream('GET', f'/uploadfiles/{filename}', headers=headers,
+                                     params={'full': True}) as response:
+                async for _ in response.aiter_raw():
+                    pass
+            return response
+
+        async def read_sample(i):
+            return await client.get(f'/uploadfiles/{filename}', headers=headers, params={'sample': 100, 'seed': i})
+
+        async def search(i):
+            # every last name is in most row blocks, the rows of the first blocks fill the limit
+            params = {'q': LAST_NAMES[i % len(LAST_NAMES)], 'limit': 100}
+            return await client.get('/uploadfiles/search', headers=headers, params=params)
+
+        read_requests = max(1, min(requests, (1024 ** 3) // size))
+        results[f'read[{label}]'] = await run_load(read, read_requests, concurrency, session.server_pid)
+        results[f'read_sample[{label}]'] = await run_load(read_sample, requests, concurrency, session.server_pid)
+        results[f'read_sorted[{label}]'] = await run_load(read_sorted, read_requests, concurrency, session.server_pid)
+        results[f'read_full[{label}]'] = await run_load(read_full, read_requests, concurrency, session.server_pid)
+        results[f'search[{label}]'] = await run_load(search, requests, concurrency, session.server_pid)
+
+    async def list_files(i):
+        return await client.get('/uploadfiles/', headers=headers)
+
+    results['list_files'] = await run_load(list_files, requests, concurrency, session.server_pid)
+    return results
+
+
+async def bench_download(session: BenchSession, sizes: list[int], data_dir: str,
+                         requests: int, concurrency: int) -> dict:
+    """Compare the raw download of a file with reading it back through pandas."""
+    client, headers = session.client, session.headers
+    results = {}
+
+    async def consume(url, **kwargs):
+        async with client.stream('GET', url, **kwargs) as response:
+            async for _ in response.aiter_raw():
+                pass
+        return response
+
+    for size in sizes:
+        label = format_size(size)
+        path = ensure_dataset(data_dir, size)
+        filename = os.path.basename(path)
+        await upload_dataset(session, path, filename)
+        parts = 4
+        part_size = -(-size // parts)
+
+        async def raw(i):
+            return await consume(f'/uploadfiles/{filename}/raw', headers=headers)
+
+        async def raw_range(i):
+            # every request fetches one quarter, like a client downloading in parallel
+            start = (i % parts) * part_size
+            range_headers = {**headers, 'Range': f'bytes={start}-{start + part_size - 1}'}
+            return await consume(f'/uploadfiles/{filename}/raw', headers=range_headers)
+
+        async def pandas_full(i):
+            return await consume(f'/uploadfiles/{filename}', headers=headers, params={'full': True})
+
+        count = max(1, min(requests, (1024 ** 3) // size))
+        for name, send, transferred in (('raw', raw, size), ('raw_range', raw_range, part_size),
+                                        ('pandas_full', pandas_full, size)):
+            result = await run_load(send, count, concurrency, session.server_pid)
+            result['mb_per_s'] = round(result['rps'] * transferred / 1024 ** 2, 2)
+            results[f'{name}[{label}]'] = result
+
+        await client.delete(f'/uploadfiles/{filename}', headers=headers)
+    return results
+
+
+def bench_dtypes(sizes: list[int], data_dir: str, repeat: int) -> dict:
+    """Parse time and frame memory of a plain ``pd.read_csv`` against a read with the inferred schema."""
+    import pandas as pd
+    from src.app.datasets import infer_schema, read_frame
+
+    def measure(read) -> tuple[float, int]:
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            df = read()
+            durations.append(time.perf_counter() - start)
+        return statistics.median(durations), int(df.memory_usage(deep=True).sum())
+
+    results = {}
+    for size in sizes:
+        path = ensure_dataset(data_dir, size)
+        start = time.perf_counter()
+        schema = infer_schema(path)
+        infer_seconds = time.perf_counter() - start
+
+        parse_before, memory_before = measure(lambda: pd.read_csv(path))
+        parse_after, memory_after = measure(lambda: read_frame(path, FIELDNAMES, schema))
+        results[f'dtypes[{format_size(size)}]'] = {
+            'rows': schema['rows'],
+            'dtypes': schema['columns'],
+            'infer_s': round(infer_seconds, 4),
+            'parse_s_before': round(parse_before, 4),
+            'parse_s_after': round(parse_after, 4),
+            'memory_mb_before': round(memory_before / 1024 ** 2, 2),
+            'memory_mb_after': round(memory_after / 1024 ** 2, 2),
+        }
+    return results
+
+
+def bench_storage(roots: list[str], users: int, size: int, concurrency: int) -> dict:
+    """Write and read back one file per user with the users spread over the first 1, 2, 4... of ``roots``.
+
+    Files are fsynced, so with ``roots`` on separate volumes the write throughput scales with their number.
+    """
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+    from src.app.storage import HashRing
+
+    block = os.urandom(min(size, 1024 ** 2))
+    counts = sorted({min(2 ** power, len(roots)) for power in range(len(roots).bit_length() + 1)})
+
+    def write(path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as outfile:
+            for start in range(0, size, len(block)):
+                outfile.write(block[:size - start])
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def read(path: str):
+        with open(path, 'rb') as infile:
+            while infile.read(1024 ** 2):
+                pass
+
+    def run(operation, paths: list[str]) -> float:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(operation, paths))
+        return time.perf_counter() - start
+
+    results = {}
+    for count in counts:
+        ring = HashRing(roots[:count])
+        placed = {f'bench_user{i}': ring.root_for(f'bench_user{i}') for i in range(users)}
+        paths = [os.path.join(root, username, 'data.csv') for username, root in placed.items()]
+        write_seconds = run(write, paths)
+        read_seconds = run(read, paths)
+        for username, root in placed.items():
+            shutil.rmtree(os.path.join(root, username), ignore_errors=True)
+        per_root = [list(placed.values()).count(root) for root in ring.roots]
+        total_mb = users * size / 1024 ** 2
+        results[f'storage[{count} roots]'] = {
+            'users_per_root_min': min(per_root),
+            'users_per_root_max': max(per_root),
+            'write_mb_per_s': round(total_mb / write_seconds, 2),
+            'read_mb_per_s': round(total_mb / read_seconds, 2),
+        }
+    return results
@@ -0,0 +1,164 @@
+import asyncio, csv, io, json, os
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, status
+from redis.asyncio import Redis
+from redis.exceptions import LockError, RedisError
+
+from .constants import APPEND_LOCK_TIMEOUT, APPEND_LOCK_WAIT
+from .datasets import build_metadata, load_schema, load_stats, update_schema
+from .formats import ALIASES, CSV, NDJSON
+from .rowindex import RowIndex, read_record
+from .sql_app.crud import INTERNAL_KEY_PREFIX
+from .valueindex import ValueIndex, build_value_index, indexed_columns
+
+JSON = 'application/json'
+
+
+def lock_key(username: str, filename: str) -> str:
+    return f'{INTERNAL_KEY_PREFIX}lock:{username}:{filename}'
+
+
+async def _renew_lock(lock):
+    while True:
+        await asyncio.sleep(APPEND_LOCK_TIMEOUT / 3)
+        try:
+            await lock.reacquire()
+        except LockError:
+            # expired while the event loop was blocked, the release finds it gone too
+            return
+        except RedisError:
+            # tried again on the next tick, the lock outlives a missed renewal
+            continue
+
+
+@asynccontextmanager
+async def file_lock(db: Redis, username: str, filename: str):
+    """Serialize writers of one file across workers or answer 503 when it stays locked.
+
+    The lock is renewed while it is held, a metadata rebuild may take longer than APPEND_LOCK_TIMEOUT. The timeout
+    only frees the lock of a worker that died holding it.
+    """
+    lock = db.lock(lock_key(username, filename), timeout=APPEND_LOCK_TIMEOUT, blocking_timeout=APPEND_LOCK_WAIT)
+    if not await lock.acquire():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='File is locked',
+            headers={'Retry-After': '1'},
+        )
+    renew = asyncio.create_task(_renew_lock(lock))
+    try:
+        yield
+    finally:
+        renew.cancel()
+        try:
+            await lock.release()
+        except LockError:
+            # expired, it couldn't be renewed in time
+            pass
+
+
+def _bad_row(number: int) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Bad row {number}")
+
+
+def _csv_rows(text: str, fieldnames: list[str]) -> list[list[str]]:
+    reader = csv.reader(io.StringIO(text, newline=''))
+    header = next(reader, [])
+    # columns may come in any order but all of them, each once
+    if len(header) != len(fieldnames) or set(header) != set(fieldnames):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad header")
+    order = [header.index(column) for column in fieldnames]
+    rows = []
+    for number, row in enumerate(reader, 1):
+        if not row:
+            continue
+        if len(row) != len(header):
+            raise _bad_row(number)
+        rows.append([row[position] for position in order])
+    return rows
+
+
+def _json_rows(items: list, fieldnames: list[str]) -> list[list[str]]:
+    rows = []
+    for number, item in enumerate(items, 1):
+        if not isinstance(item, dict) or any(key not in fieldnames for key in item):
+            raise _bad_row(number)
+        row = []
+        for column in fieldnames:
+            value = item.get(column)
+            if isinstance(value, (dict, list)):
+                raise _bad_row(number)
+            row.append('' if value is None else str(value))
+        rows.append(row)
+    return rows
+
+
+def parse_rows(content_type: str | None, body: bytes, fieldnames: list[str]) -> list[list[str]]:
+    """Rows of a CSV, JSON or NDJSON request body in the column order of ``fieldnames``.
+
+    A CSV body starts with its own header, JSON objects may leave out columns, those stay empty.
+    """
+    media_type = (content_type or '').partition(';')[0].strip().lower()
+    media_type = ALIASES.get(media_type, media_type)
+    if media_type not in (CSV, JSON, NDJSON):
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Unsupported media type")
+    if not fieldnames:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File has no header")
+    try:
+        text = body.decode('utf-8')
+        if media_type == CSV:
+            rows = _csv_rows(text, fieldnames)
+        elif media_type == JSON:
+            items = json.loads(text)
+            rows = _json_rows(items if isinstance(items, list) else [items], fieldnames)
+        else:
+            rows = _json_rows([json.loads(line) for line in text.splitlines() if line.strip()], fieldnames)
+    except (UnicodeDecodeError, ValueError, csv.Error):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad body")
+    if not rows:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No rows")
+    return rows
+
+
+def encode_records(rows: list[list[str]]) -> list[bytes]:
+    """One CSV record per row, as they are written to the file."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    records = []
+    for row in rows:
+        writer.writerow(row)
+        records.append(buffer.getvalue().encode('utf-8'))
+        buffer.seek(0)
+        buffer.truncate()
+    return records
+
+
+def append_rows(path: str, records: list[bytes]) -> int:
+    """Append ``records`` to the file at ``path``, returns the number of its data rows.
+
+    The schema, the row checkpoints and the value index are updated from the new rows alone, they are rebuilt
+    from the whole file only when they are missing or were already stale. The caller holds the file lock.
+    """
+    schema, stats, index = load_schema(path), load_stats(path), RowIndex.load(path)
+    value_index, value_columns = ValueIndex.load(path), indexed_columns(path)
+    with open(path, 'rb') as infile:
+        header = read_record(infile)
+        infile.seek(0, os.SEEK_END)
+        size = infile.tell()
+        infile.seek(max(size - 1, 0))
+        # the last record of the file may lack its line break
+        prefix = b'' if infile.read(1) in (b'', b'\n') else b'\n'
+
+    with open(path, 'ab') as outfile:
+        outfile.write(prefix + b''.join(records))
+
+    if value_index is not None:
+        value_index.append(csv.reader(io.StringIO(b''.join(records).decode('utf-8'), newline='')), value_index.rows)
+    elif value_columns:
+        build_value_index(path, value_columns)
+
+    if schema is None or stats is None or index is None:
+        build_metadata(path)
+        return load_schema(path)['rows']
+    update_schema(path, schema, stats, header.rstrip(b'\r\n') + b'\n', records)
+    return index.append([len(record) for record in records], size + len(prefix))
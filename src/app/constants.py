@@ -1,4 +1,4 @@
-import os, dotenv
+import json, os, dotenv
 from pathlib import Path
 
 dotenv.load_dotenv()
@@ -12,3 +12,56 @@ ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ['ACCESS_TOKEN_EXPIRE_MINUTES'])
 REDIS_URL = os.environ['REDIS_URL']
 BASE_DIR = Path(__file__).resolve().parent.parent
 PATH_FILES = os.path.join(BASE_DIR / 'app', 'files')
+# comma separated directories, on separate volumes, the users' directories are spread over
+STORAGE_ROOTS = [root for root in (os.environ.get('STORAGE_ROOTS') or '').split(',') if root] or [PATH_FILES]
+# points of every root on the consistent hash ring, more points spread the users more evenly
+STORAGE_VNODES = int(os.environ.get('STORAGE_VNODES') or 64)
+# seconds a rebalance waits for requests that started before a user's directory was moved
+REBALANCE_GRACE = float(os.environ.get('REBALANCE_GRACE') or 5)
+# keys of rate limits, jobs and other service data, everything else is a user
+INTERNAL_KEY_PREFIX = 'miniserver:'
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+PATH_PROFILES = os.environ.get('PATH_PROFILES') or os.path.join(BASE_DIR / 'app', 'profiles')
+PROFILES_MAX = int(os.environ.get('PROFILES_MAX') or 20)
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL') or 0.001)
+STREAM_CHUNK_ROWS = int(os.environ.get('STREAM_CHUNK_ROWS') or 10000)
+PRECOMPRESS_UPLOADS = os.environ.get('PRECOMPRESS_UPLOADS', 'false').lower() in ('1', 'true', 'yes')
+PRECOMPRESS_MIN_SIZE = int(os.environ.get('PRECOMPRESS_MIN_SIZE') or 1024)
+PRELOAD_HEAVY_MODULES = os.environ.get('PRELOAD_HEAVY_MODULES', 'false').lower() in ('1', 'true', 'yes')
+# token buckets per route class, `rate` requests per second with bursts of up to `burst` requests
+RATE_LIMITS = json.loads(os.environ.get('RATE_LIMITS') or 'null') or {
+    'client': {
+        'read': {'rate': 50, 'burst': 100},
+        'parse': {'rate': 10, 'burst': 30},
+        'sort': {'rate': 2, 'burst': 10},
+        'upload': {'rate': 2, 'burst': 10},
+        'jobs': {'rate': 1, 'burst': 10},
+    },
+    'admin': {
+        'read': {'rate': 200, 'burst': 400},
+        'parse': {'rate': 50, 'burst': 100},
+        'sort': {'rate': 10, 'burst': 30},
+        'upload': {'rate': 10, 'burst': 30},
+        'jobs': {'rate': 5, 'burst': 30},
+    },
+}
+# expensive operations running at once in one worker
+CONCURRENCY_LIMITS = json.loads(os.environ.get('CONCURRENCY_LIMITS') or 'null') or {
+    'parse': 4,
+    'sort': 2,
+    'upload': 4,
+}
+ADMISSION_TIMEOUT = float(os.environ.get('ADMISSION_TIMEOUT') or 0.5)
+PATH_JOBS = os.environ.get('PATH_JOBS') or os.path.join(BASE_DIR / 'app', 'jobs')
+# processes of the job worker, independent of the HTTP workers
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 2)
+# jobs and their results are kept this many seconds after the last update
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL') or 3600)
+JOB_CLEANUP_INTERVAL = int(os.environ.get('JOB_CLEANUP_INTERVAL') or 60)
+# appends to one file are serialized by a Redis lock, renewed while held and freed APPEND_LOCK_TIMEOUT seconds
+# after its holder died, a second appender waits APPEND_LOCK_WAIT seconds for it before getting 503
+APPEND_LOCK_TIMEOUT = float(os.environ.get('APPEND_LOCK_TIMEOUT') or 60)
+APPEND_LOCK_WAIT = float(os.environ.get('APPEND_LOCK_WAIT') or 5)
+# processes hashing the passwords of bulk imported users, users accepted by one POST /users/bulk
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS') or os.cpu_count() or 1)
+BULK_USERS_MAX = int(os.environ.get('BULK_USERS_MAX') or 1000)
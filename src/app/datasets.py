@@ -0,0 +1,380 @@
+import csv, io, json, os, random
+from fastapi import HTTPException, status
+
+from .constants import STREAM_CHUNK_ROWS
+from .formats import json_default
+from .rowindex import RowIndex, build_row_index
+from .storage import meta_path_of
+
+SCHEMA_FILE = 'schema.json'
+# what inference learned about every column, kept apart from the schema that every read loads
+STATS_FILE = 'stats.json'
+SCHEMA_CHUNK_ROWS = 100000
+# string columns with at most this many distinct values, and fewer than CATEGORY_MAX_RATIO of the rows, are categories
+CATEGORY_MAX_UNIQUE = 1000
+CATEGORY_MAX_RATIO = 0.5
+# values written as integers, without a fraction or an exponent
+INTEGER_PATTERN = r'^\s*[+-]?\d+\s*$'
+INT_DTYPES = ('int8', 'int16', 'int32', 'int64', 'uint64')
+# every integer up to this magnitude is exact in float32 (float64), the next one isn't
+FLOAT32_INT_MAX = 2 ** 24
+FLOAT64_INT_MAX = 2 ** 53
+# pandas parses these as True and False, pyarrow is given the same
+TRUE_VALUES = ['True', 'TRUE', 'true']
+FALSE_VALUES = ['False', 'FALSE', 'false']
+PREVIEW_ROWS = 3
+SAMPLE_MAX = 10000
+
+
+def read_header(path: str) -> list[str]:
+    # a byte order mark isn't part of the first column name, pandas skips it too
+    with open(path, encoding='utf-8-sig', newline='') as csv_file:
+        return next(csv.reader(csv_file), [])
+
+
+def select_columns(fieldnames: list[str], headers: str | None, sort_by: str | None) -> tuple[list[str], list[str]]:
+    """Validate ``headers`` and ``sort_by`` query params against the file's header row."""
+    columns = headers.split(',') if headers else fieldnames
+    if any(column not in fieldnames for column in columns):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad param headers")
+    by = sort_by.split(',') if sort_by else []
+    if any(column not in columns for column in by):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad param sort_by")
+    return columns, by
+
+
+class _ColumnStats:
+    """What one pass over a column learns about it, merged chunk by chunk."""
+    FIELDS = ('kind', 'rows', 'has_na', 'integral', 'float32_exact', 'minimum', 'maximum', 'values')
+
+    def __init__(self):
+        self.kind = None
+        self.rows = 0
+        self.has_na = False
+        self.integral = True
+        self.float32_exact = True
+        self.minimum = self.maximum = None
+        self.values = set()
+
+    def update(self, series) -> bool:
+        """Merge the chunk ``series``, True when only its text tells whether its numbers are integers."""
+        import numpy as np, pandas as pd
+
+        self.rows += len(series)
+        na = series.isna()
+        self.has_na = self.has_na or bool(na.any())
+        values = series[~na]
+        if values.empty:
+            return False
+
+        pending = False
+        # pandas keeps booleans next to missing values as objects
+        if pd.api.types.is_bool_dtype(values) or pd.api.types.infer_dtype(values) == 'boolean':
+            kind = 'bool'
+        elif pd.api.types.is_numeric_dtype(values):
+            kind = 'numeric'
+        else:
+            kind = 'string'
+        if self.kind is None:
+            self.kind = kind
+        elif self.kind != kind:
+            self.kind = 'mixed'
+
+        if kind == 'numeric':
+            minimum, maximum = values.min().item(), values.max().item()
+            self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+            self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+            if self.integral and not pd.api.types.is_integer_dtype(values):
+                # pandas parses integers as floats next to missing values, other floats were written as floats
+                self.integral = bool(na.any()) and bool((values % 1 == 0).all())
+                pending = self.integral
+            # checked on integer chunks too, a later float chunk or append may still turn the column into floats
+            if self.float32_exact and pd.api.types.is_integer_dtype(values):
+                self.float32_exact = max(-minimum, maximum) <= FLOAT32_INT_MAX
+            elif self.float32_exact:
+                self.float32_exact = bool((values.astype(np.float32).astype(values.dtype) == values).all())
+        elif kind == 'string':
+            if self.values is not None:
+                self.values.update(values.unique())
+                if len(self.values) > CATEGORY_MAX_UNIQUE:
+                    self.values = None
+        return pending
+
+    def to_dict(self) -> dict:
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        # sorted, a set's order depends on the order the values were added in
+        data['values'] = None if self.values is None else sorted(self.values, key=str)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> '_ColumnStats':
+        stats = cls()
+        for name in cls.FIELDS:
+            setattr(stats, name, data[name])
+        stats.values = None if data['values'] is None else set(data['values'])
+        return stats
+
+    def dtype(self) -> str:
+        import numpy as np
+
+        if self.kind == 'bool':
+            return 'boolean' if self.has_na else 'bool'
+        if self.kind == 'numeric' and self.integral:
+            # with missing values the integers were parsed through floats, exact only below FLOAT64_INT_MAX
+            if not self.has_na or max(-self.minimum, self.maximum) < FLOAT64_INT_MAX:
+                for name in INT_DTYPES:
+                    info = np.iinfo(name)
+                    if info.min <= self.minimum and self.maximum <= info.max:
+                        # nullable integers keep missing values without turning the column into floats
+                        return name.capitalize() if self.has_na else name
+            # floats would round them, their text is kept
+            return 'object'
+        if self.kind == 'numeric':
+            return 'float32' if self.float32_exact else 'float64'
+        if self.kind == 'string' and self.values is not None and len(self.values) <= CATEGORY_MAX_RATIO * self.rows:
+            return 'category'
+        return 'object'
+
+
+def _update_stats(stats: dict[str, _ColumnStats], source, chunk_rows: int = SCHEMA_CHUNK_ROWS) -> int:
+    """Merge the csv ``source`` (a path or a binary file object) into ``stats``, returns its number of rows."""
+    import pandas as pd
+
+    rows, pending = 0, set()
+    with pd.read_csv(source, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            rows += len(chunk)
+            for column, stat in stats.items():
+                if stat.update(chunk[column]):
+                    pending.add(column)
+
+    pending = [column for column in pending if stats[column].integral]
+    if pending:
+        # a second pass over the text of the integral looking float columns, "1.0" isn't the integer 1
+        if not isinstance(source, str):
+            source.seek(0)
+        with pd.read_csv(source, usecols=pending, dtype=str, chunksize=chunk_rows) as reader:
+            for chunk in reader:
+                for column in pending:
+                    if stats[column].integral and not chunk[column].dropna().str.match(INTEGER_PATTERN).all():
+                        stats[column].integral = False
+    return rows
+
+
+def _infer_stats(path: str, chunk_rows: int = SCHEMA_CHUNK_ROWS) -> tuple[int, dict[str, _ColumnStats]]:
+    stats = {column: _ColumnStats() for column in read_header(path)}
+    if not stats:
+        return 0, stats
+    return _update_stats(stats, path, chunk_rows), stats
+
+
+def _make_schema(stat_result: os.stat_result, rows: int, stats: dict[str, _ColumnStats]) -> dict:
+    return {
+        'size': stat_result.st_size,
+        'mtime_ns': stat_result.st_mtime_ns,
+        'rows': rows,
+        'columns': {column: stat.dtype() for column, stat in stats.items()},
+    }
+
+
+def infer_schema(path: str, chunk_rows: int = SCHEMA_CHUNK_ROWS) -> dict:
+    """Compact dtypes of every column, found in one chunked pass over the whole file.
+
+    Integers get the smallest type holding their range, floats become float32 only when that is lossless and
+    low-cardinality strings become categories. Every value reads back as it is written, integers no type holds
+    exactly stay text.
+    """
+    stat_result = os.stat(path)
+    rows, stats = _infer_stats(path, chunk_rows)
+    return _make_schema(stat_result, rows, stats)
+
+
+def _save_meta_json(path: str, name: str, data: dict):
+    path_to_meta = meta_path_of(path, name)
+    with open(path_to_meta + '.tmp', 'w', encoding='utf-8') as outfile:
+        json.dump(data, outfile)
+    os.replace(path_to_meta + '.tmp', path_to_meta)
+
+
+def _load_meta_json(path: str, name: str) -> dict | None:
+    try:
+        with open(meta_path_of(path, name), encoding='utf-8') as infile:
+            data = json.load(infile)
+        stat_result = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if (data.get('size'), data.get('mtime_ns')) != (stat_result.st_size, stat_result.st_mtime_ns):
+        return None
+    return data
+
+
+def save_schema(path: str, schema: dict, stats: dict[str, _ColumnStats]):
+    _save_meta_json(path, STATS_FILE, {
+        'size': schema['size'],
+        'mtime_ns': schema['mtime_ns'],
+        'columns': {column: stat.to_dict() for column, stat in stats.items()},
+    })
+    _save_meta_json(path, SCHEMA_FILE, schema)
+
+
+def build_schema(path: str) -> dict:
+    stat_result = os.stat(path)
+    rows, stats = _infer_stats(path)
+    schema = _make_schema(stat_result, rows, stats)
+    save_schema(path, schema, stats)
+    return schema
+
+
+def load_stats(path: str) -> dict[str, _ColumnStats] | None:
+    data = _load_meta_json(path, STATS_FILE)
+    if data:
+        return {column: _ColumnStats.from_dict(stat) for column, stat in data['columns'].items()}
+
+
+def update_schema(path: str, schema: dict, stats: dict[str, _ColumnStats], header: bytes, records: list[bytes]) -> dict:
+    """Merge appended ``records`` into the stats of the rest of the file, only the new rows are parsed."""
+    rows = _update_stats(stats, io.BytesIO(header + b''.join(records)))
+    schema = _make_schema(os.stat(path), schema['rows'] + rows, stats)
+    save_schema(path, schema, stats)
+    return schema
+
+
+def build_metadata(path: str):
+    """Derived data of an uploaded file: the schema and the row checkpoints."""
+    build_schema(path)
+    build_row_index(path)
+
+
+def load_schema(path: str) -> dict | None:
+    """Persisted schema of the file at ``path``, None when there is none or the file changed since."""
+    return _load_meta_json(path, SCHEMA_FILE)
+
+
+def read_options(schema: dict | None, columns: list[str]) -> dict:
+    """``pd.read_csv`` keyword arguments reading only ``columns`` with the dtypes of ``schema``."""
+    if not schema:
+        return {'usecols': columns}
+    dtype = {}
+    for column in columns:
+        column_dtype = schema['columns'].get(column, 'object')
+        dtype[column] = object if column_dtype == 'object' else column_dtype
+    return {'usecols': columns, 'dtype': dtype}
+
+
+def _arrow_type(dtype: str):
+    import pyarrow as pa
+
+    if dtype in ('object', 'category'):
+        return pa.string()
+    if dtype in ('bool', 'boolean'):
+        return pa.bool_()
+    if dtype.startswith('float'):
+        return pa.float64()
+    return pa.uint64() if dtype == 'uint64' else pa.int64()
+
+
+def read_frame(path: str, columns: list[str], schema: dict | None = None):
+    """Whole projected file with the dtypes of ``schema``, columns in the requested order.
+
+    With a schema the file is parsed by the multithreaded pyarrow reader. It is given the type of every column,
+    its own inference would turn text like "007" into numbers.
+    """
+    import pandas as pd
+
+    if not schema:
+        return pd.read_csv(path, **read_options(schema, columns))[columns]
+    import pyarrow.csv as pa_csv
+    from pandas._libs.parsers import STR_NA_VALUES
+
+    dtypes = {column: schema['columns'].get(column, 'object') for column in columns}
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=columns,
+        column_types={column: _arrow_type(dtype) for column, dtype in dtypes.items()},
+        # missing and boolean values as pandas reads them
+        null_values=list(STR_NA_VALUES), strings_can_be_null=True,
+        true_values=TRUE_VALUES, false_values=FALSE_VALUES,
+    )
+    df = pa_csv.read_csv(path, convert_options=convert_options).to_pandas()
+    return df.astype(read_options(schema, columns)['dtype'])[columns]
+
+
+def preview_frame(path: str, columns: list[str], schema: dict | None = None, nrows: int = PREVIEW_ROWS):
+    """First ``nrows`` rows, only the beginning of the file is parsed."""
+    import pandas as pd
+
+    return pd.read_csv(path, nrows=nrows, **read_options(schema, columns))[columns]
+
+
+def sample_frame(path: str, columns: list[str], schema: dict | None, n: int, seed: int):
+    """Uniform random sample of ``n`` rows in file order, reproducible with ``seed``.
+
+    Rows are picked through the row checkpoints, so the cost depends on ``n`` and not on the file size.
+    Without checkpoints (or with stale ones) the whole file is streamed through a reservoir, which draws other rows
+    for the same seed.
+    """
+    import pandas as pd
+
+    row_index = RowIndex.load(path)
+    if row_index is None:
+        return reservoir_sample(path, columns, schema, n, seed)
+
+    row_numbers = sorted(random.Random(seed).sample(range(row_index.rows), min(n, row_index.rows)))
+    header, records = row_index.read_rows(row_numbers)
+    content = io.BytesIO(header + (b'' if header.endswith(b'\n') else b'\n') + b''.join(records))
+    return pd.read_csv(content, **read_options(schema, columns))[columns]
+
+
+def reservoir_sample(path: str, columns: list[str], schema: dict | None, n: int, seed: int,
+                     chunk_rows: int = STREAM_CHUNK_ROWS):
+    """Uniform random sample of ``n`` rows in one chunked pass, memory stays bounded by ``n + chunk_rows``."""
+    import numpy as np, pandas as pd
+
+    rng = np.random.default_rng(seed)
+    sample, keys = None, np.empty(0)
+    with pd.read_csv(path, chunksize=chunk_rows, **read_options(schema, columns)) as reader:
+        for chunk in reader:
+            # the rows with the n smallest random keys are a uniform sample of the rows seen so far
+            sample = chunk if sample is None else pd.concat([sample, chunk])
+            keys = np.concatenate([keys, rng.random(len(chunk))])
+            if len(keys) > n:
+                keep = np.sort(np.argpartition(keys, n)[:n])
+                sample, keys = sample.iloc[keep], keys[keep]
+    if sample is None:
+        return preview_frame(path, columns, schema, 0)
+    return sample[columns]
+
+
+def iter_frames(path, columns: list[str], by: list[str], chunk_rows: int = STREAM_CHUNK_ROWS,
+                schema: dict | None = None):
+    """Yield the projected and sorted content of ``path`` in frames of at most ``chunk_rows`` rows.
+
+    ``path`` is a path or a binary file object. Without ``by`` the file is parsed chunk by chunk and memory
+    stays bounded by ``chunk_rows``; sorting needs the projected columns in memory once, the output is still sliced.
+    """
+    import pandas as pd
+
+    if by:
+        df = read_frame(path, columns, schema).sort_values(by=by)
+        for start in range(0, max(len(df), 1), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+        return
+
+    with pd.read_csv(path, chunksize=chunk_rows, **read_options(schema, columns)) as reader:
+        for chunk in reader:
+            yield chunk[columns]
+
+
+def stream_csv(frames):
+    header = True
+    for df in frames:
+        yield df.to_csv(index=False, header=header, encoding='utf-8')
+        header = False
+
+
+def stream_ndjson(frames):
+    import orjson
+
+    for df in frames:
+        rows = df.to_dict(orient='records')
+        if rows:
+            yield b'\n'.join(orjson.dumps(row, default=json_default, option=orjson.OPT_SERIALIZE_NUMPY) for row in rows) + b'\n'
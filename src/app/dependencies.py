@@ -1,26 +1,34 @@
 from datetime import timedelta, datetime, UTC
+from functools import cache
 from typing import Annotated
-import redis.asyncio as redis
 from redis.asyncio import Redis
-from fastapi import HTTPException, Depends, status
+from fastapi import HTTPException, Depends, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 
-from .constants import REDIS_URL, SECRET_KEY, ALGORITHM
+from .constants import REDIS_URL, SECRET_KEY, ALGORITHM, METRICS_ENABLED, CONCURRENCY_LIMITS
+from .limits import check_rate_limit, concurrency_slot
+from .metrics import BCRYPT_SECONDS, observe_redis_usage
 from .schemas.token import TokenData
-from .schemas.users import User, UserInDB
+from .schemas.users import User
 from .sql_app.crud import get_user
+from .sql_app.database import InstrumentedRedis
+from .storage import UserStorage, check_not_moving, resolve_root
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
 # Dependency
 async def get_db():
-    client = await redis.from_url(REDIS_URL)
+    if METRICS_ENABLED:
+        client = await InstrumentedRedis.from_url(REDIS_URL)
+    else:
+        client = await Redis.from_url(REDIS_URL)
     try:
         yield client
     finally:
+        if METRICS_ENABLED:
+            observe_redis_usage(client)
         await client.aclose()
 
 
@@ -57,15 +65,61 @@ async def get_current_active_user(
     return current_user
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def admission(route_class: str):
+    """Rate limits the user for ``route_class`` and, for classes in CONCURRENCY_LIMITS, holds a concurrency slot."""
+
+    async def admit(
+            current_user: Annotated[User, Depends(get_current_active_user)],
+            db: Annotated[Redis, Depends(get_db)],
+    ):
+        await check_rate_limit(db, current_user, route_class)
+        if route_class not in CONCURRENCY_LIMITS:
+            yield
+            return
+        async with concurrency_slot(route_class):
+            yield
+
+    return admit
+
+
+async def admit_read_uploadfile(
+        current_user: Annotated[User, Depends(get_current_active_user)],
+        db: Annotated[Redis, Depends(get_db)],
+        sort_by: str | None = None,
+):
+    route_class = 'sort' if sort_by else 'parse'
+    await check_rate_limit(db, current_user, route_class)
+    async with concurrency_slot(route_class):
+        yield
+
+
+async def get_user_storage(
+        current_user: Annotated[User, Depends(get_current_active_user)],
+        db: Annotated[Redis, Depends(get_db)],
+        request: Request,
+):
+    # reads go on from the old root while a rebalance moves the user's directory
+    if request.method not in ('GET', 'HEAD'):
+        await check_not_moving(db, current_user.username)
+    return UserStorage(current_user.username, await resolve_root(db, current_user.username))
+
+
+@cache
+def get_pwd_context():
+    # passlib and its bcrypt backend are loaded on the first password check, not at import
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    with BCRYPT_SECONDS.labels('verify').time():
+        return get_pwd_context().verify(plain_password, hashed_password)
 
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    with BCRYPT_SECONDS.labels('hash').time():
+        return get_pwd_context().hash(password)
 
 
 async def authenticate_user(db, username: str, password: str):
@@ -0,0 +1,147 @@
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse, Response
+
+CSV_TABLE = 'application/json'
+JSON_ROWS = 'application/json; shape=rows'
+JSON_COLUMNS = 'application/json; shape=columns'
+CSV = 'text/csv'
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+PARQUET = 'application/vnd.apache.parquet'
+MSGPACK = 'application/msgpack'
+NDJSON = 'application/x-ndjson'
+
+# aliases in common use that are answered with the canonical media type
+ALIASES = {
+    'application/x-parquet': PARQUET,
+    'application/x-msgpack': MSGPACK,
+    'application/vnd.msgpack': MSGPACK,
+    'application/jsonl': NDJSON,
+}
+
+
+def parse_accept(accept: str) -> list[tuple[str, str | None]]:
+    """Media ranges of an ``Accept`` header as ``(type, shape)`` ordered by preference."""
+    ranges = []
+    for position, item in enumerate(accept.split(',')):
+        media_type, *params = (part.strip() for part in item.split(';'))
+        if not media_type:
+            continue
+        quality, shape = 1.0, None
+        for param in params:
+            name, _, value = param.partition('=')
+            name, value = name.strip().lower(), value.strip().strip('"').lower()
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+            elif name == 'shape':
+                shape = value
+        if quality > 0:
+            media_type = media_type.lower()
+            ranges.append((-quality, position, ALIASES.get(media_type, media_type), shape))
+    return [(media_type, shape) for _, _, media_type, shape in sorted(ranges)]
+
+
+def negotiate(accept: str | None, offers: tuple[str, ...]) -> str:
+    """Pick the offer preferred by ``accept``, the first offer is the default for ``*/*`` and no header."""
+    if not accept:
+        return offers[0]
+    parsed_offers = []
+    for offer in offers:
+        media_type, _, shape = offer.partition('; shape=')
+        parsed_offers.append((offer, media_type, shape or None))
+
+    for media_range, shape in parse_accept(accept):
+        range_type, _, range_subtype = media_range.partition('/')
+        for offer, media_type, offer_shape in parsed_offers:
+            offer_type, _, offer_subtype = media_type.partition('/')
+            if range_type not in ('*', offer_type) or range_subtype not in ('*', offer_subtype):
+                continue
+            if shape is None or shape == offer_shape:
+                return offer
+    raise HTTPException(
+        status_code=status.HTTP_406_NOT_ACCEPTABLE,
+        detail='Supported media types: ' + ', '.join(offers),
+    )
+
+
+def json_default(value):
+    import pandas as pd
+
+    # missing values of nullable columns and NaT are null, like NaN
+    if value is pd.NA or value is pd.NaT:
+        return None
+    return str(value)
+
+
+def render_csv_table(df) -> Response:
+    return JSONResponse({'csv_table': df.to_csv(index=False, encoding='utf-8')})
+
+
+def render_json_rows(df) -> Response:
+    import orjson
+
+    content = orjson.dumps(df.to_dict(orient='records'), default=json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return Response(content, media_type=JSON_ROWS)
+
+
+def render_json_columns(df) -> Response:
+    import orjson
+
+    content = orjson.dumps(df.to_dict(orient='list'), default=json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return Response(content, media_type=JSON_COLUMNS)
+
+
+def render_csv(df) -> Response:
+    return Response(df.to_csv(index=False, encoding='utf-8'), media_type=CSV)
+
+
+def to_arrow(df):
+    import pyarrow as pa
+
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def render_arrow_stream(df) -> Response:
+    import pyarrow as pa
+
+    table = to_arrow(df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(sink.getvalue().to_pybytes(), media_type=ARROW_STREAM)
+
+
+def render_parquet(df) -> Response:
+    import pyarrow as pa, pyarrow.parquet as pq
+
+    sink = pa.BufferOutputStream()
+    pq.write_table(to_arrow(df), sink)
+    return Response(sink.getvalue().to_pybytes(), media_type=PARQUET)
+
+
+def render_msgpack(df) -> Response:
+    import msgpack
+
+    content = msgpack.packb(df.to_dict(orient='list'), default=json_default)
+    return Response(content, media_type=MSGPACK)
+
+
+RENDERERS = {
+    CSV_TABLE: render_csv_table,
+    JSON_ROWS: render_json_rows,
+    JSON_COLUMNS: render_json_columns,
+    CSV: render_csv,
+    ARROW_STREAM: render_arrow_stream,
+    PARQUET: render_parquet,
+    MSGPACK: render_msgpack,
+}
+TABLE_MEDIA_TYPES = tuple(RENDERERS)
+STREAM_MEDIA_TYPES = (CSV, NDJSON)
+
+
+def render(media_type: str, df) -> Response:
+    response = RENDERERS[media_type](df)
+    response.headers['Vary'] = 'Accept'
+    return response
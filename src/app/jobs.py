@@ -0,0 +1,294 @@
+import hashlib, json, os, time, uuid
+from itertools import chain
+from redis.asyncio import Redis
+
+from .constants import PATH_JOBS, JOB_RESULT_TTL, REDIS_URL
+from .datasets import read_header, select_columns, iter_frames, stream_csv, stream_ndjson, load_schema
+from .formats import CSV, NDJSON, PARQUET, ARROW_STREAM
+from .metrics import observe_cache
+from .schemas.jobs import Job, JobIn
+from .sql_app.crud import INTERNAL_KEY_PREFIX
+from .storage import PLACEMENT_KEY, UserStorage, find_user_root, get_ring
+
+JOB_QUEUE = INTERNAL_KEY_PREFIX + 'jobs:queue'
+ACTIVE_STATUSES = ('queued', 'running')
+# media type and extension of the result file of every format
+RESULT_FORMATS = {
+    'csv': (CSV, '.csv'),
+    'ndjson': (NDJSON, '.ndjson'),
+    'parquet': (PARQUET, '.parquet'),
+    'arrow': (ARROW_STREAM, '.arrows'),
+}
+
+# sets the fields of the job only while its status is one of ARGV[1] (comma separated), so a worker
+# never overwrites a cancellation and a cancellation never overwrites a finished job
+TRANSITION_LUA = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if not status then
+    return 0
+end
+local allowed = false
+for expected in string.gmatch(ARGV[1], '[^,]+') do
+    if expected == status then
+        allowed = true
+    end
+end
+if not allowed then
+    return 0
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# points the dedup key KEYS[1] at the new job ARGV[1] unless it holds a job that is still usable (queued, running
+# or done), returns the job id the key holds afterwards. ARGV[3] is the prefix of the job keys
+CLAIM_LUA = """
+local existing = redis.call('GET', KEYS[1])
+if existing then
+    local status = redis.call('HGET', ARGV[3] .. existing, 'status')
+    if status and status ~= 'failed' and status ~= 'cancelled' then
+        return existing
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return ARGV[1]
+"""
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_key(job_id: str) -> str:
+    return f'{INTERNAL_KEY_PREFIX}job:{job_id}'
+
+
+def dedup_key(fingerprint: str) -> str:
+    return f'{INTERNAL_KEY_PREFIX}jobs:dedup:{fingerprint}'
+
+
+def result_path(job: Job) -> str:
+    return os.path.join(PATH_JOBS, job.id + RESULT_FORMATS[job.format][1])
+
+
+def job_fingerprint(username: str, spec: JobIn, stat_result: os.stat_result) -> str:
+    """Identity of the file content (size and mtime) and of the operation on it."""
+    identity = [username, spec.filename, stat_result.st_size, stat_result.st_mtime_ns,
+                spec.headers, spec.sort_by, spec.format]
+    return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+
+def _transition_args(statuses: tuple[str, ...], fields: dict) -> list:
+    fields = {**fields, 'updated': time.time()}
+    return [','.join(statuses), JOB_RESULT_TTL, *chain.from_iterable(fields.items())]
+
+
+async def get_job(db: Redis, job_id: str) -> Job | None:
+    data = await db.hgetall(job_key(job_id))
+    if data:
+        return Job(**data)
+
+
+async def submit_job(db: Redis, username: str, spec: JobIn, stat_result: os.stat_result) -> tuple[Job, bool]:
+    """Queue the operation or return the job already made for the same file and operation.
+
+    Returns the job and whether it was deduplicated.
+    """
+    fingerprint = job_fingerprint(username, spec, stat_result)
+    claim = db.register_script(CLAIM_LUA)
+    while True:
+        now = time.time()
+        job = Job(**spec.model_dump(), id=uuid.uuid4().hex, username=username, status='queued',
+                  created=now, updated=now)
+        fields = {key: value for key, value in job.model_dump().items() if value is not None}
+        # the job exists before it is claimed, so a concurrent submit never takes a claim for a missing job over
+        async with db.pipeline(transaction=True) as pipe:
+            pipe.hset(job_key(job.id), mapping={**fields, 'fingerprint': fingerprint})
+            pipe.expire(job_key(job.id), JOB_RESULT_TTL)
+            await pipe.execute()
+        claimed_id = await claim(keys=[dedup_key(fingerprint)], args=[job.id, JOB_RESULT_TTL, job_key('')])
+        if claimed_id == job.id:
+            await db.rpush(JOB_QUEUE, job.id)
+            observe_cache('jobs', False)
+            return job, False
+
+        await db.delete(job_key(job.id))
+        existing = await get_job(db, claimed_id)
+        if existing:
+            observe_cache('jobs', True)
+            return existing, True
+        # removed since it was claimed, claim again
+
+
+async def cancel_job(db: Redis, job: Job) -> bool:
+    """Cancel a queued or running job, the worker stops it at the next chunk."""
+    transition = db.register_script(TRANSITION_LUA)
+    cancelled = await transition(keys=[job_key(job.id)], args=_transition_args(ACTIVE_STATUSES, {'status': 'cancelled'}))
+    if cancelled:
+        fingerprint = await db.hget(job_key(job.id), 'fingerprint')
+        await db.delete(dedup_key(fingerprint))
+    return bool(cancelled)
+
+
+async def fail_job(db: Redis, job_id: str, error: str) -> bool:
+    """Fail a queued or running job whose worker process crashed, so the operation can be submitted again."""
+    transition = db.register_script(TRANSITION_LUA)
+    failed = await transition(keys=[job_key(job_id)],
+                              args=_transition_args(ACTIVE_STATUSES, {'status': 'failed', 'error': error}))
+    if failed:
+        fingerprint = await db.hget(job_key(job_id), 'fingerprint')
+        await db.delete(dedup_key(fingerprint))
+    return bool(failed)
+
+
+async def remove_job(db: Redis, job: Job):
+    fingerprint = await db.hget(job_key(job.id), 'fingerprint')
+    await db.delete(job_key(job.id), dedup_key(fingerprint))
+    try:
+        os.remove(result_path(job))
+    except FileNotFoundError:
+        pass
+
+
+async def remove_expired_results(db: Redis):
+    """Remove result files of jobs whose keys expired."""
+    if not os.path.isdir(PATH_JOBS):
+        return
+    for name in os.listdir(PATH_JOBS):
+        job_id = name.partition('.')[0]
+        if not await db.exists(job_key(job_id)):
+            try:
+                os.remove(os.path.join(PATH_JOBS, name))
+            except FileNotFoundError:
+                pass
+
+
+def _write_csv(frames, path: str):
+    with open(path, 'w', encoding='utf-8', newline='') as outfile:
+        for chunk in stream_csv(frames):
+            outfile.write(chunk)
+
+
+def _write_ndjson(frames, path: str):
+    with open(path, 'wb') as outfile:
+        for chunk in stream_ndjson(frames):
+            outfile.write(chunk)
+
+
+def _write_arrow_tables(frames, columns: list[str], new_writer):
+    import pyarrow as pa
+
+    writer = schema = None
+    try:
+        for df in frames:
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                writer = new_writer(schema)
+            writer.write_table(table)
+        if writer is None:
+            writer = new_writer(pa.schema([(column, pa.string()) for column in columns]))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _write_parquet(frames, path: str, columns: list[str]):
+    import pyarrow.parquet as pq
+
+    _write_arrow_tables(frames, columns, lambda schema: pq.ParquetWriter(path, schema))
+
+
+def _write_arrow(frames, path: str, columns: list[str]):
+    import pyarrow as pa
+
+    _write_arrow_tables(frames, columns, lambda schema: pa.ipc.new_stream(path, schema))
+
+
+def write_result(job: Job, path: str, on_progress) -> int:
+    """Write the result of ``job`` for the file at ``path``, returns the number of rows.
+
+    ``on_progress(rows, progress)`` is called after every chunk.
+    """
+    columns, by = select_columns(read_header(path), job.headers, job.sort_by)
+    schema = load_schema(path)
+    size = os.path.getsize(path) or 1
+    rows = 0
+
+    def frames(infile):
+        nonlocal rows
+        for df in iter_frames(infile, columns, by, schema=schema):
+            yield df
+            rows += len(df)
+            on_progress(rows, min(infile.tell() / size, 1.0))
+
+    os.makedirs(PATH_JOBS, exist_ok=True)
+    target = result_path(job)
+    with open(path, 'rb') as infile:
+        if job.format == 'csv':
+            _write_csv(frames(infile), target + '.tmp')
+        elif job.format == 'ndjson':
+            _write_ndjson(frames(infile), target + '.tmp')
+        elif job.format == 'parquet':
+            _write_parquet(frames(infile), target + '.tmp', columns)
+        else:
+            _write_arrow(frames(infile), target + '.tmp', columns)
+    os.replace(target + '.tmp', target)
+    return rows
+
+
+_sync_db = None
+
+
+def run_job(job_id: str) -> str:
+    """Run a queued job in a worker process, returns its final status."""
+    global _sync_db
+    if _sync_db is None:
+        from redis import Redis as SyncRedis
+
+        _sync_db = SyncRedis.from_url(REDIS_URL)
+    db = _sync_db
+    transition = db.register_script(TRANSITION_LUA)
+
+    def update(statuses: tuple[str, ...], **fields) -> bool:
+        return bool(transition(keys=[job_key(job_id)], args=_transition_args(statuses, fields)))
+
+    if not update(('queued',), status='running'):
+        # cancelled or expired while queued
+        return 'skipped'
+    data = db.hgetall(job_key(job_id))
+    job = Job(**data)
+    # resolved now rather than at submit, a rebalance may have moved the user's directory since
+    root = db.hget(PLACEMENT_KEY, job.username) or find_user_root(job.username) or get_ring().root_for(job.username)
+
+    def on_progress(rows: int, progress: float):
+        if not update(('running',), rows=rows, progress=progress):
+            raise JobCancelled
+
+    try:
+        rows = write_result(job, UserStorage(job.username, root).path(job.filename), on_progress)
+    except JobCancelled:
+        _remove_partial(job)
+        return 'cancelled'
+    except Exception as exp:
+        _remove_partial(job)
+        update(('running',), status='failed', error=str(exp) or type(exp).__name__)
+        db.delete(dedup_key(data['fingerprint']))
+        return 'failed'
+
+    if not update(('running',), status='done', rows=rows, progress=1.0):
+        _remove_partial(job)
+        return 'cancelled'
+    db.expire(dedup_key(data['fingerprint']), JOB_RESULT_TTL)
+    return 'done'
+
+
+def _remove_partial(job: Job):
+    for path in (result_path(job), result_path(job) + '.tmp'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,78 @@
+import asyncio, math
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, status
+from redis.asyncio import Redis
+
+from .constants import RATE_LIMITS, CONCURRENCY_LIMITS, ADMISSION_TIMEOUT
+from .schemas.users import User, RateLimit
+from .sql_app.crud import INTERNAL_KEY_PREFIX
+
+# refills the bucket for the time passed since the last call and takes one token if there is one,
+# returns {allowed, seconds until a token is available}
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+_token_bucket_script = None
+_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+def get_rate_limit(user: User, route_class: str) -> RateLimit:
+    """Limit of the user record if it has one, otherwise the default of the user's role."""
+    if user.rate_limits and route_class in user.rate_limits:
+        return user.rate_limits[route_class]
+    return RateLimit(**RATE_LIMITS['admin' if user.admin else 'client'][route_class])
+
+
+async def check_rate_limit(db: Redis, user: User, route_class: str):
+    global _token_bucket_script
+    if _token_bucket_script is None:
+        _token_bucket_script = db.register_script(TOKEN_BUCKET_LUA)
+
+    limit = get_rate_limit(user, route_class)
+    key = f'{INTERNAL_KEY_PREFIX}ratelimit:{user.username}:{route_class}'
+    allowed, retry_after = await _token_bucket_script(keys=[key], args=[limit.rate, limit.burst], client=db)
+    if not int(allowed):
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail='Too many requests',
+            headers={'Retry-After': str(max(1, math.ceil(float(retry_after))))},
+        )
+
+
+@asynccontextmanager
+async def concurrency_slot(route_class: str):
+    """Hold one of the worker's slots for an expensive operation or answer 503 when none frees up in time."""
+    semaphore = _semaphores.get(route_class)
+    if semaphore is None:
+        semaphore = _semaphores[route_class] = asyncio.Semaphore(CONCURRENCY_LIMITS[route_class])
+    try:
+        await asyncio.wait_for(semaphore.acquire(), ADMISSION_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Server is busy',
+            headers={'Retry-After': '1'},
+        )
+    try:
+        yield
+    finally:
+        semaphore.release()
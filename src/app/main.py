@@ -1,11 +1,26 @@
 from fastapi import FastAPI
 
-from .routers import users, uploadfiles, token
+from .constants import METRICS_ENABLED, PRELOAD_HEAVY_MODULES
+from .metrics import MetricsMiddleware
+from .profiling import ProfilingMiddleware
+from .routers import users, uploadfiles, token, metrics, profiles, jobs
 
 app = FastAPI()
 app.include_router(token.router)
 app.include_router(users.router)
 app.include_router(uploadfiles.router)
+app.include_router(jobs.router)
+app.include_router(metrics.router)
+app.include_router(profiles.router)
+
+app.add_middleware(ProfilingMiddleware)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+if PRELOAD_HEAVY_MODULES:
+    from .warmup import preload
+
+    app.add_event_handler('startup', preload)
 
 # if __name__ == "__main__":
 #     import uvicorn
@@ -0,0 +1,98 @@
+import os, time
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, multiprocess
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route template',
+    ['method', 'route', 'status'],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    'http_requests_in_progress', 'HTTP requests currently being served',
+    ['method'], multiprocess_mode='livesum',
+)
+UPLOAD_BYTES = Counter('upload_bytes', 'Bytes received through file uploads')
+CSV_PARSE_SECONDS = Histogram('csv_parse_seconds', 'Time spent parsing uploaded CSV files')
+CSV_SORT_SECONDS = Histogram('csv_sort_seconds', 'Time spent sorting parsed CSV files')
+REDIS_COMMAND_SECONDS = Histogram(
+    'redis_command_seconds', 'Redis round trip latency by command',
+    ['command'], buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1.0),
+)
+REDIS_ROUND_TRIPS_PER_REQUEST = Histogram(
+    'redis_round_trips_per_request', 'Redis round trips made while serving one request',
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+REDIS_SECONDS_PER_REQUEST = Histogram('redis_seconds_per_request', 'Redis time spent while serving one request')
+BCRYPT_SECONDS = Histogram(
+    'bcrypt_seconds', 'Time spent hashing and verifying passwords',
+    ['operation'], buckets=(.01, .025, .05, .1, .25, .5, 1.0, 2.5),
+)
+CACHE_REQUESTS = Counter('cache_requests', 'Cache lookups by cache and result (hit or miss)', ['cache', 'result'])
+
+
+def get_registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render_latest() -> bytes:
+    return generate_latest(get_registry())
+
+
+def observe_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def observe_redis_usage(client):
+    REDIS_ROUND_TRIPS_PER_REQUEST.observe(getattr(client, 'round_trips', 0))
+    REDIS_SECONDS_PER_REQUEST.observe(getattr(client, 'redis_seconds', 0.0))
+
+
+class RedisMetricsMixin:
+    """Counts round trips and time for every command sent through ``execute_command``."""
+    round_trips = 0
+    redis_seconds = 0.0
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.round_trips += 1
+            self.redis_seconds += elapsed
+            REDIS_COMMAND_SECONDS.labels(str(args[0]).upper()).observe(elapsed)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording per-route latency and in-flight requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        method = scope['method']
+        in_progress = REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            REQUEST_LATENCY.labels(method, route.path if route else 'unmatched', str(status_code)).observe(
+                time.perf_counter() - start
+            )
+            in_progress.dec()
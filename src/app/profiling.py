@@ -0,0 +1,166 @@
+import json, os, re, time, uuid
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from .constants import PATH_PROFILES, PROFILES_MAX, PROFILE_INTERVAL
+from .dependencies import get_db, get_current_user
+
+PROFILE_HEADER = b'x-profile'
+PROFILE_FORMATS = {'html': '.html', 'speedscope': '.speedscope.json'}
+PROFILE_ID_PATTERN = re.compile(r'^\d+-[0-9a-f]{8}$')
+
+
+def new_profile_id() -> str:
+    return f'{time.time_ns() // 1000}-{uuid.uuid4().hex[:8]}'
+
+
+class ProfileStore:
+    """Ring buffer of profiles on disk, keeps at most ``limit`` of the latest ones."""
+
+    def __init__(self, directory: str = PATH_PROFILES, limit: int = PROFILES_MAX):
+        self.directory = directory
+        self.limit = limit
+
+    def _meta_path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, profile_id + '.meta.json')
+
+    def save(self, content: str, meta: dict) -> dict:
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = meta['id']
+        meta = {**meta, 'filename': profile_id + PROFILE_FORMATS[meta['format']]}
+        with open(os.path.join(self.directory, meta['filename']), 'w', encoding='utf-8') as outfile:
+            outfile.write(content)
+        with open(self._meta_path(profile_id), 'w', encoding='utf-8') as outfile:
+            json.dump(meta, outfile)
+
+        for stale in self.list()[self.limit:]:
+            self.remove(stale)
+        return meta
+
+    def list(self) -> list[dict]:
+        """Profiles metadata, the newest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.meta.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as infile:
+                    profiles.append(json.load(infile))
+            except (OSError, ValueError):
+                continue
+        return sorted(profiles, key=lambda meta: meta['id'], reverse=True)
+
+    def get(self, profile_id: str) -> dict | None:
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        try:
+            with open(self._meta_path(profile_id), encoding='utf-8') as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return None
+
+    def path(self, meta: dict) -> str:
+        return os.path.join(self.directory, meta['filename'])
+
+    def remove(self, meta: dict):
+        for path in (self.path(meta), self._meta_path(meta['id'])):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+profile_store = ProfileStore()
+
+
+async def run_blocking(request: Request, func, *args, **kwargs):
+    """Run ``func`` in the threadpool, or inline when ``request`` is profiled.
+
+    The profiler samples only the thread it was started in, work in the threadpool would show up as one await.
+    """
+    if getattr(request.state, 'profiled', False):
+        return func(*args, **kwargs)
+    return await run_in_threadpool(func, *args, **kwargs)
+
+
+async def get_admin_from_headers(headers: list[tuple[bytes, bytes]]):
+    authorization = dict(headers).get(b'authorization', b'').decode('latin-1')
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+
+    db_gen = get_db()
+    db = await anext(db_gen)
+    try:
+        user = await get_current_user(token, db)
+    except HTTPException:
+        return None
+    finally:
+        await db_gen.aclose()
+    return user if user.admin and not user.disabled else None
+
+
+class ProfilingMiddleware:
+    """Runs a request under a sampling profiler when an admin sends the ``X-Profile`` header.
+
+    The header value selects the output format (``html`` or ``speedscope``). Requests without
+    the header go straight to the app.
+    """
+
+    def __init__(self, app, store: ProfileStore = profile_store):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        for name, value in scope['headers']:
+            if name == PROFILE_HEADER:
+                break
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        profile_format = value.decode('latin-1').strip().lower()
+        if profile_format not in PROFILE_FORMATS:
+            profile_format = 'html'
+        if await get_admin_from_headers(scope['headers']) is None:
+            await self.app(scope, receive, send)
+            return
+
+        from pyinstrument import Profiler
+        from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+
+        profile_id = new_profile_id()
+        status_code = 500
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode='enabled')
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                message['headers'] = [*message.get('headers', []), (b'x-profile-id', profile_id.encode())]
+            await send(message)
+
+        scope.setdefault('state', {})['profiled'] = True
+        start = time.perf_counter()
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.stop()
+            renderer = SpeedscopeRenderer() if profile_format == 'speedscope' else HTMLRenderer()
+            meta = {
+                'id': profile_id,
+                'format': profile_format,
+                'method': scope['method'],
+                'path': scope['path'],
+                'query_string': scope['query_string'].decode('latin-1'),
+                'status': status_code,
+                'duration': round(time.perf_counter() - start, 6),
+                'created': time.time(),
+            }
+            await run_in_threadpool(self.store.save, profiler.output(renderer), meta)
@@ -0,0 +1,111 @@
+import asyncio, csv, io, json, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache
+from fastapi import HTTPException, status
+from pydantic import ValidationError
+from redis.asyncio import Redis
+
+from .constants import HASH_WORKERS, BULK_USERS_MAX
+from .dependencies import get_password_hash
+from .formats import CSV
+from .schemas.users import UserInCreate, UserInDB
+from .sql_app.crud import INTERNAL_KEY_PREFIX, create_users
+from .storage import is_valid_filename
+
+JSON = 'application/json'
+CSV_COLUMNS = ('username', 'password', 'email', 'full_name')
+
+
+@cache
+def get_hash_pool() -> ProcessPoolExecutor:
+    # spawned rather than forked, the server process has running threads and open connections
+    return ProcessPoolExecutor(HASH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+async def hash_passwords(passwords: list[str]) -> list[str]:
+    """Hash ``passwords`` with bcrypt in parallel across the processes of the hash pool."""
+    loop = asyncio.get_running_loop()
+    pool = get_hash_pool()
+    return await asyncio.gather(*(loop.run_in_executor(pool, get_password_hash, password) for password in passwords))
+
+
+def parse_users(media_type: str | None, body: bytes, max_users: int | None = BULK_USERS_MAX) -> list:
+    """Users of a CSV body (a header of CSV_COLUMNS, username and password required) or a JSON list of objects."""
+    media_type = (media_type or '').partition(';')[0].strip().lower()
+    if media_type not in (CSV, JSON):
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Unsupported media type")
+    try:
+        text = body.decode('utf-8')
+        if media_type == CSV:
+            reader = csv.DictReader(io.StringIO(text, newline=''))
+            fieldnames = reader.fieldnames or []
+            if not {'username', 'password'} <= set(fieldnames) <= set(CSV_COLUMNS):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad header")
+            items = []
+            for number, row in enumerate(reader, 1):
+                # DictReader keeps extra cells under None, a row with them doesn't match the header
+                if None in row:
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Bad row {number}")
+                # empty cells are missing values
+                items.append({key: value for key, value in row.items() if value})
+        else:
+            items = json.loads(text)
+    except (UnicodeDecodeError, ValueError, csv.Error):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad body")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad body")
+    if max_users is not None and len(items) > max_users:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Too many users")
+    return items
+
+
+def is_valid_username(username: str) -> bool:
+    # the username names the user's directory and key, 'me' is the current user in the routes
+    return is_valid_filename(username) and username != 'me' and not username.startswith(INTERNAL_KEY_PREFIX)
+
+
+def _describe(exp: ValidationError) -> str:
+    return '; '.join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in exp.errors())
+
+
+async def provision_users(db: Redis, items: list, admin: bool = False) -> list[dict]:
+    """Create the users of ``items`` that don't exist yet, returns the result of every item in order.
+
+    Existing users are left as they are, so the same import can run again. Only the passwords of new users
+    are hashed, in parallel, then all their directories and keys are written at once.
+    """
+    results: list[dict | None] = [None] * len(items)
+    accepted = {}
+    for position, item in enumerate(items):
+        username = item.get('username') if isinstance(item, dict) else None
+        try:
+            user = UserInCreate.model_validate(item)
+        except ValidationError as exp:
+            results[position] = {'username': username, 'status': 'invalid', 'detail': _describe(exp)}
+            continue
+        if not is_valid_username(user.username):
+            results[position] = {'username': username, 'status': 'invalid', 'detail': 'Bad username'}
+        elif user.username in accepted:
+            results[position] = {'username': username, 'status': 'invalid', 'detail': 'Duplicate username'}
+        else:
+            accepted[user.username] = (position, user)
+
+    new = {}
+    stored = await db.mget(list(accepted)) if accepted else []
+    for (username, (position, user)), value in zip(accepted.items(), stored):
+        if value is None:
+            new[username] = (position, user)
+        else:
+            results[position] = {'username': username, 'status': 'exists'}
+
+    hashed_passwords = await hash_passwords([user.password for _, user in new.values()])
+    values = {}
+    for (username, (_, user)), hashed_password in zip(new.items(), hashed_passwords):
+        user_dict = user.model_dump(exclude={'password'})
+        values[username] = UserInDB(**user_dict, hashed_password=hashed_password, admin=admin or None).model_dump_json()
+
+    created = await create_users(db, values) if values else {}
+    for username, (position, _) in new.items():
+        # taken by a concurrent request since the check
+        results[position] = {'username': username, 'status': 'created' if created[username] else 'exists'}
+    return results
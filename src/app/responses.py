@@ -0,0 +1,185 @@
+import os, uuid
+from email.utils import formatdate
+from anyio import open_file
+from fastapi import HTTPException, status
+from starlette.responses import Response
+
+RANGE_CHUNK_SIZE = 256 * 1024
+# more ranges than this, once merged, are ignored and the whole file is sent, so parts can't amplify a response
+RANGE_MAX_PARTS = 16
+
+
+def make_etag(stat_result: os.stat_result, variant: str = '') -> str:
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}{variant}"'
+
+
+def etag_matches(header: str | None, etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    # weak comparison, W/ prefixes are ignored
+    return etag in (tag.strip().removeprefix('W/') for tag in header.split(','))
+
+
+def accepts_encoding(accept_encoding: str | None, encoding: str) -> bool:
+    for item in (accept_encoding or '').split(','):
+        coding, *params = (part.strip() for part in item.split(';'))
+        if coding.lower() not in (encoding, '*'):
+            continue
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def parse_range(header: str, size: int) -> list[tuple[int, int]] | None:
+    """Byte ranges of a ``Range`` header as inclusive ``(start, end)`` pairs, sorted with overlaps merged.
+
+    Returns None when more than RANGE_MAX_PARTS ranges remain, the whole file is sent then.
+    Raises 416 when the header is malformed or none of the ranges overlaps the file.
+    """
+    unit, _, ranges_spec = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        raise range_not_satisfiable(size)
+
+    ranges = []
+    for spec in ranges_spec.split(','):
+        start, sep, end = spec.strip().partition('-')
+        try:
+            if not sep:
+                raise ValueError
+            if not start:
+                suffix = int(end)
+                if suffix <= 0:
+                    continue
+                ranges.append((max(size - suffix, 0), size - 1))
+                continue
+            start = int(start)
+            end = int(end) if end else size - 1
+        except ValueError:
+            raise range_not_satisfiable(size)
+        if start > end:
+            raise range_not_satisfiable(size)
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+
+    if not ranges:
+        raise range_not_satisfiable(size)
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged if len(merged) <= RANGE_MAX_PARTS else None
+
+
+def range_not_satisfiable(size: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+        detail='Range not satisfiable',
+        headers={'Content-Range': f'bytes */{size}'},
+    )
+
+
+class RangeFileResponse(Response):
+    """Serves a whole file or byte ranges of it.
+
+    Uses the ASGI ``http.response.zerocopysend`` extension (sendfile) when the server offers it and
+    falls back to reading the file in chunks otherwise. Several ranges are sent as multipart/byteranges.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            stat_result: os.stat_result,
+            media_type: str,
+            ranges: list[tuple[int, int]] | None = None,
+            headers: dict | None = None,
+            send_body: bool = True,
+    ):
+        self.path = path
+        self.size = stat_result.st_size
+        self.ranges = ranges
+        self.send_body = send_body
+        self.status_code = status.HTTP_206_PARTIAL_CONTENT if ranges else status.HTTP_200_OK
+        self.media_type = media_type
+        self.background = None
+        self.parts = []
+
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Last-Modified': formatdate(stat_result.st_mtime, usegmt=True),
+            **(headers or {}),
+        }
+        if not ranges:
+            headers['Content-Type'] = media_type
+            headers['Content-Length'] = str(self.size)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            headers['Content-Type'] = media_type
+            headers['Content-Range'] = f'bytes {start}-{end}/{self.size}'
+            headers['Content-Length'] = str(end - start + 1)
+        else:
+            boundary = uuid.uuid4().hex
+            length = 0
+            for start, end in ranges:
+                part_header = (
+                    f'--{boundary}\r\nContent-Type: {media_type}\r\n'
+                    f'Content-Range: bytes {start}-{end}/{self.size}\r\n\r\n'
+                ).encode('latin-1')
+                self.parts.append((part_header, start, end))
+                length += len(part_header) + end - start + 1 + 2
+            self.closing = f'--{boundary}--\r\n'.encode('latin-1')
+            headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+            headers['Content-Length'] = str(length + len(self.closing))
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if not self.send_body:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        zerocopy = 'http.response.zerocopysend' in scope.get('extensions', {})
+        async with await open_file(self.path, mode='rb') as file:
+            if not self.ranges:
+                await self._send_range(send, file, 0, self.size - 1, zerocopy, more_body=False)
+            elif not self.parts:
+                start, end = self.ranges[0]
+                await self._send_range(send, file, start, end, zerocopy, more_body=False)
+            else:
+                for part_header, start, end in self.parts:
+                    await send({'type': 'http.response.body', 'body': part_header, 'more_body': True})
+                    await self._send_range(send, file, start, end, zerocopy, more_body=True)
+                    await send({'type': 'http.response.body', 'body': b'\r\n', 'more_body': True})
+                await send({'type': 'http.response.body', 'body': self.closing})
+
+    @staticmethod
+    async def _send_range(send, file, start: int, end: int, zerocopy: bool, more_body: bool):
+        count = end - start + 1
+        if zerocopy:
+            await send({
+                'type': 'http.response.zerocopysend',
+                'file': file.wrapped.fileno(),
+                'offset': start,
+                'count': count,
+                'more_body': more_body,
+            })
+            return
+
+        await file.seek(start)
+        while count > 0:
+            chunk = await file.read(min(RANGE_CHUNK_SIZE, count))
+            if not chunk:
+                break
+            count -= len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': count > 0 or more_body})
+        if count > 0 or (start > end and not more_body):
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': more_body})
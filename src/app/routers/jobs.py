@@ -0,0 +1,88 @@
+from typing import Annotated
+from aiofiles import os as aiofiles_os
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from redis.asyncio import Redis
+
+from ..datasets import read_header, select_columns
+from ..dependencies import get_current_active_user, get_db, get_user_storage, admission
+from ..jobs import RESULT_FORMATS, ACTIVE_STATUSES, get_job, submit_job, cancel_job, remove_job, result_path
+from ..responses import RangeFileResponse, make_etag, parse_range
+from ..schemas.jobs import Job, JobIn
+from ..schemas.users import User
+from ..storage import UserStorage
+
+router = APIRouter(
+    prefix='/jobs',
+    tags=['jobs'],
+)
+
+
+async def get_user_job(
+        current_user: Annotated[User, Depends(get_current_active_user)],
+        db: Annotated[Redis, Depends(get_db)],
+        job_id: str,
+) -> Job:
+    job = await get_job(db, job_id)
+    if not job or job.username != current_user.username:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job not found')
+    return job
+
+
+@router.post("/", response_model=Job, status_code=status.HTTP_202_ACCEPTED,
+             dependencies=[Depends(admission('jobs'))])
+async def create_job(
+        current_user: Annotated[User, Depends(get_current_active_user)],
+        db: Annotated[Redis, Depends(get_db)],
+        storage: Annotated[UserStorage, Depends(get_user_storage)],
+        spec: JobIn,
+        response: Response,
+):
+    if not await storage.isfile(spec.filename):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Filename not found")
+
+    path_to_file = storage.path(spec.filename)
+    select_columns(read_header(path_to_file), spec.headers, spec.sort_by)
+    stat_result = await aiofiles_os.stat(path_to_file)
+
+    job, deduplicated = await submit_job(db, current_user.username, spec, stat_result)
+    if deduplicated:
+        response.status_code = status.HTTP_200_OK
+    return job
+
+
+@router.get("/{job_id}", response_model=Job)
+async def read_job(
+        job: Annotated[Job, Depends(get_user_job)],
+):
+    return job
+
+
+@router.get("/{job_id}/result", dependencies=[Depends(admission('read'))])
+async def read_job_result(
+        job: Annotated[Job, Depends(get_user_job)],
+        request: Request,
+):
+    if job.status != 'done':
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'Job is {job.status}')
+
+    path_to_result = result_path(job)
+    try:
+        stat_result = await aiofiles_os.stat(path_to_result)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Result expired')
+
+    range_header = request.headers.get('range')
+    ranges = parse_range(range_header, stat_result.st_size) if range_header else None
+    media_type = RESULT_FORMATS[job.format][0]
+    return RangeFileResponse(path_to_result, stat_result, media_type, ranges, {'ETag': make_etag(stat_result)})
+
+
+@router.delete("/{job_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_job(
+        job: Annotated[Job, Depends(get_user_job)],
+        db: Annotated[Redis, Depends(get_db)],
+):
+    # an active job is cancelled and kept so its status can still be read, a finished one is removed
+    if job.status in ACTIVE_STATUSES and await cancel_job(db, job):
+        return
+    await remove_job(db, job)
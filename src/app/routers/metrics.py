@@ -0,0 +1,14 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from ..metrics import render_latest
+
+router = APIRouter(
+    prefix='/metrics',
+    tags=['metrics'],
+)
+
+
+@router.get("/", include_in_schema=False)
+def read_metrics():
+    return Response(render_latest(), media_type=CONTENT_TYPE_LATEST)
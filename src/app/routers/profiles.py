@@ -0,0 +1,38 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import FileResponse
+
+from ..dependencies import get_current_active_user
+from ..profiling import profile_store
+from ..schemas.users import User
+
+router = APIRouter(
+    prefix='/profiles',
+    tags=['profiles'],
+)
+
+
+@router.get("/")
+async def read_profiles(
+        current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    if not current_user.admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Requires admin privileges')
+
+    return {'profiles': profile_store.list()}
+
+
+@router.get("/{profile_id}")
+async def read_profile(
+        current_user: Annotated[User, Depends(get_current_active_user)],
+        profile_id: str,
+):
+    if not current_user.admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Requires admin privileges')
+
+    meta = profile_store.get(profile_id)
+    if not meta:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Profile not found')
+
+    media_type = 'text/html' if meta['format'] == 'html' else 'application/json'
+    return FileResponse(profile_store.path(meta), media_type=media_type, filename=meta['filename'])
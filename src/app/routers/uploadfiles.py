@@ -1,11 +1,26 @@
 from typing import Annotated
-import os, csv, aiofiles, pandas as pd
+import csv, io, random, aiofiles
 from aiofiles import os as aiofiles_os
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, status, Query
-
-from ..constants import PATH_FILES
-from ..dependencies import get_current_active_user
-from ..schemas.users import User
+from fastapi import (
+    APIRouter, Depends, UploadFile, File, HTTPException, status, Query, Header, Request, Response, BackgroundTasks,
+)
+from fastapi.responses import StreamingResponse
+from redis.asyncio import Redis
+from starlette.concurrency import run_in_threadpool
+
+from ..appends import file_lock, parse_rows, encode_records, append_rows
+from ..constants import PRECOMPRESS_UPLOADS, PRECOMPRESS_MIN_SIZE
+from ..datasets import (
+    read_header, select_columns, iter_frames, stream_csv, stream_ndjson, build_metadata, load_schema, read_frame,
+    preview_frame, sample_frame, PREVIEW_ROWS, SAMPLE_MAX,
+)
+from ..dependencies import get_db, get_user_storage, admission, admit_read_uploadfile
+from ..formats import TABLE_MEDIA_TYPES, STREAM_MEDIA_TYPES, CSV, negotiate, render
+from ..metrics import UPLOAD_BYTES, CSV_PARSE_SECONDS, CSV_SORT_SECONDS
+from ..profiling import run_blocking
+from ..responses import RangeFileResponse, make_etag, etag_matches, accepts_encoding, parse_range
+from ..storage import UserStorage, is_valid_filename
+from ..valueindex import SEARCH_LIMIT_MAX, select_index_columns, build_value_index, search
 
 router = APIRouter(
     prefix='/uploadfiles',
@@ -13,40 +28,59 @@ router = APIRouter(
 )
 
 
-@router.post("/")
+@router.post("/", dependencies=[Depends(admission('upload'))])
 async def create_uploadfiles(
-        current_user: Annotated[User, Depends(get_current_active_user)],
+        storage: Annotated[UserStorage, Depends(get_user_storage)],
         files: Annotated[list[UploadFile], File(description="Multiple files as UploadFile", max_length=1048576)],
+        index_columns: str | None = None,
 ):
     fileinfos = []
-    listdir = await aiofiles_os.listdir(os.path.join(PATH_FILES, current_user.username))
+    listdir = await storage.listdir()
     for indx, upfile in enumerate(files):
 
-        if upfile.filename in listdir:
+        if not is_valid_filename(upfile.filename):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad filename")
+        elif upfile.filename in listdir:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File already exists")
         else:
             fileinfos.append({'filename': upfile.filename, 'size': upfile.size})
 
         context = await upfile.read()
+        UPLOAD_BYTES.inc(len(context))
+        if index_columns:
+            header = io.TextIOWrapper(io.BytesIO(context), encoding='utf-8-sig', errors='replace', newline='')
+            columns = select_index_columns(next(csv.reader(header), []), index_columns)
 
-        path_to_file = os.path.join(PATH_FILES, current_user.username, upfile.filename)
+        path_to_file = storage.path(upfile.filename)
         async with aiofiles.open(path_to_file, mode='wb') as outfile:
             await outfile.write(context)
 
+        await storage.makedirs_meta(upfile.filename)
+        # dtypes and row checkpoints are built once here, later reads and samples use them
+        try:
+            await run_in_threadpool(build_metadata, path_to_file)
+            if index_columns:
+                await run_in_threadpool(build_value_index, path_to_file, columns)
+        except (ValueError, csv.Error):
+            # not utf-8 or not a csv table, it couldn't be read either
+            await storage.remove(upfile.filename)
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad file")
+        if PRECOMPRESS_UPLOADS and len(context) >= PRECOMPRESS_MIN_SIZE:
+            await run_in_threadpool(storage.precompress, upfile.filename)
+
     return {"fileinfos": fileinfos}
 
 
-@router.get("/")
+@router.get("/", dependencies=[Depends(admission('read'))])
 async def read_uploadfiles(
-        current_user: Annotated[User, Depends(get_current_active_user)],
+        storage: Annotated[UserStorage, Depends(get_user_storage)],
 ):
     response = {}
-    a = os.path.join(PATH_FILES, current_user.username)
-    listdir = await aiofiles_os.listdir(os.path.join(PATH_FILES, current_user.username))
+    listdir = await storage.listdir()
 
     for filename in listdir:
-        path_to_file_in = os.path.join(PATH_FILES, current_user.username, filename)
-        async with aiofiles.open(path_to_file_in, encoding='utf-8') as csv_file:
+        path_to_file_in = storage.path(filename)
+        async with aiofiles.open(path_to_file_in, encoding='utf-8-sig') as csv_file:
             line = await csv_file.readline()
         if not line:
             fieldnames = []
@@ -58,42 +92,156 @@ async def read_uploadfiles(
     return response
 
 
-@router.get("/{filename}")
+@router.get("/search", dependencies=[Depends(admission('read'))])
+async def search_uploadfiles(
+        storage: Annotated[UserStorage, Depends(get_user_storage)],
+        q: Annotated[str, Query(min_length=1)],
+        limit: Annotated[int, Query(gt=0, le=SEARCH_LIMIT_MAX)] = 100,
+):
+    # files uploaded with index_columns are searched through their value index, the others are skipped
+    paths = {filename: storage.path(filename) for filename in await storage.listdir()}
+    hits = await run_in_threadpool(search, paths, q, limit)
+    return {'q': q, 'hits': hits}
+
+
+@router.get("/{filename}", dependencies=[Depends(admit_read_uploadfile)])
 async def read_uploadfile(
-        current_user: Annotated[User, Depends(get_current_active_user)],
+        storage: Annotated[UserStorage, Depends(get_user_storage)],
+        request: Request,
         filename: str,
         headers: str | None = None,
         sort_by: str | None = None,
+        full: bool = False,
+        sample: Annotated[int | None, Query(gt=0, le=SAMPLE_MAX)] = None,
+        seed: int | None = None,
+        accept: Annotated[str | None, Header()] = None,
 ):
-    filenames = await aiofiles_os.listdir(os.path.join(PATH_FILES, current_user.username))
-    if filename not in filenames:
+    media_type = negotiate(accept, STREAM_MEDIA_TYPES if full else TABLE_MEDIA_TYPES)
+    if full and sample:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad param sample")
+
+    if not await storage.isfile(filename):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Filename not found")
 
-    df = pd.read_csv(os.path.join(PATH_FILES, current_user.username, filename))
+    path_to_file = storage.path(filename)
+    columns, by = select_columns(read_header(path_to_file), headers, sort_by)
+    schema = load_schema(path_to_file)
+    if full:
+        frames = iter_frames(path_to_file, columns, by, schema=schema)
+        content = stream_csv(frames) if media_type == CSV else stream_ndjson(frames)
+        return StreamingResponse(content, media_type=media_type, headers={'Vary': 'Accept'})
+
+    # parsed and sorted in the threadpool, so the admission slot bounds the work and the event loop stays free;
+    # inline when profiled, for the profile to show the parse and the sort
+    if sample:
+        seed = random.randrange(2 ** 32) if seed is None else seed
+        with CSV_PARSE_SECONDS.time():
+            df = await run_blocking(request, sample_frame, path_to_file, columns, schema, sample, seed)
+    elif by:
+        with CSV_PARSE_SECONDS.time():
+            df = await run_blocking(request, read_frame, path_to_file, columns, schema)
+    else:
+        # nothing to order, only the first rows are parsed
+        with CSV_PARSE_SECONDS.time():
+            df = await run_blocking(request, preview_frame, path_to_file, columns, schema)
+
+    if by:
+        with CSV_SORT_SECONDS.time():
+            df = await run_blocking(request, df.sort_values, by=by)
+
+    if not sample:
+        return render(media_type, df.head(PREVIEW_ROWS))
+    response = render(media_type, df)
+    response.headers['X-Sample-Seed'] = str(seed)
+    return response
 
-    if headers:
-        try:
-            df = df[headers.split(',')]
-        except KeyError as exp:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad param headers")
 
-    if sort_by:
+@router.api_route("/{filename}/raw", methods=["GET", "HEAD"], dependencies=[Depends(admission('read'))])
+async def read_uploadfile_raw(
+        storage: Annotated[UserStorage, Depends(get_user_storage)],
+        request: Request,
+        filename: str,
+):
+    if not await storage.isfile(filename):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Filename not found")
+
+    path_to_file = storage.path(filename)
+    stat_result = await aiofiles_os.stat(path_to_file)
+    etag = make_etag(stat_result)
+    headers = {'Vary': 'Accept-Encoding'}
+
+    if accepts_encoding(request.headers.get('accept-encoding'), 'gzip'):
+        path_to_variant = storage.meta_path(filename, 'gz')
         try:
-            df = df.sort_values(by=sort_by.split(','))
-        except KeyError as exp:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad param sort_by")
+            variant_stat = await aiofiles_os.stat(path_to_variant)
+        except FileNotFoundError:
+            variant_stat = None
+        # a variant older than the file itself is stale
+        if variant_stat and variant_stat.st_mtime_ns >= stat_result.st_mtime_ns:
+            path_to_file, stat_result = path_to_variant, variant_stat
+            etag = make_etag(stat_result, '-gzip')
+            headers['Content-Encoding'] = 'gzip'
+
+    headers['ETag'] = etag
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    ranges = None
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header and (not if_range or if_range.strip() == etag):
+        ranges = parse_range(range_header, stat_result.st_size)
+
+    return RangeFileResponse(path_to_file, stat_result, CSV, ranges, headers, send_body=request.method != 'HEAD')
+
+
+async def refresh_variant(db: Redis, storage: UserStorage, filename: str):
+    # the variant of the file before the append is stale, it is served again once rewritten
+    async with file_lock(db, storage.username, filename):
+        if await storage.isfile(filename):
+            await run_in_threadpool(storage.precompress, filename)
+
+
+@router.post("/{filename}/rows", dependencies=[Depends(admission('upload'))])
+async def append_uploadfile_rows(
+        storage: Annotated[UserStorage, Depends(get_user_storage)],
+        db: Annotated[Redis, Depends(get_db)],
+        request: Request,
+        background_tasks: BackgroundTasks,
+        filename: str,
+):
+    if not await storage.isfile(filename):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Filename not found")
+
+    body = await request.body()
+    UPLOAD_BYTES.inc(len(body))
+    path_to_file = storage.path(filename)
+    rows = parse_rows(request.headers.get('content-type'), body, read_header(path_to_file))
+    records = encode_records(rows)
+
+    async with file_lock(db, storage.username, filename):
+        # removed while the lock was awaited
+        if not await storage.isfile(filename):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Filename not found")
+        await storage.makedirs_meta(filename)
+        total_rows = await run_in_threadpool(append_rows, path_to_file, records)
+        size = (await aiofiles_os.stat(path_to_file)).st_size
 
-    return {'csv_table': df.head(3).to_csv(index=False, encoding='utf-8')}
+    if PRECOMPRESS_UPLOADS and size >= PRECOMPRESS_MIN_SIZE:
+        background_tasks.add_task(refresh_variant, db, storage, filename)
+    return {'filename': filename, 'rows': len(records), 'total_rows': total_rows}
 
 
 @router.delete("/{filename}", status_code=status.HTTP_204_NO_CONTENT)
 async def remove_uploadfile(
-        current_user: Annotated[User, Depends(get_current_active_user)],
+        storage: Annotated[UserStorage, Depends(get_user_storage)],
+        db: Annotated[Redis, Depends(get_db)],
         filename: str,
 ):
-    path_file = os.path.join(PATH_FILES, current_user.username, filename)
-    isfile = await aiofiles_os.path.isfile(path_file)
+    isfile = await storage.isfile(filename)
     if not isfile:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Filename not found")
 
-    await aiofiles_os.remove(path_file)
+    # not while rows are appended to it
+    async with file_lock(db, storage.username, filename):
+        await storage.remove(filename)
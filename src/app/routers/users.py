@@ -1,10 +1,11 @@
 from typing import Annotated
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from redis.asyncio import Redis
 
 from ..dependencies import get_current_active_user, get_password_hash, get_db
-from ..schemas.users import UserInUpdate, User, UserInCreate, UserInDB
-from ..sql_app.crud import create_user, delete_user, update_user, get_user
+from ..provisioning import parse_users, provision_users
+from ..schemas.users import UserInUpdate, User, UserInCreate, UserInDB, BulkUserResult
+from ..sql_app.crud import create_user, delete_user, update_user, get_user, get_usernames
 
 router = APIRouter(
     prefix='/users',
@@ -39,14 +40,20 @@ async def patch_user(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Requires admin privileges')
 
     update_data = patched_user.model_dump(exclude_unset=True)
+    if 'rate_limits' in update_data:
+        if not current_user.admin:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Requires admin privileges')
+        update_data['rate_limits'] = patched_user.rate_limits
     password = update_data.pop('password', None)
     if password:
         update_data['hashed_password'] = get_password_hash(password)
 
     stored_user_model = await get_user(db, username)
+    if not stored_user_model:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User doesn\'t exists')
     updated_user = stored_user_model.model_copy(update=update_data)
 
-    await update_user(db, current_user.username, updated_user.username, updated_user.model_dump_json())
+    await update_user(db, username, updated_user.username, updated_user.model_dump_json())
 
     return updated_user
 
@@ -56,7 +63,7 @@ async def get_users(
         current_user: Annotated[User, Depends(get_current_active_user)],
         db: Annotated[Redis, Depends(get_db)],
 ):
-    response = [await get_user(db, username) async for username in db.scan_iter()]
+    response = [await get_user(db, username) for username in await get_usernames(db)]
     return response
 
 
@@ -82,6 +89,20 @@ async def insert_user(
     return user_model
 
 
+@router.post("/bulk", response_model=list[BulkUserResult])
+async def insert_users(
+        current_user: Annotated[User, Depends(get_current_active_user)],
+        db: Annotated[Redis, Depends(get_db)],
+        request: Request,
+):
+    if not current_user.admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Requires admin privileges')
+
+    # a JSON list of users or a CSV with a header, every user gets its own result
+    items = parse_users(request.headers.get('content-type'), await request.body())
+    return await provision_users(db, items)
+
+
 @router.delete('/{username}', status_code=status.HTTP_204_NO_CONTENT)
 async def remove_user(
         current_user: Annotated[User, Depends(get_current_active_user)],
@@ -0,0 +1,120 @@
+import os
+from array import array
+
+from .storage import meta_path_of
+
+ROW_INDEX_FILE = 'rows.idx'
+# byte offset of every ROW_CHECKPOINT_INTERVAL-th data row is kept
+ROW_CHECKPOINT_INTERVAL = 128
+# size, mtime_ns, rows and interval precede the offsets
+HEADER_ITEMS = 4
+ITEM_SIZE = array('Q').itemsize
+
+
+def read_record(infile) -> bytes:
+    """One CSV record, several lines when a quoted value contains line breaks."""
+    record = infile.readline()
+    while record.count(b'"') % 2:
+        line = infile.readline()
+        if not line:
+            break
+        record += line
+    return record
+
+
+def is_blank(record: bytes) -> bool:
+    # pandas skips blank lines, they aren't rows
+    return record in (b'\n', b'\r\n')
+
+
+def build_row_index(path: str, interval: int = ROW_CHECKPOINT_INTERVAL) -> int:
+    """Write the row checkpoints of the file at ``path``, returns the number of data rows."""
+    stat_result = os.stat(path)
+    offsets = array('Q')
+    rows = 0
+    with open(path, 'rb') as infile:
+        position = len(read_record(infile))
+        while record := read_record(infile):
+            if not is_blank(record):
+                if rows % interval == 0:
+                    offsets.append(position)
+                rows += 1
+            position += len(record)
+
+    path_to_index = meta_path_of(path, ROW_INDEX_FILE)
+    with open(path_to_index + '.tmp', 'wb') as outfile:
+        array('Q', (stat_result.st_size, stat_result.st_mtime_ns, rows, interval)).tofile(outfile)
+        offsets.tofile(outfile)
+    os.replace(path_to_index + '.tmp', path_to_index)
+    return rows
+
+
+class RowIndex:
+    """Random access to data rows through the checkpoints, reads only the offsets it needs."""
+
+    def __init__(self, path: str, rows: int, interval: int):
+        self.path = path
+        self.rows = rows
+        self.interval = interval
+
+    @classmethod
+    def load(cls, path: str) -> 'RowIndex | None':
+        """The index of the file at ``path``, None when there is none or the file changed since."""
+        try:
+            with open(meta_path_of(path, ROW_INDEX_FILE), 'rb') as infile:
+                header = array('Q')
+                header.fromfile(infile, HEADER_ITEMS)
+            stat_result = os.stat(path)
+        except (OSError, EOFError):
+            return None
+        size, mtime_ns, rows, interval = header
+        if (size, mtime_ns) != (stat_result.st_size, stat_result.st_mtime_ns):
+            return None
+        return cls(path, rows, interval)
+
+    def read_rows(self, row_numbers: list[int]) -> tuple[bytes, list[bytes]]:
+        """Header line and the records of the ascending ``row_numbers``."""
+        records = []
+        with open(self.path, 'rb') as infile, open(meta_path_of(self.path, ROW_INDEX_FILE), 'rb') as index_file:
+            header = read_record(infile)
+            current = None
+            for row in row_numbers:
+                checkpoint = row // self.interval
+                # seek unless the target is further in the block the file is positioned in
+                if current is None or row < current or checkpoint != current // self.interval:
+                    index_file.seek((HEADER_ITEMS + checkpoint) * ITEM_SIZE)
+                    offset = array('Q')
+                    offset.fromfile(index_file, 1)
+                    infile.seek(offset[0])
+                    current = checkpoint * self.interval
+                while record := read_record(infile):
+                    if is_blank(record):
+                        continue
+                    if current == row:
+                        break
+                    current += 1
+                records.append(record if record.endswith(b'\n') else record + b'\n')
+                current += 1
+        return header, records
+
+    def append(self, record_lengths: list[int], start: int) -> int:
+        """Add the checkpoints of records appended to the file at offset ``start``, returns the number of data rows.
+
+        Only the new offsets and the header are written, the checkpoints of the rows already indexed are kept.
+        """
+        offsets = array('Q')
+        position = start
+        for length in record_lengths:
+            if self.rows % self.interval == 0:
+                offsets.append(position)
+            self.rows += 1
+            position += length
+
+        stat_result = os.stat(self.path)
+        with open(meta_path_of(self.path, ROW_INDEX_FILE), 'r+b') as index_file:
+            index_file.seek(0, os.SEEK_END)
+            offsets.tofile(index_file)
+            # the header goes last, until it is rewritten the index is stale and isn't used
+            index_file.seek(0)
+            array('Q', (stat_result.st_size, stat_result.st_mtime_ns, self.rows, self.interval)).tofile(index_file)
+        return self.rows
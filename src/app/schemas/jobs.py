@@ -0,0 +1,23 @@
+from typing import Literal
+from pydantic import BaseModel
+
+JobFormat = Literal['csv', 'ndjson', 'parquet', 'arrow']
+JobStatus = Literal['queued', 'running', 'done', 'failed', 'cancelled']
+
+
+class JobIn(BaseModel):
+    filename: str
+    headers: str | None = None
+    sort_by: str | None = None
+    format: JobFormat = 'csv'
+
+
+class Job(JobIn):
+    id: str
+    username: str
+    status: JobStatus
+    progress: float = 0.0
+    rows: int = 0
+    error: str | None = None
+    created: float
+    updated: float
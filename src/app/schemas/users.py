@@ -1,4 +1,12 @@
-from pydantic import BaseModel, EmailStr
+from typing import Literal
+from pydantic import BaseModel, EmailStr, Field
+
+RouteClass = Literal['read', 'parse', 'sort', 'upload', 'jobs']
+
+
+class RateLimit(BaseModel):
+    rate: float = Field(gt=0)
+    burst: int = Field(ge=1)
 
 
 class User(BaseModel):
@@ -7,6 +15,7 @@ class User(BaseModel):
     full_name: str | None = None
     disabled: bool | None = None
     admin: bool | None = None
+    rate_limits: dict[RouteClass, RateLimit] | None = None
 
 
 class UserInCreate(BaseModel):
@@ -14,6 +23,7 @@ class UserInCreate(BaseModel):
     password: str
     email: EmailStr | None = None
     full_name: str | None = None
+    rate_limits: dict[RouteClass, RateLimit] | None = None
 
 
 class UserInUpdate(UserInCreate):
@@ -23,3 +33,9 @@ class UserInUpdate(UserInCreate):
 
 class UserInDB(User):
     hashed_password: str
+
+
+class BulkUserResult(BaseModel):
+    username: str | None = None
+    status: Literal['created', 'exists', 'invalid']
+    detail: str | None = None
@@ -1,7 +1,10 @@
-import getpass, asyncio
+import argparse, getpass, asyncio
+from fastapi import HTTPException
 from redis.asyncio import Redis
 
 from ..dependencies import get_password_hash, get_db
+from ..formats import CSV
+from ..provisioning import JSON, parse_users, provision_users
 from ..schemas.users import UserInDB
 from ..sql_app.crud import create_user, get_user
 
@@ -25,8 +28,34 @@ async def create_user_admin():
         await create_user(db, admin.username, admin.model_dump_json())
 
 
+async def import_users(path: str, admin: bool = False) -> list[dict]:
+    """Create the users of a CSV or JSON file, the same import as ``POST /users/bulk`` without its size limit."""
+    with open(path, 'rb') as infile:
+        body = infile.read()
+    items = parse_users(CSV if path.lower().endswith('.csv') else JSON, body, max_users=None)
+    db: Redis = await anext(get_db())
+    try:
+        return await provision_users(db, items, admin)
+    finally:
+        await db.aclose()
+
+
 async def main():
-    await create_user_admin()
+    parser = argparse.ArgumentParser(description='Create an admin interactively or import users from a file')
+    parser.add_argument('--import', dest='path', default=None,
+                        help='CSV (username,password,email,full_name) or JSON list of users')
+    parser.add_argument('--admin', action='store_true', help='imported users are admins')
+    args = parser.parse_args()
+    if not args.path:
+        await create_user_admin()
+        return
+
+    try:
+        results = await import_users(args.path, args.admin)
+    except HTTPException as exp:
+        raise SystemExit(exp.detail)
+    for result in results:
+        print(' '.join(str(value) for value in result.values() if value))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+import asyncio, time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from redis.asyncio import Redis
+
+from ..constants import REDIS_URL, JOB_WORKERS, JOB_CLEANUP_INTERVAL
+from ..jobs import JOB_QUEUE, fail_job, run_job, remove_expired_results
+
+
+class JobPool:
+    """Process pool of the worker, made again once a crashed process (killed for memory, say) broke it."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(workers)
+
+    def submit(self, fn, *args) -> Future:
+        try:
+            return self.pool.submit(fn, *args)
+        except BrokenProcessPool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = ProcessPoolExecutor(self.workers)
+            return self.pool.submit(fn, *args)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+async def work(workers: int = JOB_WORKERS):
+    """Take jobs from the queue and run at most ``workers`` of them at once in a process pool."""
+    db: Redis = Redis.from_url(REDIS_URL)
+    slots = asyncio.Semaphore(workers)
+    last_cleanup = 0.0
+    # failures being recorded, referenced until they finish
+    failing = set()
+
+    def done(job_id: str, future: asyncio.Future):
+        slots.release()
+        exp = future.exception()
+        if exp is None:
+            print(f'Job {job_id} {future.result()}')
+            return
+        print(f'Job {job_id} crashed: {exp!r}')
+        # the process died before the job could record it, a job left running would be deduplicated to
+        task = asyncio.create_task(fail_job(db, job_id, repr(exp)))
+        failing.add(task)
+        task.add_done_callback(failing.discard)
+
+    pool = JobPool(workers)
+    try:
+        while True:
+            if time.monotonic() - last_cleanup > JOB_CLEANUP_INTERVAL:
+                await remove_expired_results(db)
+                last_cleanup = time.monotonic()
+
+            # a job is taken from the queue only when a process is free for it,
+            # so several worker hosts share the queue fairly
+            await slots.acquire()
+            popped = await db.blpop([JOB_QUEUE], timeout=1)
+            if not popped:
+                slots.release()
+                continue
+            _, job_id = popped
+            future = asyncio.wrap_future(pool.submit(run_job, job_id))
+            future.add_done_callback(lambda future, job_id=job_id: done(job_id, future))
+    finally:
+        pool.shutdown()
+
+
+async def main():
+    print(f'Job worker started with {JOB_WORKERS} processes')
+    await work()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,34 @@
+import argparse, asyncio
+from redis.asyncio import Redis
+
+from ..constants import REDIS_URL, REBALANCE_GRACE
+from ..sql_app.crud import get_usernames
+from ..storage import plan_moves, move_user
+
+
+async def rebalance(db: Redis, dry_run: bool = False, grace: float = REBALANCE_GRACE) -> list[tuple[str, str, str]]:
+    """Move every user directory to the root the ring assigns it, one user at a time, returns the moves."""
+    moves = await plan_moves(db, await get_usernames(db))
+    for username, source, target in moves:
+        print(f'{username}: {source} -> {target}')
+        if not dry_run:
+            await move_user(db, username, source, target, grace)
+    return moves
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Move user directories after STORAGE_ROOTS changed')
+    parser.add_argument('--dry-run', action='store_true', help='only print the moves')
+    parser.add_argument('--grace', type=float, default=REBALANCE_GRACE,
+                        help='seconds to wait for requests in flight around every move')
+    args = parser.parse_args()
+    db: Redis = Redis.from_url(REDIS_URL)
+    try:
+        moves = await rebalance(db, args.dry_run, args.grace)
+    finally:
+        await db.aclose()
+    print(f'{len(moves)} users {"to move" if args.dry_run else "moved"}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,11 +1,13 @@
-import json, os
+import asyncio, json, os
 from shutil import rmtree
 from fastapi import status, HTTPException
 from redis.asyncio import Redis
 from aiofiles import os as aiofiles_os
+from starlette.concurrency import run_in_threadpool
 
-from ..constants import PATH_FILES
+from ..constants import INTERNAL_KEY_PREFIX
 from ..schemas.users import UserInDB
+from ..storage import PLACEMENT_KEY, check_not_moving, resolve_root
 
 
 async def get_user(db: Redis, username: str) -> UserInDB:
@@ -15,27 +17,66 @@ async def get_user(db: Redis, username: str) -> UserInDB:
         return UserInDB(**user_dict)
 
 
+async def get_usernames(db: Redis) -> list[str]:
+    return [key async for key in db.scan_iter() if not key.startswith(INTERNAL_KEY_PREFIX)]
+
+
 async def create_user(db: Redis, username: str, value: str):
-    path_to_dir = os.path.join(PATH_FILES, username)
+    root = await resolve_root(db, username)
+    path_to_dir = os.path.join(root, username)
     dir_exists = await aiofiles_os.path.isdir(path_to_dir)
     if dir_exists:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='User already exists')
     else:
-        await aiofiles_os.mkdir(path_to_dir)
+        await aiofiles_os.makedirs(path_to_dir)
+        await db.hset(PLACEMENT_KEY, username, root)
         await db.set(username, value)
 
 
+def _make_user_dirs(paths: list[str]):
+    for path in paths:
+        os.makedirs(path, exist_ok=True)
+
+
+async def create_users(db: Redis, users: dict[str, str]) -> dict[str, bool]:
+    """Create every user of ``users`` (username to value) that doesn't exist yet, returns whether each was created.
+
+    Directories are made in one threadpool call and the keys are set in one pipeline. A directory left
+    without its key by an interrupted import is reused, so running the same import again completes it.
+    """
+    usernames = list(users)
+    placed = await db.hmget(PLACEMENT_KEY, usernames)
+    # placed like create_user places them, a directory already on disk keeps its root
+    unplaced = [username for username, root in zip(usernames, placed) if not root]
+    roots = dict(zip(usernames, placed))
+    roots.update(zip(unplaced, await asyncio.gather(*(resolve_root(db, username) for username in unplaced))))
+    await run_in_threadpool(_make_user_dirs, [os.path.join(roots[username], username) for username in usernames])
+    async with db.pipeline(transaction=False) as pipe:
+        for username, value in users.items():
+            pipe.hsetnx(PLACEMENT_KEY, username, roots[username])
+            pipe.set(username, value, nx=True)
+        results = await pipe.execute()
+    return {username: bool(created) for username, created in zip(users, results[1::2])}
+
+
 async def update_user(db: Redis, delete_username: str, new_username: str, new_value: str):
-    await aiofiles_os.replace(os.path.join(PATH_FILES, delete_username), os.path.join(PATH_FILES, new_username))
+    # renamed in place, the directory stays on its root
+    await check_not_moving(db, delete_username)
+    root = await resolve_root(db, delete_username)
+    await aiofiles_os.replace(os.path.join(root, delete_username), os.path.join(root, new_username))
+    await db.hdel(PLACEMENT_KEY, delete_username)
+    await db.hset(PLACEMENT_KEY, new_username, root)
     await db.delete(delete_username)
     await db.set(new_username, new_value)
 
 
 async def delete_user(db: Redis, username: str):
-    path_to_dir= os.path.join(PATH_FILES, username)
+    await check_not_moving(db, username)
+    path_to_dir= os.path.join(await resolve_root(db, username), username)
     dir_exists = await aiofiles_os.path.isdir(path_to_dir)
     if not dir_exists:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='User haven\'t exists')
     else:
-        rmtree(os.path.join(PATH_FILES, username))
+        rmtree(path_to_dir)
         await db.delete(username)
+        await db.hdel(PLACEMENT_KEY, username)
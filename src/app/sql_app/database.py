@@ -0,0 +1,7 @@
+from redis.asyncio import Redis
+
+from ..metrics import RedisMetricsMixin
+
+
+class InstrumentedRedis(RedisMetricsMixin, Redis):
+    pass
@@ -0,0 +1,181 @@
+import asyncio, bisect, gzip, hashlib, os, shutil
+from functools import cache
+from aiofiles import os as aiofiles_os
+from fastapi import HTTPException, status
+from redis.asyncio import Redis
+from starlette.concurrency import run_in_threadpool
+
+from .constants import PATH_FILES, STORAGE_ROOTS, STORAGE_VNODES, INTERNAL_KEY_PREFIX
+
+# derived data of every uploaded file lives in META_DIR/<filename>/ next to the files
+META_DIR = '.meta'
+# root of every user's directory, recorded when the user is created and changed only by a rebalance
+PLACEMENT_KEY = INTERNAL_KEY_PREFIX + 'storage:placement'
+# users whose directory a rebalance is moving, their files can't be changed meanwhile
+MOVING_KEY = INTERNAL_KEY_PREFIX + 'storage:moving'
+
+
+def meta_path_of(path: str, name: str) -> str:
+    """Path of the derived data ``name`` of the uploaded file at ``path``."""
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, META_DIR, filename, name)
+
+
+def is_valid_filename(filename: str | None) -> bool:
+    return bool(filename) and not filename.startswith('.') and '/' not in filename and '\\' not in filename
+
+
+def _ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of usernames onto storage roots, adding a root moves about 1/n of the users to it."""
+
+    def __init__(self, roots: list[str], vnodes: int = STORAGE_VNODES):
+        self.roots = list(roots)
+        self.points = sorted((_ring_hash(f'{root}#{point}'), root) for root in self.roots for point in range(vnodes))
+        self.hashes = [point_hash for point_hash, _ in self.points]
+
+    def root_for(self, username: str) -> str:
+        position = bisect.bisect(self.hashes, _ring_hash(username)) % len(self.points)
+        return self.points[position][1]
+
+
+@cache
+def get_ring() -> HashRing:
+    return HashRing(STORAGE_ROOTS)
+
+
+def find_user_root(username: str) -> str | None:
+    """Root holding the directory of ``username``, for users created before placements were recorded."""
+    for root in dict.fromkeys([*STORAGE_ROOTS, PATH_FILES]):
+        if os.path.isdir(os.path.join(root, username)):
+            return root
+
+
+async def resolve_root(db: Redis, username: str) -> str:
+    """Root of the directory of ``username``: the recorded one, the one found on disk or the ring's choice."""
+    root = await db.hget(PLACEMENT_KEY, username)
+    if root:
+        return root
+    root = await run_in_threadpool(find_user_root, username)
+    if root:
+        await db.hsetnx(PLACEMENT_KEY, username, root)
+        return root
+    return get_ring().root_for(username)
+
+
+async def check_not_moving(db: Redis, username: str):
+    """Refuse changes to ``username`` with 503 while a rebalance moves the user's directory, they would be lost."""
+    if await db.sismember(MOVING_KEY, username):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Storage is being moved',
+            headers={'Retry-After': '5'},
+        )
+
+
+class UserStorage:
+    """Uploaded files of one user and the derived data kept next to them."""
+
+    def __init__(self, username: str, root: str = PATH_FILES):
+        self.username = username
+        self.root = root
+        self.directory = os.path.join(root, username)
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def meta_dir(self, filename: str) -> str:
+        return os.path.join(self.directory, META_DIR, filename)
+
+    def meta_path(self, filename: str, name: str) -> str:
+        return meta_path_of(self.path(filename), name)
+
+    async def listdir(self) -> list[str]:
+        return [name for name in await aiofiles_os.listdir(self.directory) if name != META_DIR]
+
+    async def isfile(self, filename: str) -> bool:
+        return is_valid_filename(filename) and await aiofiles_os.path.isfile(self.path(filename))
+
+    async def makedirs_meta(self, filename: str):
+        await aiofiles_os.makedirs(self.meta_dir(filename), exist_ok=True)
+
+    async def remove(self, filename: str):
+        await aiofiles_os.remove(self.path(filename))
+        await run_in_threadpool(shutil.rmtree, self.meta_dir(filename), True)
+
+    def precompress(self, filename: str):
+        """Write the gzip variant served to clients sending ``Accept-Encoding: gzip``."""
+        path_to_variant = self.meta_path(filename, 'gz')
+        with open(self.path(filename), 'rb') as infile, gzip.open(path_to_variant + '.tmp', 'wb', 6) as outfile:
+            shutil.copyfileobj(infile, outfile, 1024 * 1024)
+        os.replace(path_to_variant + '.tmp', path_to_variant)
+
+
+def sync_tree(source: str, target: str):
+    """Make ``target`` a copy of ``source``, copying only files whose size or mtime differ.
+
+    Copies keep their mtime, so the derived data recorded against it stays valid.
+    """
+    copied = set()
+    for directory, _, filenames in os.walk(source):
+        target_directory = os.path.normpath(os.path.join(target, os.path.relpath(directory, source)))
+        os.makedirs(target_directory, exist_ok=True)
+        for filename in filenames:
+            path, target_path = os.path.join(directory, filename), os.path.join(target_directory, filename)
+            copied.add(target_path)
+            stat_result = os.stat(path)
+            try:
+                target_stat = os.stat(target_path)
+            except FileNotFoundError:
+                target_stat = None
+            if target_stat is None or (target_stat.st_size, target_stat.st_mtime_ns) != (
+                    stat_result.st_size, stat_result.st_mtime_ns):
+                shutil.copy2(path, target_path)
+    for directory, _, filenames in os.walk(target, topdown=False):
+        for filename in filenames:
+            if os.path.join(directory, filename) not in copied:
+                os.remove(os.path.join(directory, filename))
+        if not os.path.exists(os.path.join(source, os.path.relpath(directory, target))):
+            os.rmdir(directory)
+
+
+async def plan_moves(db: Redis, usernames: list[str]) -> list[tuple[str, str, str]]:
+    """``(username, source, target)`` of every user whose directory isn't on the root the ring assigns it."""
+    ring = get_ring()
+    moves = []
+    for username in usernames:
+        source = await resolve_root(db, username)
+        target = ring.root_for(username)
+        if source != target and await aiofiles_os.path.isdir(os.path.join(source, username)):
+            moves.append((username, source, target))
+    return moves
+
+
+async def move_user(db: Redis, username: str, source: str, target: str, grace: float):
+    """Move the directory of ``username`` to ``target`` while the user keeps working.
+
+    The bulk of the data is copied first. Then changes are refused for the user (MOVING_KEY), the copy catches up
+    with what changed meanwhile, is put in place and the placement switched. The old directory is removed after
+    ``grace`` seconds, once requests that resolved it are done.
+    """
+    source_dir, target_dir = os.path.join(source, username), os.path.join(target, username)
+    # a hidden name, not a user directory until it is complete
+    staging_dir = os.path.join(target, f'.rebalance-{username}')
+    await run_in_threadpool(sync_tree, source_dir, staging_dir)
+    await db.sadd(MOVING_KEY, username)
+    try:
+        await asyncio.sleep(grace)
+        if not await aiofiles_os.path.isdir(source_dir):
+            # deleted or renamed by a request that started before the move was flagged, nothing is left to move
+            await run_in_threadpool(shutil.rmtree, staging_dir, True)
+            return
+        await run_in_threadpool(sync_tree, source_dir, staging_dir)
+        await aiofiles_os.rename(staging_dir, target_dir)
+        await db.hset(PLACEMENT_KEY, username, target)
+    finally:
+        await db.srem(MOVING_KEY, username)
+    await asyncio.sleep(grace)
+    await run_in_threadpool(shutil.rmtree, source_dir, True)
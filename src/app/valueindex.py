@@ -0,0 +1,359 @@
+import csv, io, os
+from array import array
+from fastapi import HTTPException, status
+
+from .rowindex import ROW_CHECKPOINT_INTERVAL, RowIndex
+from .storage import meta_path_of
+
+# the first segment is built from the whole file, appended rows go to the next ones
+VALUE_INDEX_FILE = 'values.idx'
+# the last two segments are merged while the older isn't SEGMENT_MERGE_RATIO times larger than the newer,
+# so there are O(log rows) segments and a posting is rewritten O(log rows) times
+SEGMENT_MERGE_RATIO = 2
+# terms are front coded in blocks of TERMS_PER_BLOCK, the directory keeps the offset of every block
+TERMS_PER_BLOCK = 64
+# size, mtime_ns, rows, block_rows, directory offset, blocks and columns offset close the file
+FOOTER_ITEMS = 7
+ITEM_SIZE = array('Q').itemsize
+SEARCH_LIMIT_MAX = 10000
+
+
+def select_index_columns(fieldnames: list[str], index_columns: str) -> list[str]:
+    columns = index_columns.split(',')
+    if any(column not in fieldnames for column in columns):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad param index_columns")
+    return list(dict.fromkeys(columns))
+
+
+def term_key(value: str, column: str) -> bytes:
+    # sorted by value first, so all the columns holding a value are adjacent
+    return value.encode('utf-8') + b'\0' + column.encode('utf-8')
+
+
+def _encode_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(data: bytes, position: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def _read_varint(infile) -> int:
+    value = shift = 0
+    while True:
+        byte = infile.read(1)[0]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value
+        shift += 7
+
+
+def _add_rows(terms: dict[bytes, list[int]], rows, positions: list[tuple[str, int]],
+              start_row: int, block_rows: int) -> int:
+    """Add the row blocks of the values of ``rows`` to ``terms``, returns the number of rows."""
+    count = 0
+    for row in rows:
+        # pandas and the row checkpoints skip blank lines, they aren't rows
+        if not row:
+            continue
+        block = (start_row + count) // block_rows
+        count += 1
+        for column, position in positions:
+            value = row[position] if position < len(row) else ''
+            if not value or '\0' in value:
+                continue
+            postings = terms.setdefault(term_key(value, column), [])
+            if not postings or postings[-1] != block:
+                postings.append(block)
+    return count
+
+
+def _merge_postings(postings: list[int], blocks):
+    """Add the row blocks ``blocks`` of later rows to ``postings``, the first may be the last of ``postings``."""
+    for block in blocks:
+        if not postings or block > postings[-1]:
+            postings.append(block)
+
+
+def _segment_path(path: str, number: int) -> str:
+    return meta_path_of(path, VALUE_INDEX_FILE if number == 0 else f'{VALUE_INDEX_FILE}.{number}')
+
+
+def _segment_numbers(path: str) -> list[int]:
+    """Numbers of the index segments of the file at ``path`` on disk, in order."""
+    try:
+        names = os.listdir(os.path.dirname(meta_path_of(path, VALUE_INDEX_FILE)))
+    except OSError:
+        return []
+    numbers = []
+    for name in names:
+        if name == VALUE_INDEX_FILE:
+            numbers.append(0)
+        elif name.startswith(VALUE_INDEX_FILE + '.') and name[len(VALUE_INDEX_FILE) + 1:].isdigit():
+            numbers.append(int(name[len(VALUE_INDEX_FILE) + 1:]))
+    return sorted(numbers)
+
+
+def _write_value_index(path: str, stat_result: os.stat_result, columns: list[str], rows: int,
+                       block_rows: int, terms: dict[bytes, list[int]], number: int = 0) -> '_Segment':
+    out = bytearray()
+    offsets = array('Q')
+    previous = b''
+    for term_number, key in enumerate(sorted(terms)):
+        if term_number % TERMS_PER_BLOCK == 0:
+            # the first term of a block is whole, so a block can be decoded on its own
+            offsets.append(len(out))
+            previous = b''
+        shared = len(os.path.commonprefix([previous, key]))
+        _encode_varint(shared, out)
+        _encode_varint(len(key) - shared, out)
+        out += key[shared:]
+        postings = terms[key]
+        _encode_varint(len(postings), out)
+        last = 0
+        for block in postings:
+            _encode_varint(block - last, out)
+            last = block
+        previous = key
+
+    directory_offset = len(out)
+    out += offsets.tobytes()
+    columns_offset = len(out)
+    _encode_varint(len(columns), out)
+    for column in columns:
+        name = column.encode('utf-8')
+        _encode_varint(len(name), out)
+        out += name
+    out += array('Q', (stat_result.st_size, stat_result.st_mtime_ns, rows, block_rows,
+                       directory_offset, len(offsets), columns_offset)).tobytes()
+
+    path_to_index = _segment_path(path, number)
+    with open(path_to_index + '.tmp', 'wb') as outfile:
+        outfile.write(out)
+    os.replace(path_to_index + '.tmp', path_to_index)
+    return _Segment(path_to_index, directory_offset, len(offsets), len(out))
+
+
+def build_value_index(path: str, columns: list[str], block_rows: int = ROW_CHECKPOINT_INTERVAL) -> int:
+    """Write the index of the values of ``columns`` of the file at ``path``, returns the number of terms."""
+    stat_result = os.stat(path)
+    terms = {}
+    with open(path, encoding='utf-8-sig', newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        fieldnames = next(reader, [])
+        positions = [(column, fieldnames.index(column)) for column in columns]
+        rows = _add_rows(terms, reader, positions, 0, block_rows)
+    _write_value_index(path, stat_result, columns, rows, block_rows, terms)
+    # the segments of appended rows are in the one just written
+    for number in _segment_numbers(path)[1:]:
+        os.remove(_segment_path(path, number))
+    return len(terms)
+
+
+def _read_footer(path_to_index: str) -> tuple[array, list[str], int] | None:
+    """Footer, columns and size of the segment at ``path_to_index``."""
+    try:
+        with open(path_to_index, 'rb') as infile:
+            size = infile.seek(-FOOTER_ITEMS * ITEM_SIZE, os.SEEK_END) + FOOTER_ITEMS * ITEM_SIZE
+            footer = array('Q')
+            footer.fromfile(infile, FOOTER_ITEMS)
+            columns_offset = footer[6]
+            infile.seek(columns_offset)
+            data = infile.read()
+    except (OSError, EOFError):
+        return None
+    count, position = _decode_varint(data, 0)
+    columns = []
+    for _ in range(count):
+        length, position = _decode_varint(data, position)
+        columns.append(data[position:position + length].decode('utf-8'))
+        position += length
+    return footer, columns, size
+
+
+def indexed_columns(path: str) -> list[str] | None:
+    """Columns the file at ``path`` was indexed by, also when the index is stale."""
+    read = _read_footer(_segment_path(path, 0))
+    return read[1] if read else None
+
+
+class _Segment:
+    """One index file, a lookup reads O(log terms) block heads and one or two blocks."""
+
+    def __init__(self, path: str, directory_offset: int, blocks: int, size: int):
+        self.path = path
+        self.directory_offset = directory_offset
+        self.blocks = blocks
+        self.size = size
+
+    def _block_offset(self, infile, block: int) -> int:
+        if block == self.blocks:
+            return self.directory_offset
+        infile.seek(self.directory_offset + block * ITEM_SIZE)
+        offset = array('Q')
+        offset.fromfile(infile, 1)
+        return offset[0]
+
+    def _first_key(self, infile, block: int) -> bytes:
+        infile.seek(self._block_offset(infile, block))
+        _read_varint(infile)
+        return infile.read(_read_varint(infile))
+
+    def _read_block(self, infile, block: int):
+        """Terms of ``block`` with their row blocks, in order."""
+        start = self._block_offset(infile, block)
+        end = self._block_offset(infile, block + 1)
+        infile.seek(start)
+        data = infile.read(end - start)
+        position, key = 0, b''
+        while position < len(data):
+            shared, position = _decode_varint(data, position)
+            length, position = _decode_varint(data, position)
+            key = key[:shared] + data[position:position + length]
+            position += length
+            count, position = _decode_varint(data, position)
+            postings, last = [], 0
+            for _ in range(count):
+                delta, position = _decode_varint(data, position)
+                last += delta
+                postings.append(last)
+            yield key, postings
+
+    def terms(self):
+        with open(self.path, 'rb') as infile:
+            for block in range(self.blocks):
+                yield from self._read_block(infile, block)
+
+    def lookup(self, value: str) -> list[tuple[str, list[int]]]:
+        """Indexed columns holding ``value`` with the row blocks it is in."""
+        prefix = value.encode('utf-8') + b'\0'
+        found = []
+        with open(self.path, 'rb') as infile:
+            # the last block starting at or before the prefix holds its first term, if any
+            low, high = 0, self.blocks
+            while high - low > 1:
+                middle = (low + high) // 2
+                if self._first_key(infile, middle) <= prefix:
+                    low = middle
+                else:
+                    high = middle
+            for block in range(low, self.blocks):
+                for key, postings in self._read_block(infile, block):
+                    if key.startswith(prefix):
+                        found.append((key[len(prefix):].decode('utf-8'), postings))
+                    elif key > prefix:
+                        return found
+        return found
+
+
+class ValueIndex:
+    """Row blocks of the values of the indexed columns, kept in segments looked up one after the other."""
+
+    def __init__(self, path: str, columns: list[str], rows: int, block_rows: int, segments: list[_Segment]):
+        self.path = path
+        self.columns = columns
+        self.rows = rows
+        self.block_rows = block_rows
+        self.segments = segments
+
+    @classmethod
+    def load(cls, path: str) -> 'ValueIndex | None':
+        """The index of the file at ``path``, None when there is none or the file changed since."""
+        numbers = _segment_numbers(path)
+        if not numbers or numbers != list(range(len(numbers))):
+            return None
+        reads = [_read_footer(_segment_path(path, number)) for number in numbers]
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return None
+        if None in reads:
+            return None
+        # the last segment was written with the last rows of the file
+        size, mtime_ns, rows = reads[-1][0][:3]
+        if (size, mtime_ns) != (stat_result.st_size, stat_result.st_mtime_ns):
+            return None
+        segments = [_Segment(_segment_path(path, number), footer[4], footer[5], segment_size)
+                    for number, (footer, _, segment_size) in zip(numbers, reads)]
+        footer, columns, _ = reads[0]
+        return cls(path, columns, rows, footer[3], segments)
+
+    def lookup(self, value: str) -> list[tuple[str, list[int]]]:
+        """Indexed columns holding ``value`` with the row blocks it is in."""
+        found = {}
+        for segment in self.segments:
+            for column, postings in segment.lookup(value):
+                _merge_postings(found.setdefault(column, []), postings)
+        # in the order of the terms, like a single segment returns them
+        return sorted(found.items(), key=lambda item: item[0].encode('utf-8'))
+
+    def append(self, rows, start_row: int) -> int:
+        """Index the values of ``rows`` appended at row ``start_row``, returns the number of rows.
+
+        They are written to a new segment, the cost depends on the appended rows and not on the index size.
+        Merges of segments are amortized over the appends.
+        """
+        terms = {}
+        with open(self.path, encoding='utf-8-sig', newline='') as csv_file:
+            fieldnames = next(csv.reader(csv_file), [])
+        positions = [(column, fieldnames.index(column)) for column in self.columns]
+        self.rows = start_row + _add_rows(terms, rows, positions, start_row, self.block_rows)
+        stat_result = os.stat(self.path)
+        self.segments.append(_write_value_index(self.path, stat_result, self.columns, self.rows, self.block_rows,
+                                                terms, len(self.segments)))
+
+        while len(self.segments) > 1 and self.segments[-2].size <= SEGMENT_MERGE_RATIO * self.segments[-1].size:
+            older, newer = self.segments[-2:]
+            terms = dict(older.terms())
+            for key, postings in newer.terms():
+                _merge_postings(terms.setdefault(key, []), postings)
+            self.segments[-2:] = [_write_value_index(self.path, stat_result, self.columns, self.rows,
+                                                     self.block_rows, terms, len(self.segments) - 2)]
+            # left behind by a crash, its postings would be in the merged segment too and merged again at lookup
+            os.remove(newer.path)
+        return self.rows
+
+    def find_rows(self, row_index: RowIndex, column: str, blocks: list[int], value: str, limit: int) -> list[int]:
+        """Rows of ``blocks`` where ``column`` equals ``value``, read through the row checkpoints."""
+        rows = []
+        for block in blocks:
+            row_numbers = range(block * self.block_rows, min((block + 1) * self.block_rows, row_index.rows))
+            header, records = row_index.read_rows(list(row_numbers))
+            position = next(csv.reader(io.StringIO(header.decode('utf-8-sig'), newline=''))).index(column)
+            for row, record in zip(row_numbers, records):
+                fields = next(csv.reader(io.StringIO(record.decode('utf-8'), newline='')), [])
+                if position < len(fields) and fields[position] == value:
+                    rows.append(row)
+                    if len(rows) == limit:
+                        return rows
+        return rows
+
+
+def search(paths: dict[str, str], value: str, limit: int) -> list[dict]:
+    """Files of ``paths`` (by filename) holding ``value`` in an indexed column, with at most ``limit`` rows in all.
+
+    Files without an index, or with a stale one, are skipped.
+    """
+    hits = []
+    for filename, path in paths.items():
+        value_index, row_index = ValueIndex.load(path), RowIndex.load(path)
+        if value_index is None or row_index is None:
+            continue
+        for column, blocks in value_index.lookup(value):
+            rows = value_index.find_rows(row_index, column, blocks, value, limit)
+            if rows:
+                hits.append({'filename': filename, 'column': column, 'rows': rows})
+                limit -= len(rows)
+            if not limit:
+                return hits
+    return hits
@@ -0,0 +1,12 @@
+import importlib
+
+from .dependencies import get_pwd_context
+
+HEAVY_MODULES = ('pandas', 'pyarrow', 'pyarrow.parquet', 'orjson', 'msgpack')
+
+
+def preload():
+    """Import the lazily loaded dependencies and build the password context ahead of the first request."""
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+    get_pwd_context().hash('warmup')
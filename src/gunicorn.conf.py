@@ -1,5 +1,8 @@
 from app.constants import APP_HOST, APP_PORT
-import multiprocessing
+import multiprocessing, os, shutil, tempfile
+
+# prometheus_client aggregates metrics of all workers through files in this directory
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'miniserver-prometheus'))
 
 worker_class = 'uvicorn.workers.UvicornWorker'
 # workers = multiprocessing.cpu_count() * 2 + 1
@@ -12,6 +15,19 @@ errorlog = '-'
 loglevel = 'debug'
 wsgi_app = 'app.main:app'
 
+
+def on_starting(server):
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
 # certfile = '/etc/letsencrypt/live/www.example.com/fullchain.pem'
 # keyfile = '/etc/letsencrypt/live/www.example.com/privkey.pem'
 # ssl_version =  # if necessary
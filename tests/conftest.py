@@ -76,6 +76,11 @@ async def start():
         await delete_user(db, 'new_username2')
     except HTTPException as exp:
         pass
+    for username in ('bulk_user1', 'bulk_user2', 'bulk_user3'):
+        try:
+            await delete_user(db, username)
+        except HTTPException as exp:
+            pass
 
     await create_user(db, test_admin_user.username, test_admin_user.model_dump_json())
     await create_user(db, test_client_user.username, test_client_user.model_dump_json())
@@ -1,14 +1,26 @@
-import pytest, asyncio
+import pytest, asyncio, csv, json, os, shutil, subprocess, sys, textwrap, threading, msgpack, pyarrow as pa, pyarrow.parquet as pq
 from httpx import AsyncClient
 from datetime import timedelta
 from redis.asyncio import Redis
-from fastapi import status
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import status, HTTPException, Response
 
 from src.app.constants import APP_URL, BASE_DIR
 from tests.conftest import test_admin_user, test_client_user, files, get_headers_dict
 from src.app.dependencies import create_access_token, get_db
-from src.app.sql_app.crud import get_user
+from src.app.sql_app.crud import create_user, create_users, get_user, delete_user, update_user
 from src.app.main import app
+from src.app import appends, datasets, formats, jobs, limits, profiling, storage
+from src.app.appends import append_rows, encode_records
+from src.app.routers import uploadfiles
+from src.app.scripts import job_worker
+from src.app.scripts.create_admin import import_users
+from src.app.datasets import build_metadata, build_schema, infer_schema, load_schema, load_stats, read_frame, sample_frame
+from src.app.profiling import ProfileStore, new_profile_id
+from src.app.rowindex import RowIndex, build_row_index
+from src.app.storage import PLACEMENT_KEY, MOVING_KEY, HashRing, UserStorage, move_user
+from src.app.valueindex import ValueIndex, build_value_index
+from benchmarks.harness import compare, percentile, run_load
 
 
 class TestPre:
@@ -216,6 +228,71 @@ class TestUsers:
 
         assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
 
+    # bulk import creates the new users once and reports every item
+    @pytest.mark.asyncio
+    async def test_create_users_bulk_200(self):
+        headers = get_headers_dict(test_admin_user.token)
+        users = [
+            {'username': 'bulk_user1', 'password': 'bulk_password1', 'full_name': 'Bulk One'},
+            {'username': test_client_user.username, 'password': 'other_password'},
+            {'username': 'bulk_user2', 'password': 'bulk_password2', 'email': 'bad'},
+            {'username': 'bulk_user1', 'password': 'bulk_password1'},
+            {'username': '../bulk_user', 'password': 'bulk_password'},
+        ]
+        csv_body = 'username,password,email\nbulk_user1,bulk_password1,\nbulk_user2,bulk_password2,bulk@example.com\n'
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            first = await ac.post(self.endpoint + 'bulk', headers=headers, json=users)
+            second = await ac.post(self.endpoint + 'bulk', content=csv_body, headers={**headers, 'Content-Type': 'text/csv'})
+            token = await ac.post('/token/', data={'username': 'bulk_user2', 'password': 'bulk_password2'})
+            user = await ac.get(self.endpoint + 'bulk_user1', headers=headers)
+            for username in ('bulk_user1', 'bulk_user2'):
+                await ac.delete(self.endpoint + username, headers=headers)
+
+        assert first.status_code == status.HTTP_200_OK
+        assert [(result['username'], result['status']) for result in first.json()] == [
+            ('bulk_user1', 'created'),
+            (test_client_user.username, 'exists'),
+            ('bulk_user2', 'invalid'),
+            ('bulk_user1', 'invalid'),
+            ('../bulk_user', 'invalid'),
+        ]
+        assert first.json()[2]['detail'].startswith('email:')
+        assert [result['status'] for result in second.json()] == ['exists', 'created']
+        assert token.status_code == status.HTTP_200_OK
+        assert user.json()['full_name'] == 'Bulk One' and not user.json()['admin']
+
+    @pytest.mark.parametrize(('user', 'content', 'content_type', 'status_code', 'detail'), (
+            (test_client_user, '[]', 'application/json', status.HTTP_403_FORBIDDEN, None),
+            (test_admin_user, 'username,secret\nbulk_user1,x\n', 'text/csv', status.HTTP_400_BAD_REQUEST, 'Bad header'),
+            (test_admin_user, 'username,password\nbulk_user1,x\nbulk_user2,y,EXTRA\n', 'text/csv',
+             status.HTTP_400_BAD_REQUEST, 'Bad row 2'),
+            (test_admin_user, '{"username": "bulk_user1"}', 'application/json', status.HTTP_400_BAD_REQUEST, 'Bad body'),
+            (test_admin_user, 'bulk_user1', 'text/plain', status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, None),
+    ))
+    @pytest.mark.asyncio
+    async def test_create_users_bulk_invalid(self, user, content, content_type, status_code, detail):
+        headers = {**get_headers_dict(user.token), 'Content-Type': content_type}
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.post(self.endpoint + 'bulk', content=content, headers=headers)
+            created = await ac.get(self.endpoint + 'bulk_user1', headers=get_headers_dict(test_admin_user.token))
+
+        assert response.status_code == status_code
+        if detail:
+            assert response.json()['detail'] == detail
+        assert created.status_code == status.HTTP_404_NOT_FOUND
+
+    # the script imports the same files, running it again changes nothing
+    @pytest.mark.asyncio
+    async def test_import_users(self, tmp_path):
+        path = tmp_path / 'users.json'
+        path.write_text(json.dumps([{'username': 'bulk_user3', 'password': 'bulk_password3'}]))
+
+        assert await import_users(str(path), admin=True) == [{'username': 'bulk_user3', 'status': 'created'}]
+        assert await import_users(str(path), admin=True) == [{'username': 'bulk_user3', 'status': 'exists'}]
+        db: Redis = await anext(get_db())
+        assert (await get_user(db, 'bulk_user3')).admin
+        await delete_user(db, 'bulk_user3')
+
     # no auth admin create user 401
     @pytest.mark.parametrize(('user',), (
             (test_admin_user,),
@@ -283,6 +360,90 @@ class TestUsers:
         assert response.status_code == status.HTTP_401_UNAUTHORIZED
 
 
+class TestProfiles:
+    endpoint = '/profiles/'
+
+    # admin request with X-Profile header is profiled and downloadable 200
+    @pytest.mark.parametrize(('profile_format', 'content_type'), (
+            ('html', 'text/html'),
+            ('speedscope', 'application/json'),
+    ))
+    @pytest.mark.asyncio
+    async def test_profile_admin_200(self, profile_format, content_type):
+        headers = {**get_headers_dict(test_admin_user.token), 'X-Profile': profile_format}
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get('/users/me', headers=headers)
+            profile_id = response.headers['X-Profile-Id']
+            profiles = await ac.get(self.endpoint, headers=get_headers_dict(test_admin_user.token))
+            profile = await ac.get(self.endpoint + profile_id, headers=get_headers_dict(test_admin_user.token))
+
+        assert response.status_code == status.HTTP_200_OK
+        assert profiles.status_code == status.HTTP_200_OK
+        assert profile_id in [meta['id'] for meta in profiles.json()['profiles']]
+        assert profile.status_code == status.HTTP_200_OK
+        assert profile.headers['content-type'].startswith(content_type)
+
+    # the parse and the sort of a profiled read run where the profiler samples them
+    @pytest.mark.asyncio
+    async def test_profile_read_uploadfile(self, monkeypatch):
+        monkeypatch.setattr(profiling, 'PROFILE_INTERVAL', 0.0001)
+        headers = get_headers_dict(test_admin_user.token)
+        with open(os.path.join(BASE_DIR.parent, 'tests', 'csv_files', 'people.csv'), 'rb') as infile:
+            header, *rows = infile.read().splitlines()
+        content = b'\n'.join([header, *rows * 500])
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            await ac.post('/uploadfiles/', headers=headers, files=[('files', ('profiled.csv', content))])
+            response = await ac.get('/uploadfiles/profiled.csv', params={'sort_by': 'Sex'},
+                                    headers={**headers, 'X-Profile': 'speedscope'})
+            profile = await ac.get(self.endpoint + response.headers['X-Profile-Id'], headers=headers)
+            await ac.delete('/uploadfiles/profiled.csv', headers=headers)
+
+        assert response.status_code == status.HTTP_200_OK
+        frames = {frame['name'] for frame in profile.json()['shared']['frames']}
+        assert {'read_frame', 'sort_values'} <= frames
+
+    # client and unmarked requests are not profiled
+    @pytest.mark.parametrize(('headers',), (
+            ({**get_headers_dict(test_client_user.token), 'X-Profile': 'html'},),
+            (get_headers_dict(test_admin_user.token),),
+    ))
+    @pytest.mark.asyncio
+    async def test_profile_skipped(self, headers):
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get('/users/me', headers=headers)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert 'X-Profile-Id' not in response.headers
+
+    # client can't list profiles 403
+    @pytest.mark.asyncio
+    async def test_profiles_client_403(self):
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get(self.endpoint, headers=get_headers_dict(test_client_user.token))
+
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    # unknown profile 404
+    @pytest.mark.parametrize(('profile_id',), (
+            ('0-00000000',),
+            ('..%2F..%2Fconstants.py',),
+    ))
+    @pytest.mark.asyncio
+    async def test_profile_404(self, profile_id):
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get(self.endpoint + profile_id, headers=get_headers_dict(test_admin_user.token))
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    # ring buffer keeps only the latest profiles
+    def test_profile_store_bounded(self, tmp_path):
+        store = ProfileStore(str(tmp_path), limit=2)
+        ids = [store.save('<html></html>', {'id': new_profile_id(), 'format': 'html'})['id'] for _ in range(3)]
+
+        assert [meta['id'] for meta in store.list()] == ids[:0:-1]
+        assert len(list(tmp_path.iterdir())) == 4
+
+
 class TestUploadFiles:
     endpoint = '/uploadfiles/'
 
@@ -302,6 +463,106 @@ class TestUploadFiles:
         assert data['fileinfos'][0]['filename'] == 'organizations.csv'
         assert data['fileinfos'][1]['filename'] == 'people.csv'
 
+    # dtypes inferred at upload are persisted with the file
+    @pytest.mark.parametrize(('user', 'filename', 'columns'), (
+            (test_admin_user, 'people.csv', {'Index': 'int8', 'Sex': 'category', 'Date of birth': 'object'}),
+            (test_client_user, 'organizations.csv', {'Founded': 'int16', 'Name': 'object'}),
+    ))
+    def test_create_uploadfiles_schema(self, user, filename, columns):
+        schema = load_schema(UserStorage(user.username).path(filename))
+
+        assert schema['rows'] == 20
+        assert columns.items() <= schema['columns'].items()
+
+    # the byte order mark isn't part of the first column name
+    @pytest.mark.asyncio
+    async def test_create_uploadfiles_bom(self):
+        headers = {**get_headers_dict(test_client_user.token), 'Accept': 'application/json; shape=rows'}
+        content = '\ufeffid,name\n2,b\n1,a\n'.encode('utf-8')
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            created = await ac.post(self.endpoint, headers=headers, files=[('files', ('bom.csv', content))])
+            listed = await ac.get(self.endpoint, headers=headers)
+            response = await ac.get(self.endpoint + 'bom.csv', headers=headers, params={'sort_by': 'id'})
+            await ac.delete(self.endpoint + 'bom.csv', headers=headers)
+
+        assert created.status_code == status.HTTP_200_OK
+        assert listed.json()['bom.csv']['fieldnames'] == ['id', 'name']
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]
+
+    # files that can't be parsed aren't kept
+    @pytest.mark.parametrize(('content',), (
+            (b'a,b\n1,2\n1,2,3\n',),
+            ('name\ncaf\xe9\n'.encode('latin-1'),),
+    ))
+    @pytest.mark.asyncio
+    async def test_create_uploadfiles_bad_file(self, content):
+        headers = get_headers_dict(test_client_user.token)
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.post(self.endpoint, headers=headers, files=[('files', ('bad.csv', content))])
+            read = await ac.get(self.endpoint + 'bad.csv', headers=headers)
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()['detail'] == 'Bad file'
+        assert read.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_infer_schema(self, tmp_path):
+        path = str(tmp_path / 'typed.csv')
+        with open(path, 'w') as outfile:
+            outfile.write('small,nullable,exact,inexact,kind,born,mixed\n')
+            outfile.write(''.join(f'{i},{i if i % 2 else ""},{i / 2},{i / 10},{"ab"[i % 2]},2000-01-{i + 1:02d},'
+                                  f'{i if i < 4 else "x"}\n' for i in range(8)))
+        os.makedirs(tmp_path / '.meta' / 'typed.csv')
+        schema = build_schema(path)
+
+        assert schema['columns'] == {'small': 'int8', 'nullable': 'Int8', 'exact': 'float32', 'inexact': 'float64',
+                                     'kind': 'category', 'born': 'object', 'mixed': 'object'}
+        assert load_schema(path) == schema
+        df = read_frame(path, ['born', 'kind', 'nullable'], schema)
+        assert list(df.columns) == ['born', 'kind', 'nullable']
+        assert [str(dtype) for dtype in df.dtypes] == ['object', 'category', 'Int8']
+
+        # a changed file is read without the stale schema
+        with open(path, 'a') as outfile:
+            outfile.write('1000,1,1,1,c,2000-02-01,y\n')
+        assert load_schema(path) is None
+
+    # values read back as they are written, through the C parser and pyarrow alike
+    def test_infer_schema_faithful(self, tmp_path):
+        path = str(tmp_path / 'faithful.csv')
+        content = ('big,whole,count,code,at,huge,flag\n'
+                   '18446744073709551615,1.0,1,007,2020-01-01T10:00:00,9007199254740993,True\n'
+                   '1,,,x,2020-01-02T10:00:00,,\n'
+                   '2,3.0,3,007,,1,False\n')
+        with open(path, 'w') as outfile:
+            outfile.write(content)
+        os.makedirs(tmp_path / '.meta' / 'faithful.csv')
+        build_metadata(path)
+        schema = load_schema(path)
+
+        assert schema['columns'] == {'big': 'uint64', 'whole': 'float32', 'count': 'Int8', 'code': 'object',
+                                     'at': 'object', 'huge': 'object', 'flag': 'boolean'}
+        columns = list(schema['columns'])
+        for df in (datasets.preview_frame(path, columns, schema), read_frame(path, columns, schema),
+                   sample_frame(path, columns, schema, 3, 0)):
+            assert df.to_csv(index=False) == content
+
+    # integers too big for float32 keep float64 when a later chunk or an append brings fractions
+    def test_infer_schema_float32_integers(self, tmp_path):
+        path = str(tmp_path / 'big.csv')
+        with open(path, 'w') as outfile:
+            outfile.write('value\n16777217\n0.5\n')
+        os.makedirs(tmp_path / '.meta' / 'big.csv')
+        assert infer_schema(path, chunk_rows=1)['columns'] == {'value': 'float64'}
+
+        with open(path, 'w') as outfile:
+            outfile.write('value\n123456789\n987654321\n')
+        assert build_schema(path)['columns'] == {'value': 'int32'}
+        append_rows(path, encode_records([['0.5']]))
+
+        assert load_schema(path)['columns'] == {'value': 'float64'}
+        assert read_frame(path, ['value'], load_schema(path))['value'].tolist() == [123456789, 987654321, 0.5]
+
     # no auth user upload files 401
     @pytest.mark.asyncio
     async def test_create_uploadfiles_401(self):
@@ -371,6 +632,418 @@ class TestUploadFiles:
 
         assert response.status_code == status.HTTP_400_BAD_REQUEST
 
+    # content negotiation of read user's upload file by filename
+    @pytest.mark.parametrize(('accept', 'content_type', 'load'), (
+            (None, 'application/json', lambda content: json.loads(content)['csv_table'].splitlines()[1:]),
+            ('*/*', 'application/json', lambda content: json.loads(content)['csv_table'].splitlines()[1:]),
+            ('application/json; shape=rows', 'application/json; shape=rows', lambda content: json.loads(content)),
+            ('application/json; shape=columns', 'application/json; shape=columns',
+             lambda content: json.loads(content)['Index']),
+            ('text/csv', 'text/csv', lambda content: content.decode().splitlines()[1:]),
+            ('application/vnd.apache.arrow.stream', 'application/vnd.apache.arrow.stream',
+             lambda content: pa.ipc.open_stream(content).read_all().to_pylist()),
+            ('application/x-parquet', 'application/vnd.apache.parquet',
+             lambda content: pq.read_table(pa.BufferReader(content)).to_pylist()),
+            ('application/msgpack;q=0.9, text/html', 'application/msgpack',
+             lambda content: msgpack.unpackb(content)['Index']),
+    ))
+    @pytest.mark.asyncio
+    async def test_read_file_accept_200(self, accept, content_type, load):
+        headers = get_headers_dict(test_client_user.token)
+        if accept:
+            headers['Accept'] = accept
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get(self.endpoint + 'organizations.csv', headers=headers)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers['content-type'].startswith(content_type)
+        assert len(load(response.content)) == 3
+
+    # missing values of nullable and datetime columns are null in every format
+    def test_render_missing_values(self):
+        import pandas as pd
+
+        df = pd.DataFrame({'count': pd.array([1, None], dtype='Int8'), 'at': pd.to_datetime(['2020-01-01', None])})
+
+        assert json.loads(formats.render(formats.JSON_ROWS, df).body)[1] == {'count': None, 'at': None}
+        assert json.loads(formats.render(formats.JSON_COLUMNS, df).body)['count'] == [1, None]
+        assert msgpack.unpackb(formats.render(formats.MSGPACK, df).body)['at'][1] is None
+        assert json.loads(b''.join(datasets.stream_ndjson([df])).splitlines()[1]) == {'count': None, 'at': None}
+
+    # unsupported media type 406
+    @pytest.mark.asyncio
+    async def test_read_file_accept_406(self):
+        headers = {**get_headers_dict(test_client_user.token), 'Accept': 'text/html, application/xml;q=0.5'}
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get(self.endpoint + 'organizations.csv', headers=headers)
+
+        assert response.status_code == status.HTTP_406_NOT_ACCEPTABLE
+
+    # uniform sample in file order, the same seed gives the same rows again, through the row checkpoints or not
+    @pytest.mark.parametrize(('params', 'size'), (
+            ({'sample': 5, 'seed': 1}, 5),
+            ({'sample': 5, 'seed': 1, 'headers': 'Index,Name', 'sort_by': 'Name'}, 5),
+            ({'sample': 50, 'seed': 2}, 20),
+    ))
+    @pytest.mark.asyncio
+    async def test_read_file_sample_200(self, params, size, tmp_path):
+        headers = {**get_headers_dict(test_client_user.token), 'Accept': 'application/json; shape=rows'}
+        storage = UserStorage(test_client_user.username)
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            first = await ac.get(self.endpoint + 'organizations.csv', headers=headers, params=params)
+            second = await ac.get(self.endpoint + 'organizations.csv', headers=headers, params=params)
+            os.replace(storage.meta_path('organizations.csv', 'rows.idx'), tmp_path / 'rows.idx')
+            try:
+                reservoir = await ac.get(self.endpoint + 'organizations.csv', headers=headers, params=params)
+                reservoir_again = await ac.get(self.endpoint + 'organizations.csv', headers=headers, params=params)
+            finally:
+                os.replace(tmp_path / 'rows.idx', storage.meta_path('organizations.csv', 'rows.idx'))
+
+        assert first.status_code == status.HTTP_200_OK
+        assert first.headers['x-sample-seed'] == str(params['seed'])
+        rows = first.json()
+        assert len(rows) == size
+        assert rows == second.json()
+        assert len(reservoir.json()) == size
+        assert reservoir.json() == reservoir_again.json()
+        if 'sort_by' in params:
+            assert [row['Name'] for row in rows] == sorted(row['Name'] for row in rows)
+        else:
+            assert [row['Index'] for row in rows] == sorted(row['Index'] for row in rows)
+            assert [row['Index'] for row in reservoir.json()] == sorted(row['Index'] for row in reservoir.json())
+
+    @pytest.mark.parametrize(('params', 'status_code'), (
+            ({'sample': 0}, status.HTTP_422_UNPROCESSABLE_ENTITY),
+            ({'sample': 5, 'full': True}, status.HTTP_400_BAD_REQUEST),
+    ))
+    @pytest.mark.asyncio
+    async def test_read_file_sample_invalid(self, params, status_code):
+        headers = get_headers_dict(test_client_user.token)
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get(self.endpoint + 'organizations.csv', headers=headers, params=params)
+
+        assert response.status_code == status_code
+
+    # checkpoints are record boundaries even with line breaks in quoted values and blank lines
+    def test_row_index(self, tmp_path):
+        path = str(tmp_path / 'multiline.csv')
+        with open(path, 'w', newline='') as outfile:
+            outfile.write('id,text\n' + ''.join(f'{i},"line\n{i}"\n' + ('\n' if i % 7 == 0 else '') for i in range(50)))
+        os.makedirs(tmp_path / '.meta' / 'multiline.csv')
+
+        assert build_row_index(path, interval=4) == 50
+        row_index = RowIndex.load(path)
+        header, records = row_index.read_rows([0, 3, 4, 5, 17, 49])
+        assert header == b'id,text\n'
+        assert records == [f'{i},"line\n{i}"\n'.encode() for i in (0, 3, 4, 5, 17, 49)]
+        assert sample_frame(path, ['id', 'text'], None, 50, 0)['id'].tolist() == list(range(50))
+
+    # rows in csv, json or ndjson are appended to the file and show up in reads
+    @pytest.mark.asyncio
+    async def test_append_rows_200(self, monkeypatch):
+        monkeypatch.setattr(uploadfiles, 'PRECOMPRESS_UPLOADS', True)
+        monkeypatch.setattr(uploadfiles, 'PRECOMPRESS_MIN_SIZE', 0)
+        with open(BASE_DIR.parent / 'tests' / 'csv_files' / 'organizations.csv', 'rb') as infile:
+            content = infile.read()
+        headers = get_headers_dict(test_client_user.token)
+        storage = UserStorage(test_client_user.username)
+        csv_body = 'Name,Index,Organization Id,Website,Country,Description,Founded,Industry,Number of employees\n' \
+                   '"Appended, Inc",21,X1,https://a.example/,Chile,First,2001,Glass,10\n'
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            await ac.post(self.endpoint, headers=headers, files=[('files', ('appended.csv', content))])
+            first = await ac.post(self.endpoint + 'appended.csv/rows', content=csv_body,
+                                  headers={**headers, 'Content-Type': 'text/csv'})
+            second = await ac.post(self.endpoint + 'appended.csv/rows',
+                                   json=[{'Index': 22, 'Name': 'Second'}, {'Index': 23, 'Name': 'Third', 'Founded': 1999}],
+                                   headers=headers)
+            third = await ac.post(self.endpoint + 'appended.csv/rows', content='{"Index": 24}\n{"Index": 25}\n',
+                                  headers={**headers, 'Content-Type': 'application/x-ndjson'})
+            rows = await ac.get(self.endpoint + 'appended.csv', params={'sample': 25, 'seed': 0},
+                                headers={**headers, 'Accept': 'application/json; shape=rows'})
+            raw = await ac.get(self.endpoint + 'appended.csv/raw', headers={**headers, 'Accept-Encoding': 'gzip'})
+            await ac.delete(self.endpoint + 'appended.csv', headers=headers)
+
+        assert first.status_code == status.HTTP_200_OK
+        assert first.json() == {'filename': 'appended.csv', 'rows': 1, 'total_rows': 21}
+        assert second.json()['total_rows'] == 23
+        assert third.json()['total_rows'] == 25
+        data = rows.json()
+        assert [row['Index'] for row in data] == list(range(1, 26))
+        assert data[20]['Name'] == 'Appended, Inc'
+        assert data[22]['Founded'] == 1999
+        assert raw.headers['content-encoding'] == 'gzip'
+        assert raw.content.startswith(content) and raw.content.endswith(b'\n24,,,,,,,,\n25,,,,,,,,\n')
+        assert not os.path.exists(storage.meta_dir('appended.csv'))
+
+    @pytest.mark.parametrize(('filename', 'content', 'content_type', 'status_code', 'detail'), (
+            ('people.csv', 'Index,Name\n1,a\n', 'text/csv', status.HTTP_400_BAD_REQUEST, 'Bad header'),
+            ('people.csv', '[{"Index": 1, "Unknown": 2}]', 'application/json', status.HTTP_400_BAD_REQUEST, 'Bad row 1'),
+            ('people.csv', '[{"Index": [1]}]', 'application/json', status.HTTP_400_BAD_REQUEST, 'Bad row 1'),
+            ('people.csv', '[]', 'application/json', status.HTTP_400_BAD_REQUEST, 'No rows'),
+            ('people.csv', '{"Index": ', 'application/json', status.HTTP_400_BAD_REQUEST, 'Bad body'),
+            ('people.csv', 'Index', 'text/plain', status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, 'Unsupported media type'),
+            ('unknow.csv', '{"Index": 1}', 'application/json', status.HTTP_404_NOT_FOUND, 'Filename not found'),
+    ))
+    @pytest.mark.asyncio
+    async def test_append_rows_invalid(self, filename, content, content_type, status_code, detail):
+        headers = {**get_headers_dict(test_admin_user.token), 'Content-Type': content_type}
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.post(self.endpoint + filename + '/rows', content=content, headers=headers)
+
+        assert response.status_code == status_code
+        assert response.json()['detail'] == detail
+
+    # appends update the schema and the checkpoints to what a rebuild from the whole file makes
+    @pytest.mark.parametrize(('initial', 'appended'), (
+            ('id,value\n' + ''.join(f'{i},{i}\n' for i in range(10)), [[str(i), str(i * 1000)] for i in range(10, 19)]),
+            ('id,value\n0,a\n1,"b\nc"', [['2', 'd'], ['3', '"e\nf"'], ['4', '']]),
+            ('id,value', [['0', '2024-01-01']]),
+    ))
+    def test_append_rows_incremental(self, initial, appended, tmp_path):
+        path = str(tmp_path / 'grown.csv')
+        with open(path, 'w', newline='') as outfile:
+            outfile.write(initial)
+        os.makedirs(tmp_path / '.meta' / 'grown.csv')
+        build_schema(path)
+        build_row_index(path, interval=4)
+
+        rows = append_rows(path, encode_records(appended))
+        schema, stats = load_schema(path), load_stats(path)
+        with open(tmp_path / '.meta' / 'grown.csv' / 'rows.idx', 'rb') as infile:
+            index = infile.read()
+        build_schema(path)
+        build_row_index(path, interval=4)
+
+        assert schema == load_schema(path)
+        assert {column: stat.to_dict() for column, stat in stats.items()} == \
+               {column: stat.to_dict() for column, stat in load_stats(path).items()}
+        with open(tmp_path / '.meta' / 'grown.csv' / 'rows.idx', 'rb') as infile:
+            assert index == infile.read()
+        assert rows == schema['rows']
+        assert RowIndex.load(path).read_rows([rows - 1])[1] == [encode_records(appended)[-1]]
+
+    # the lock is renewed while it is held, a rebuild outlasting APPEND_LOCK_TIMEOUT doesn't let a second writer in
+    @pytest.mark.asyncio
+    async def test_file_lock_renewed(self, monkeypatch):
+        monkeypatch.setattr(appends, 'APPEND_LOCK_TIMEOUT', 0.3)
+        monkeypatch.setattr(appends, 'APPEND_LOCK_WAIT', 0)
+        db: Redis = await anext(get_db())
+        async with appends.file_lock(db, 'locked_user', 'locked.csv'):
+            await asyncio.sleep(1)
+            with pytest.raises(HTTPException) as exc_info:
+                async with appends.file_lock(db, 'locked_user', 'locked.csv'):
+                    pass
+
+        assert exc_info.value.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        assert not await db.exists(appends.lock_key('locked_user', 'locked.csv'))
+
+    # values of the columns indexed at upload are found across the user's files, appends and deletes included
+    @pytest.mark.asyncio
+    async def test_search_200(self):
+        csv_files = BASE_DIR.parent / 'tests' / 'csv_files'
+        headers = get_headers_dict(test_admin_user.token)
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            with open(csv_files / 'people.csv', 'rb') as infile:
+                await ac.post(self.endpoint, headers=headers, params={'index_columns': 'Sex,Index'},
+                              files=[('files', ('indexed_people.csv', infile.read()))])
+            with open(csv_files / 'organizations.csv', 'rb') as infile:
+                await ac.post(self.endpoint, headers=headers, params={'index_columns': 'Index'},
+                              files=[('files', ('indexed_orgs.csv', infile.read()))])
+            both = await ac.get(self.endpoint + 'search', headers=headers, params={'q': '7'})
+            limited = await ac.get(self.endpoint + 'search', headers=headers, params={'q': 'Male', 'limit': 3})
+            missing = await ac.get(self.endpoint + 'search', headers=headers, params={'q': 'Nobody'})
+            await ac.post(self.endpoint + 'indexed_people.csv/rows', headers=headers, json=[{'Index': 21, 'Sex': 'Other'}])
+            appended = await ac.get(self.endpoint + 'search', headers=headers, params={'q': 'Other'})
+            await ac.delete(self.endpoint + 'indexed_people.csv', headers=headers)
+            deleted = await ac.get(self.endpoint + 'search', headers=headers, params={'q': '7'})
+            await ac.delete(self.endpoint + 'indexed_orgs.csv', headers=headers)
+
+        assert both.status_code == status.HTTP_200_OK
+        assert sorted(both.json()['hits'], key=lambda hit: hit['filename']) == [
+            {'filename': 'indexed_orgs.csv', 'column': 'Index', 'rows': [6]},
+            {'filename': 'indexed_people.csv', 'column': 'Index', 'rows': [6]},
+        ]
+        hits = limited.json()['hits']
+        assert len(hits) == 1 and hits[0]['column'] == 'Sex' and len(hits[0]['rows']) == 3
+        assert missing.json() == {'q': 'Nobody', 'hits': []}
+        assert appended.json()['hits'] == [{'filename': 'indexed_people.csv', 'column': 'Sex', 'rows': [20]}]
+        assert deleted.json()['hits'] == [{'filename': 'indexed_orgs.csv', 'column': 'Index', 'rows': [6]}]
+
+    @pytest.mark.parametrize(('method', 'path', 'params', 'status_code'), (
+            ('post', '', {'index_columns': 'Index,Unknown'}, status.HTTP_400_BAD_REQUEST),
+            ('get', 'search', {}, status.HTTP_422_UNPROCESSABLE_ENTITY),
+            ('get', 'search', {'q': '1', 'limit': 0}, status.HTTP_422_UNPROCESSABLE_ENTITY),
+    ))
+    @pytest.mark.asyncio
+    async def test_search_invalid(self, method, path, params, status_code):
+        headers = get_headers_dict(test_admin_user.token)
+        files = [('files', ('unindexed.csv', b'Index,Name\n1,a'))] if method == 'post' else None
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.request(method, self.endpoint + path, headers=headers, params=params, files=files)
+
+        assert response.status_code == status_code
+
+    # lookups across many term blocks match a scan, an append merges to what a rebuild writes
+    def test_value_index(self, tmp_path):
+        path = str(tmp_path / 'values.csv')
+        rows = [[str(i), f'v{i % 150}', 'same' if i % 3 else ''] for i in range(500)]
+        with open(path, 'w', newline='') as outfile:
+            csv.writer(outfile, lineterminator='\n').writerows([['id', 'value', 'tag']] + rows[:400])
+        os.makedirs(tmp_path / '.meta' / 'values.csv')
+        build_value_index(path, ['value', 'tag'], block_rows=8)
+        value_index = ValueIndex.load(path)
+        with open(path, 'a', newline='') as outfile:
+            csv.writer(outfile, lineterminator='\n').writerows(rows[400:])
+
+        assert ValueIndex.load(path) is None
+        # appended in small parts, each to a segment merged into the older ones now and then
+        assert value_index.append(rows[400:401], 400) == 401
+        for start in range(401, 500, 9):
+            assert value_index.append(rows[start:start + 9], start) == min(start + 9, 500)
+            assert len(value_index.segments) <= 5
+        value_index = ValueIndex.load(path)
+        assert len(value_index.segments) > 1 and value_index.rows == 500
+        values = ('v0', 'v49', 'v99', 'v149', 'same', '')
+        appended = [value_index.lookup(value) for value in values]
+        build_value_index(path, ['value', 'tag'], block_rows=8)
+        value_index = ValueIndex.load(path)
+        assert len(value_index.segments) == 1 and value_index.rows == 500
+        assert [value_index.lookup(value) for value in values] == appended
+
+        value_index = ValueIndex.load(path)
+        assert value_index.segments[0].blocks > 2
+        for number in range(150):
+            blocks = sorted({i // 8 for i in range(500) if i % 150 == number})
+            assert value_index.lookup(f'v{number}') == [('value', blocks)]
+        assert value_index.lookup('same') == [('tag', sorted({i // 8 for i in range(500) if i % 3}))]
+        assert value_index.lookup('v') == value_index.lookup('v150') == value_index.lookup('') == []
+
+    # full result is streamed in csv or ndjson
+    @pytest.mark.parametrize(('params', 'accept', 'content_type'), (
+            ({'full': True}, None, 'text/csv'),
+            ({'full': True, 'headers': 'Index,Name', 'sort_by': 'Name'}, 'text/csv', 'text/csv'),
+            ({'full': True, 'sort_by': 'Founded'}, 'application/x-ndjson', 'application/x-ndjson'),
+    ))
+    @pytest.mark.asyncio
+    async def test_read_file_full_200(self, params, accept, content_type):
+        headers = get_headers_dict(test_client_user.token)
+        if accept:
+            headers['Accept'] = accept
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get(self.endpoint + 'organizations.csv', headers=headers, params=params)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers['content-type'].startswith(content_type)
+        lines = response.text.splitlines()
+        if content_type == 'text/csv':
+            assert lines[0] == params.get('headers', lines[0])
+            assert len(lines) == 21
+        else:
+            rows = [json.loads(line) for line in lines]
+            assert len(rows) == 20
+            assert [row['Founded'] for row in rows] == sorted(row['Founded'] for row in rows)
+
+    # invalid query of full result 400, unsupported media type 406
+    @pytest.mark.parametrize(('params', 'accept', 'status_code'), (
+            ({'full': True, 'headers': 'Index,Unknown'}, None, status.HTTP_400_BAD_REQUEST),
+            ({'full': True, 'headers': 'Index', 'sort_by': 'Name'}, None, status.HTTP_400_BAD_REQUEST),
+            ({'full': True}, 'application/vnd.apache.parquet', status.HTTP_406_NOT_ACCEPTABLE),
+    ))
+    @pytest.mark.asyncio
+    async def test_read_file_full_invalid(self, params, accept, status_code):
+        headers = get_headers_dict(test_client_user.token)
+        if accept:
+            headers['Accept'] = accept
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get(self.endpoint + 'organizations.csv', headers=headers, params=params)
+
+        assert response.status_code == status_code
+
+    # raw download of the whole file and of byte ranges
+    @pytest.mark.parametrize(('range_header', 'status_code', 'expected'), (
+            (None, status.HTTP_200_OK, lambda content: content),
+            ('bytes=0-99', status.HTTP_206_PARTIAL_CONTENT, lambda content: content[:100]),
+            ('bytes=100-', status.HTTP_206_PARTIAL_CONTENT, lambda content: content[100:]),
+            ('bytes=-50', status.HTTP_206_PARTIAL_CONTENT, lambda content: content[-50:]),
+            ('bytes=0-0,-1', status.HTTP_206_PARTIAL_CONTENT, lambda content: content[:1] + content[-1:]),
+            # overlapping and adjacent ranges are merged, in file order
+            ('bytes=30-39,10-19,0-9,15-25', status.HTTP_206_PARTIAL_CONTENT,
+             lambda content: content[:26] + content[30:40]),
+            ('bytes=' + ','.join(['0-'] * 100), status.HTTP_206_PARTIAL_CONTENT, lambda content: content),
+            # too many ranges are ignored
+            ('bytes=' + ','.join(f'{i * 2}-{i * 2}' for i in range(17)), status.HTTP_200_OK, lambda content: content),
+    ))
+    @pytest.mark.asyncio
+    async def test_read_file_raw(self, range_header, status_code, expected):
+        with open(BASE_DIR.parent / 'tests' / 'csv_files' / 'organizations.csv', 'rb') as infile:
+            content = infile.read()
+        headers = get_headers_dict(test_client_user.token)
+        if range_header:
+            headers['Range'] = range_header
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get(self.endpoint + 'organizations.csv/raw', headers=headers)
+
+        assert response.status_code == status_code
+        assert response.headers['accept-ranges'] == 'bytes'
+        assert int(response.headers['content-length']) == len(response.content)
+        if response.headers['content-type'].startswith('multipart/byteranges'):
+            boundary = response.headers['content-type'].split('boundary=')[1].encode()
+            parts = response.content.split(b'--' + boundary)[1:-1]
+            body = b''.join(part.split(b'\r\n\r\n', 1)[1][:-2] for part in parts)
+        else:
+            body = response.content
+        assert body == expected(content)
+
+    # conditional and invalid raw downloads
+    @pytest.mark.parametrize(('headers', 'status_code'), (
+            ({'Range': 'bytes=100000-'}, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE),
+            ({'Range': 'lines=0-1'}, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE),
+            ({'If-None-Match': 'etag'}, status.HTTP_304_NOT_MODIFIED),
+            ({'Range': 'bytes=0-1', 'If-Range': '"stale"'}, status.HTTP_200_OK),
+    ))
+    @pytest.mark.asyncio
+    async def test_read_file_raw_conditional(self, headers, status_code):
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            auth = get_headers_dict(test_client_user.token)
+            etag = (await ac.head(self.endpoint + 'organizations.csv/raw', headers=auth)).headers['etag']
+            headers = {key: etag if value == 'etag' else value for key, value in headers.items()}
+            response = await ac.get(self.endpoint + 'organizations.csv/raw', headers={**auth, **headers})
+
+        assert response.status_code == status_code
+
+    # precompressed variant is served to gzip clients
+    @pytest.mark.asyncio
+    async def test_read_file_raw_gzip(self, monkeypatch):
+        monkeypatch.setattr(uploadfiles, 'PRECOMPRESS_UPLOADS', True)
+        monkeypatch.setattr(uploadfiles, 'PRECOMPRESS_MIN_SIZE', 0)
+        with open(BASE_DIR.parent / 'tests' / 'csv_files' / 'people.csv', 'rb') as infile:
+            content = infile.read()
+        headers = get_headers_dict(test_client_user.token)
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            await ac.post(self.endpoint, headers=headers, files=[('files', ('gzipped.csv', content))])
+            response = await ac.get(self.endpoint + 'gzipped.csv/raw', headers={**headers, 'Accept-Encoding': 'gzip'})
+            plain = await ac.get(self.endpoint + 'gzipped.csv/raw', headers={**headers, 'Accept-Encoding': 'identity'})
+            await ac.delete(self.endpoint + 'gzipped.csv', headers=headers)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers['content-encoding'] == 'gzip'
+        assert response.content == content
+        assert 'content-encoding' not in plain.headers
+        assert plain.headers['etag'] != response.headers['etag']
+
+    # hidden or nested filenames are rejected 400
+    @pytest.mark.parametrize(('filename',), (
+            ('.meta',),
+            ('../escape.csv',),
+    ))
+    @pytest.mark.asyncio
+    async def test_create_uploadfiles_bad_filename_400(self, filename):
+        headers = get_headers_dict(test_client_user.token)
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.post(self.endpoint, headers=headers, files=[('files', (filename, b'a,b\n1,2'))])
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
     # read user's upload file by filename 404
     @pytest.mark.parametrize(('user',), (
             (test_admin_user,),
@@ -429,6 +1102,516 @@ class TestUploadFiles:
         assert response.status_code == status.HTTP_204_NO_CONTENT
 
 
+class TestLimits:
+    endpoint = '/uploadfiles/'
+
+    # only admins set rate limits
+    @pytest.mark.asyncio
+    async def test_put_rate_limits_client_403(self):
+        headers = get_headers_dict(test_client_user.token)
+        update_data = {'rate_limits': {'read': {'rate': 1000, 'burst': 1000}}}
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.put('/users/me', headers=headers, json=update_data)
+
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    # an admin sets the limits of another user, the admin's own record stays
+    @pytest.mark.asyncio
+    async def test_put_rate_limits_other_user(self):
+        db: Redis = await anext(get_db())
+        headers = get_headers_dict(test_admin_user.token)
+        update_data = {'rate_limits': {'sort': {'rate': 1, 'burst': 5}}}
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.put('/users/' + test_client_user.username, headers=headers, json=update_data)
+            client = await get_user(db, test_client_user.username)
+            admin = await ac.get('/users/me', headers=headers)
+            admin_files = await ac.get(self.endpoint, headers=headers)
+            await ac.put('/users/' + test_client_user.username, headers=headers, json={'rate_limits': None})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()['username'] == test_client_user.username
+        assert response.json()['rate_limits'] == update_data['rate_limits']
+        assert client.rate_limits['sort'].burst == 5
+        assert admin.status_code == status.HTTP_200_OK
+        assert admin.json()['rate_limits'] is None
+        assert 'organizations.csv' in admin_files.json()
+
+    # bucket of the user record is empty after `burst` requests
+    @pytest.mark.asyncio
+    async def test_rate_limit_429(self):
+        headers = get_headers_dict(test_admin_user.token)
+        update_data = {'rate_limits': {'read': {'rate': 0.01, 'burst': 1}}}
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.put('/users/me', headers=headers, json=update_data)
+            assert response.status_code == status.HTTP_200_OK
+            assert response.json()['rate_limits'] == {'read': {'rate': 0.01, 'burst': 1}}
+
+            first = await ac.get(self.endpoint, headers=headers)
+            second = await ac.get(self.endpoint, headers=headers)
+            users = await ac.get('/users/', headers=headers)
+            await ac.put('/users/me', headers=headers, json={'rate_limits': None})
+
+        assert first.status_code == status.HTTP_200_OK
+        assert second.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+        assert 1 <= int(second.headers['retry-after']) <= 100
+        # bucket keys aren't listed as users
+        assert users.status_code == status.HTTP_200_OK
+        assert all(user['username'] for user in users.json())
+
+    # no free slot within ADMISSION_TIMEOUT
+    @pytest.mark.asyncio
+    async def test_concurrency_slot_503(self, monkeypatch):
+        monkeypatch.setattr(limits, '_semaphores', {})
+        monkeypatch.setattr(limits, 'ADMISSION_TIMEOUT', 0.01)
+        monkeypatch.setitem(limits.CONCURRENCY_LIMITS, 'sort', 1)
+
+        async with limits.concurrency_slot('sort'):
+            with pytest.raises(HTTPException) as exc_info:
+                async with limits.concurrency_slot('sort'):
+                    pass
+        async with limits.concurrency_slot('sort'):
+            pass
+
+        assert exc_info.value.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        assert exc_info.value.headers['Retry-After'] == '1'
+
+    # parsing runs in the threadpool while the request holds its slot
+    @pytest.mark.asyncio
+    async def test_parse_in_threadpool(self, monkeypatch):
+        monkeypatch.setattr(limits, '_semaphores', {})
+        monkeypatch.setitem(limits.CONCURRENCY_LIMITS, 'sort', 1)
+        calls = []
+
+        def read_frame(*args):
+            calls.append((threading.current_thread() is threading.main_thread(), limits._semaphores['sort'].locked()))
+            return datasets.read_frame(*args)
+
+        monkeypatch.setattr(uploadfiles, 'read_frame', read_frame)
+        headers = get_headers_dict(test_admin_user.token)
+        with open(os.path.join(BASE_DIR.parent, 'tests', 'csv_files', 'people.csv'), 'rb') as infile:
+            content = infile.read()
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            await ac.post(self.endpoint, headers=headers, files=[('files', ('threads.csv', content))])
+            response = await ac.get(self.endpoint + 'threads.csv', headers=headers, params={'sort_by': 'Sex'})
+            await ac.delete(self.endpoint + 'threads.csv', headers=headers)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert calls == [(False, True)]
+
+
+def crash_job(job_id: str):
+    # dies like a worker process killed for memory
+    os._exit(1)
+
+
+class TestJobs:
+    endpoint = '/jobs/'
+    spec = {'filename': 'jobs.csv', 'headers': 'First Name,Last Name', 'sort_by': 'Last Name'}
+
+    # success submit job 202
+    @pytest.mark.asyncio
+    async def test_create_job_202(self):
+        headers = get_headers_dict(test_admin_user.token)
+        with open(os.path.join(BASE_DIR.parent, 'tests', 'csv_files', 'people.csv'), 'rb') as infile:
+            content = infile.read()
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            await ac.post('/uploadfiles/', headers=headers, files=[('files', ('jobs.csv', content))])
+            response = await ac.post(self.endpoint, headers=headers, json=self.spec)
+
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert response.json()['status'] == 'queued'
+
+    # same file and operation return the submitted job
+    @pytest.mark.asyncio
+    async def test_create_job_deduplicated_200(self):
+        headers = get_headers_dict(test_admin_user.token)
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            first = await ac.post(self.endpoint, headers=headers, json=self.spec)
+            second = await ac.post(self.endpoint, headers=headers, json=self.spec)
+
+        assert first.status_code == second.status_code == status.HTTP_200_OK
+        assert first.json()['id'] == second.json()['id']
+
+    # concurrent identical submits queue one job
+    @pytest.mark.asyncio
+    async def test_create_job_concurrent(self):
+        headers = get_headers_dict(test_admin_user.token)
+        spec = {**self.spec, 'format': 'parquet'}
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            responses = await asyncio.gather(*(ac.post(self.endpoint, headers=headers, json=spec) for _ in range(4)))
+            await ac.delete(self.endpoint + responses[0].json()['id'], headers=headers)
+
+        assert len({response.json()['id'] for response in responses}) == 1
+        assert sorted(response.status_code for response in responses) == [200, 200, 200, 202]
+
+    @pytest.mark.parametrize(('spec', 'status_code'), (
+            ({'filename': 'jobs.csv', 'headers': 'Wrong'}, status.HTTP_400_BAD_REQUEST),
+            ({'filename': 'jobs.csv', 'headers': 'First Name', 'sort_by': 'Email'}, status.HTTP_400_BAD_REQUEST),
+            ({'filename': 'jobs.csv', 'format': 'xlsx'}, status.HTTP_422_UNPROCESSABLE_ENTITY),
+            ({'filename': 'missing.csv'}, status.HTTP_404_NOT_FOUND),
+    ))
+    @pytest.mark.asyncio
+    async def test_create_job_invalid(self, spec, status_code):
+        headers = get_headers_dict(test_admin_user.token)
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.post(self.endpoint, headers=headers, json=spec)
+
+        assert response.status_code == status_code
+
+    # the worker writes the result, it is read back and removed
+    @pytest.mark.parametrize(('format', 'media_type', 'load'), (
+            ('csv', 'text/csv', lambda content: content.decode().splitlines()[1:]),
+            ('ndjson', 'application/x-ndjson',
+             lambda content: [','.join(json.loads(line).values()) for line in content.splitlines()]),
+            ('parquet', 'application/vnd.apache.parquet',
+             lambda content: [','.join(row.values()) for row in pq.read_table(pa.BufferReader(content)).to_pylist()]),
+            ('arrow', 'application/vnd.apache.arrow.stream',
+             lambda content: [','.join(row.values()) for row in pa.ipc.open_stream(content).read_all().to_pylist()]),
+    ))
+    @pytest.mark.asyncio
+    async def test_run_job(self, format, media_type, load):
+        headers = get_headers_dict(test_admin_user.token)
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.post(self.endpoint, headers=headers, json={**self.spec, 'format': format})
+            job_id = response.json()['id']
+            result_status = await asyncio.to_thread(jobs.run_job, job_id)
+            job = (await ac.get(self.endpoint + job_id, headers=headers)).json()
+            result = await ac.get(self.endpoint + job_id + '/result', headers=headers)
+            removed = await ac.delete(self.endpoint + job_id, headers=headers)
+            missing = await ac.get(self.endpoint + job_id, headers=headers)
+
+        assert result_status == 'done'
+        assert (job['status'], job['progress'], job['rows']) == ('done', 1.0, 20)
+        assert result.status_code == status.HTTP_200_OK
+        assert result.headers['content-type'].startswith(media_type)
+        rows = load(result.content)
+        assert len(rows) == 20
+        assert rows == sorted(rows, key=lambda row: row.split(',')[1])
+        assert removed.status_code == status.HTTP_204_NO_CONTENT
+        assert missing.status_code == status.HTTP_404_NOT_FOUND
+
+    # a cancelled job is skipped by the worker and has no result, a new submit queues it again
+    @pytest.mark.asyncio
+    async def test_cancel_job(self):
+        headers = get_headers_dict(test_admin_user.token)
+        spec = {**self.spec, 'format': 'ndjson'}
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            job_id = (await ac.post(self.endpoint, headers=headers, json=spec)).json()['id']
+            cancelled = await ac.delete(self.endpoint + job_id, headers=headers)
+            result_status = await asyncio.to_thread(jobs.run_job, job_id)
+            job = (await ac.get(self.endpoint + job_id, headers=headers)).json()
+            result = await ac.get(self.endpoint + job_id + '/result', headers=headers)
+            resubmitted = await ac.post(self.endpoint, headers=headers, json=spec)
+            await ac.delete(self.endpoint + resubmitted.json()['id'], headers=headers)
+
+        assert cancelled.status_code == status.HTTP_204_NO_CONTENT
+        assert result_status == 'skipped'
+        assert job['status'] == 'cancelled'
+        assert result.status_code == status.HTTP_409_CONFLICT
+        assert resubmitted.status_code == status.HTTP_202_ACCEPTED
+        assert resubmitted.json()['id'] != job_id
+
+    # a job whose process crashed fails and is submitted again, the broken pool is made again
+    @pytest.mark.asyncio
+    async def test_crashed_job(self, monkeypatch):
+        monkeypatch.setattr(job_worker, 'run_job', crash_job)
+        headers = get_headers_dict(test_admin_user.token)
+        spec = {**self.spec, 'format': 'arrow'}
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            job_id = (await ac.post(self.endpoint, headers=headers, json=spec)).json()['id']
+            worker = asyncio.create_task(job_worker.work(1))
+            for _ in range(100):
+                job = (await ac.get(self.endpoint + job_id, headers=headers)).json()
+                if job['status'] == 'failed':
+                    break
+                await asyncio.sleep(0.1)
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+            resubmitted = await ac.post(self.endpoint, headers=headers, json=spec)
+            for removed_id in (job_id, resubmitted.json()['id'], resubmitted.json()['id']):
+                await ac.delete(self.endpoint + removed_id, headers=headers)
+
+        assert job['status'] == 'failed'
+        assert 'BrokenProcessPool' in job['error']
+        assert resubmitted.status_code == status.HTTP_202_ACCEPTED
+        pool = job_worker.JobPool(1)
+        try:
+            with pytest.raises(BrokenProcessPool):
+                pool.submit(crash_job, job_id).result()
+            assert pool.submit(abs, -1).result() == 1
+        finally:
+            pool.shutdown()
+
+    # the file is read from where a rebalance moved it after the submit
+    @pytest.mark.asyncio
+    async def test_run_job_moved(self, tmp_path):
+        headers = get_headers_dict(test_admin_user.token)
+        storage = UserStorage(test_admin_user.username)
+        moved = tmp_path / test_admin_user.username / 'jobs.csv'
+        db: Redis = await anext(get_db())
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            job_id = (await ac.post(self.endpoint, headers=headers, json={**self.spec, 'format': 'ndjson'})).json()['id']
+            os.makedirs(moved.parent)
+            os.replace(storage.path('jobs.csv'), moved)
+            await db.hset(PLACEMENT_KEY, test_admin_user.username, str(tmp_path))
+            try:
+                result_status = await asyncio.to_thread(jobs.run_job, job_id)
+            finally:
+                await db.hset(PLACEMENT_KEY, test_admin_user.username, storage.root)
+                os.replace(moved, storage.path('jobs.csv'))
+            job = (await ac.get(self.endpoint + job_id, headers=headers)).json()
+            await ac.delete(self.endpoint + job_id, headers=headers)
+
+        assert result_status == 'done'
+        assert job['rows'] == 20
+
+    # jobs of other users are not found
+    @pytest.mark.asyncio
+    async def test_read_job_404(self):
+        headers = get_headers_dict(test_admin_user.token)
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            job_id = (await ac.post(self.endpoint, headers=headers, json=self.spec)).json()['id']
+            response = await ac.get(self.endpoint + job_id, headers=get_headers_dict(test_client_user.token))
+            await ac.delete(self.endpoint + job_id, headers=headers)
+            await ac.delete(self.endpoint + job_id, headers=headers)
+            await ac.delete('/uploadfiles/jobs.csv', headers=headers)
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+class TestStorage:
+    endpoint = '/uploadfiles/'
+
+    # users spread evenly and a new root takes users only for itself
+    def test_hash_ring(self):
+        usernames = [f'user{i}' for i in range(4000)]
+        ring = HashRing(['/a', '/b', '/c', '/d'])
+        grown = HashRing(['/a', '/b', '/c', '/d', '/e'])
+        placed = {username: ring.root_for(username) for username in usernames}
+        moved = [username for username in usernames if grown.root_for(username) != placed[username]]
+
+        assert all(600 < list(placed.values()).count(root) < 1400 for root in ring.roots)
+        assert all(grown.root_for(username) == '/e' for username in moved)
+        assert 400 < len(moved) < 1200
+
+    # a user's directory moves to another root with its derived data still valid
+    @pytest.mark.asyncio
+    async def test_move_user(self, tmp_path):
+        source, target = str(tmp_path / 'a'), str(tmp_path / 'b')
+        os.makedirs(os.path.join(source, 'storage_user', '.meta', 'data.csv'))
+        with open(os.path.join(source, 'storage_user', 'data.csv'), 'w') as outfile:
+            outfile.write('a,b\n1,2\n')
+        os.makedirs(os.path.join(target, '.rebalance-storage_user', 'stale'))
+        build_metadata(os.path.join(source, 'storage_user', 'data.csv'))
+        db: Redis = await anext(get_db())
+        await db.hset(PLACEMENT_KEY, 'storage_user', source)
+        try:
+            await move_user(db, 'storage_user', source, target, grace=0)
+            placement = await db.hget(PLACEMENT_KEY, 'storage_user')
+            moving = await db.sismember(MOVING_KEY, 'storage_user')
+        finally:
+            await db.hdel(PLACEMENT_KEY, 'storage_user')
+
+        assert placement == target and not moving
+        assert not os.path.exists(os.path.join(source, 'storage_user'))
+        assert sorted(os.listdir(target)) == ['storage_user']
+        assert load_schema(os.path.join(target, 'storage_user', 'data.csv'))['rows'] == 1
+        assert RowIndex.load(os.path.join(target, 'storage_user', 'data.csv')).rows == 1
+        assert await db.hget(PLACEMENT_KEY, test_admin_user.username) == UserStorage('').root
+
+    # an import reuses a directory left on a root the ring doesn't choose, like a single create does
+    @pytest.mark.asyncio
+    async def test_create_users_found_root(self, tmp_path, monkeypatch):
+        roots = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+        ring = HashRing(roots)
+        found = next(root for root in roots if root != ring.root_for('storage_user'))
+        os.makedirs(os.path.join(found, 'storage_user'))
+        monkeypatch.setattr(storage, 'STORAGE_ROOTS', roots)
+        monkeypatch.setattr(storage, 'get_ring', lambda: ring)
+        db: Redis = await anext(get_db())
+        try:
+            created = await create_users(db, {'storage_user': '{}'})
+            placement = await db.hget(PLACEMENT_KEY, 'storage_user')
+        finally:
+            await db.delete('storage_user')
+            await db.hdel(PLACEMENT_KEY, 'storage_user')
+
+        assert created == {'storage_user': True}
+        assert placement == found
+        assert not os.path.exists(os.path.join(ring.root_for('storage_user'), 'storage_user'))
+
+    # while a rebalance moves the user, files can be read but not changed
+    @pytest.mark.asyncio
+    async def test_moving_user_503(self):
+        headers = get_headers_dict(test_admin_user.token)
+        db: Redis = await anext(get_db())
+        await db.sadd(MOVING_KEY, test_admin_user.username)
+        try:
+            async with AsyncClient(app=app, base_url=APP_URL) as ac:
+                upload = await ac.post(self.endpoint, headers=headers, files=[('files', ('moving.csv', b'a\n1'))])
+                listing = await ac.get(self.endpoint, headers=headers)
+        finally:
+            await db.srem(MOVING_KEY, test_admin_user.username)
+
+        assert upload.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        assert upload.headers['retry-after'] == '5'
+        assert listing.status_code == status.HTTP_200_OK
+
+    # a moving user is neither renamed nor deleted, a move finds nothing to move after a delete
+    @pytest.mark.asyncio
+    async def test_moving_user_kept(self, tmp_path):
+        db: Redis = await anext(get_db())
+        await create_user(db, 'storage_user', '{}')
+        await db.sadd(MOVING_KEY, 'storage_user')
+        try:
+            with pytest.raises(HTTPException) as renamed:
+                await update_user(db, 'storage_user', 'storage_user2', '{}')
+            with pytest.raises(HTTPException) as deleted:
+                await delete_user(db, 'storage_user')
+        finally:
+            await db.srem(MOVING_KEY, 'storage_user')
+            await delete_user(db, 'storage_user')
+
+        assert renamed.value.status_code == deleted.value.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        source, target = str(tmp_path / 'a'), str(tmp_path / 'b')
+        os.makedirs(os.path.join(source, 'storage_user'))
+        await db.hset(PLACEMENT_KEY, 'storage_user', source)
+        try:
+            move = asyncio.create_task(move_user(db, 'storage_user', source, target, grace=0.2))
+            await asyncio.sleep(0.1)
+            shutil.rmtree(os.path.join(source, 'storage_user'))
+            await move
+            placement = await db.hget(PLACEMENT_KEY, 'storage_user')
+        finally:
+            await db.hdel(PLACEMENT_KEY, 'storage_user')
+
+        assert placement == source
+        assert os.listdir(target) == []
+
+
+class TestMetrics:
+    endpoint = '/metrics/'
+
+    # metrics of the requests served above are exposed
+    @pytest.mark.parametrize(('name',), (
+            ('http_request_duration_seconds_count{method="GET",route="/uploadfiles/{filename}",status="200"}',),
+            ('http_requests_in_progress',),
+            ('upload_bytes_total',),
+            ('csv_parse_seconds_count',),
+            ('csv_sort_seconds_count',),
+            ('redis_command_seconds_count{command="GET"}',),
+            ('redis_round_trips_per_request_count',),
+            ('bcrypt_seconds_count{operation="verify"}',),
+    ))
+    @pytest.mark.asyncio
+    async def test_metrics_200(self, name):
+        async with AsyncClient(app=app, base_url=APP_URL) as ac:
+            response = await ac.get(self.endpoint)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert name in response.text
+
+
+class TestBenchmarks:
+    result = {'requests': 100, 'errors': 0, 'p50_ms': 10.0, 'p95_ms': 20.0, 'p99_ms': 30.0, 'rps': 100.0,
+              'peak_rss_mb': 100.0, 'server_peak_rss_mb': 100.0}
+
+    @pytest.mark.parametrize(('q', 'expected'), (
+            (50, 50),
+            (95, 95),
+            (99, 99),
+            (100, 100),
+    ))
+    def test_percentile(self, q, expected):
+        assert percentile(list(range(100, 0, -1)), q) == expected
+
+    # same numbers don't regress
+    def test_compare_ok(self):
+        assert compare({'read': self.result}, {'results': {'read': self.result}}) == []
+
+    # every metric past its threshold is reported
+    @pytest.mark.parametrize(('update', 'metric'), (
+            ({'p95_ms': 40.0}, 'p95_ms'),
+            ({'rps': 50.0}, 'rps'),
+            ({'peak_rss_mb': 200.0}, 'peak_rss_mb'),
+            ({'server_peak_rss_mb': 200.0}, 'server_peak_rss_mb'),
+            ({'errors': 1}, 'errors'),
+    ))
+    def test_compare_regression(self, update, metric):
+        regressions = compare({'read': {**self.result, **update}}, {'results': {'read': self.result}})
+
+        assert len(regressions) == 1
+        assert metric in regressions[0]
+
+    # the peak of a scenario isn't carried over into the scenarios after it
+    @pytest.mark.asyncio
+    async def test_run_load_peak_rss(self):
+        async def allocate(i):
+            block = b'x' * 256 * 1024 ** 2
+            return Response(block[:1])
+
+        async def idle(i):
+            return Response(status_code=200)
+
+        large = await run_load(allocate, 1, 1, os.getpid())
+        small = await run_load(idle, 1, 1, os.getpid())
+        if small['peak_rss_mb'] is None:
+            pytest.skip('peak RSS can not be reset on this platform')
+
+        assert large['peak_rss_mb'] - small['peak_rss_mb'] > 200
+        assert small['server_peak_rss_mb'] == small['peak_rss_mb']
+        assert (await run_load(idle, 1, 1))['server_peak_rss_mb'] is None
+
+    # per scenario thresholds override the defaults
+    def test_compare_thresholds(self):
+        thresholds = {'scenarios': {'read': {'latency_tolerance': 1.5}}}
+        current = {**self.result, 'p95_ms': 40.0}
+
+        assert compare({'read': current}, {'results': {'read': self.result}}, thresholds) == []
+
+
+class TestStartup:
+    import_time_budget = float(os.environ.get('IMPORT_TIME_BUDGET') or 2.0)
+    first_request_budget = float(os.environ.get('FIRST_REQUEST_BUDGET') or 0.5)
+    heavy_modules = ('pandas', 'pyarrow', 'passlib', 'msgpack', 'pyinstrument')
+    script = textwrap.dedent('''
+        import asyncio, json, os, sys, time
+        start = time.perf_counter()
+        from src.app.main import app
+        import_time = time.perf_counter() - start
+        loaded = [name for name in sys.argv[1:] if name in sys.modules]
+
+        from httpx import AsyncClient
+
+        async def first_request():
+            headers = {'Authorization': 'Bearer ' + os.environ['TOKEN']}
+            async with AsyncClient(app=app, base_url='http://test') as ac:
+                start = time.perf_counter()
+                response = await ac.get('/users/me', headers=headers)
+                return response.status_code, time.perf_counter() - start
+
+        status_code, first_request_time = asyncio.run(first_request())
+        print(json.dumps({'import_time': import_time, 'loaded': loaded, 'status_code': status_code,
+                          'first_request_time': first_request_time,
+                          'loaded_after_request': [name for name in sys.argv[1:] if name in sys.modules]}))
+    ''')
+
+    # app.main imports fast, heavy dependencies are loaded only by the endpoints that need them
+    def test_cold_start_budget(self):
+        result = subprocess.run(
+            [sys.executable, '-c', self.script, *self.heavy_modules],
+            cwd=BASE_DIR.parent, env={**os.environ, 'TOKEN': test_client_user.token, 'PRELOAD_HEAVY_MODULES': 'false'},
+            capture_output=True, text=True, check=True,
+        )
+        data = json.loads(result.stdout.splitlines()[-1])
+
+        assert data['loaded'] == []
+        assert data['loaded_after_request'] == []
+        assert data['status_code'] == status.HTTP_200_OK
+        assert data['import_time'] < self.import_time_budget
+        assert data['first_request_time'] < self.first_request_budget
+
+
 class TestPost:
 
     # success delete users me 204, empty DB